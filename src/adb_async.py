@@ -0,0 +1,341 @@
+import asyncio
+import cv2
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from utils import *
+
+############################################
+# 基于asyncio的adb客户端, 直接使用adb server的smart socket协议:
+#   请求 = 4位十六进制长度 + 内容, 例如"000chost:version"; 应答为"OKAY"或"FAIL"+4位长度+错误信息.
+#   host:xxx            对adb server本身的查询(host:version, host:devices...), 结果为4位长度+内容.
+#   host:transport:序列号 之后的请求发给该设备, 例如shell:命令 / exec:命令, 结果读到连接关闭为止.
+# 每个请求使用独立的连接, 因此截图, 点击和shell查询可以在同一个事件循环上同时进行, 各自有超时和取消.
+# 农场线程通过AdbSyncClient使用: 事件循环运行在后台线程中, 同步方法等待对应的协程完成.
+ADB_HOST = '127.0.0.1'
+ADB_PORT = 5037
+
+class AdbError(RuntimeError):
+    pass
+
+class AdbStream:
+    """一个到adb server的连接. 使用事件循环的socket接口, 以便直接读入调用方提供的缓冲区."""
+    def __init__(self, loop, sock):
+        self._loop = loop
+        self._sock = sock
+
+    @classmethod
+    async def open(cls, host, port):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (host, port))
+        except OSError as e:
+            sock.close()
+            raise AdbError(f"无法连接到adb server {host}:{port}: {e}")
+        return cls(loop, sock)
+
+    async def request(self, request):
+        data = request.encode('utf-8')
+        await self._loop.sock_sendall(self._sock, b'%04x' % len(data) + data)
+        status = await self.read_exactly(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(f"{request}: {await self.read_message()}")
+        raise AdbError(f"{request}: 未知的应答{status!r}")
+
+    async def read_message(self):
+        length = int(await self.read_exactly(4), 16)
+        return (await self.read_exactly(length)).decode('utf-8', errors='replace')
+
+    async def read_exactly(self, n):
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            count = await self._loop.sock_recv_into(self._sock, view[received:])
+            if count == 0:
+                raise AdbError(f"连接在读取{n}字节时被关闭")
+            received += count
+        return bytes(data)
+
+    async def read_into(self, buffer):
+        """读到连接关闭为止, 写入buffer(bytearray, 不够时扩大). 返回(buffer, 长度)."""
+        length = 0
+        while True:
+            if length == len(buffer):
+                buffer.extend(bytes(max(len(buffer), 65536)))
+            count = await self._loop.sock_recv_into(self._sock, memoryview(buffer)[length:])
+            if count == 0:
+                return buffer, length
+            length += count
+
+    async def read_all(self):
+        buffer, length = await self.read_into(bytearray(65536))
+        return bytes(buffer[:length])
+
+    def close(self):
+        self._sock.close()
+
+class AdbAsyncClient:
+    def __init__(self, host = ADB_HOST, port = ADB_PORT, serial = None):
+        self.host = host
+        self.port = port
+        self.serial = serial
+        self._stats = {} # kind -> [次数, 总耗时, 最大耗时]
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.timeouts = 0
+
+    async def _open(self, service):
+        stream = await AdbStream.open(self.host, self.port)
+        try:
+            if not service.startswith('host:'):
+                if self.serial is None:
+                    raise AdbError("没有指定设备")
+                await stream.request(f"host:transport:{self.serial}")
+            await stream.request(service)
+        except BaseException:
+            stream.close()
+            raise
+        return stream
+
+    async def _timed(self, kind, coro, timeout):
+        """执行一个请求, 超时时取消它(协程中的finally会关闭连接), 并记录耗时."""
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError(f"adb请求{kind}在{timeout}秒内未完成")
+        finally:
+            self.in_flight -= 1
+            cost = time.perf_counter() - start
+            stat = self._stats.setdefault(kind, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += cost
+            stat[2] = max(stat[2], cost)
+
+    async def _host(self, request):
+        stream = await self._open(request)
+        try:
+            return await stream.read_message()
+        finally:
+            stream.close()
+
+    async def _read_all(self, service):
+        stream = await self._open(service)
+        try:
+            return await stream.read_all()
+        finally:
+            stream.close()
+
+    async def _read_into(self, service, buffer):
+        stream = await self._open(service)
+        try:
+            return await stream.read_into(buffer)
+        finally:
+            stream.close()
+
+    async def host_query(self, request, timeout = 5):
+        """adb server自身的查询, 例如host:version, host:devices."""
+        return await self._timed(request, self._host(request), timeout)
+
+    async def _host_command(self, request):
+        # host:kill之类的请求只有OKAY, 没有后续内容.
+        stream = await self._open(request)
+        stream.close()
+
+    async def version(self, timeout = 5):
+        return int(await self.host_query('host:version', timeout), 16)
+
+    async def devices(self, timeout = 5):
+        """返回[(序列号, 状态)], 状态例如device, offline, unauthorized."""
+        output = await self.host_query('host:devices', timeout)
+        return [tuple(line.split('\t', 1)) for line in output.splitlines() if '\t' in line]
+
+    async def connect(self, address, timeout = 10):
+        """相当于adb connect. 结果是adb的提示信息, 例如"connected to ...", "already connected to ...", "failed to connect to ..."."""
+        return await self.host_query(f'host:connect:{address}', timeout)
+
+    async def disconnect(self, address, timeout = 5):
+        return await self.host_query(f'host:disconnect:{address}', timeout)
+
+    async def kill_server(self, timeout = 5):
+        return await self._timed('host:kill', self._host_command('host:kill'), timeout)
+
+    async def shell(self, cmdStr, timeout = 5):
+        data = await self._timed('shell', self._read_all(f"shell:{cmdStr}"), timeout)
+        return data.decode('utf-8', errors='replace')
+
+    async def exec_out(self, cmdStr, timeout = 5):
+        """exec:不经过终端转换, 适合读取二进制输出."""
+        return await self._timed(f"exec:{cmdStr.split()[0]}", self._read_all(f"exec:{cmdStr}"), timeout)
+
+    async def exec_out_into(self, cmdStr, buffer, timeout = 5):
+        return await self._timed(f"exec:{cmdStr.split()[0]}", self._read_into(f"exec:{cmdStr}", buffer), timeout)
+
+    async def tap(self, pos, timeout = 5):
+        return await self.shell(f"input tap {int(pos[0])} {int(pos[1])}", timeout)
+
+    def stats(self):
+        return {kind: {'count': n, 'mean': total / n, 'max': worst} for kind, (n, total, worst) in self._stats.items()}
+
+############################################
+# 同步接口. 所有客户端共用一个在后台线程中运行的事件循环.
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+def AdbEventLoop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name='AdbEventLoop', daemon=True).start()
+        return _LOOP
+
+class AdbSyncClient:
+    def __init__(self, host = ADB_HOST, port = ADB_PORT, serial = None):
+        self.client = AdbAsyncClient(host, port, serial)
+        self._loop = AdbEventLoop()
+
+    @classmethod
+    def for_device(cls, device):
+        """与ppadb的Device使用同一个adb server和设备."""
+        return cls(device.client.host, device.client.port, device.serial)
+
+    @property
+    def serial(self):
+        return self.client.serial
+
+    def submit(self, coro):
+        """提交一个协程, 立即返回concurrent.futures.Future. 用于同时发出多个请求."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _run(self, coro, timeout):
+        # 协程自己会在timeout后取消并抛出TimeoutError, 这里多等一秒作为保险.
+        return self.submit(coro).result(timeout + 1)
+
+    def host_query(self, request, timeout = 5):
+        return self._run(self.client.host_query(request, timeout), timeout)
+
+    def version(self, timeout = 5):
+        return self._run(self.client.version(timeout), timeout)
+
+    def devices(self, timeout = 5):
+        return self._run(self.client.devices(timeout), timeout)
+
+    def connect(self, address, timeout = 10):
+        return self._run(self.client.connect(address, timeout), timeout)
+
+    def disconnect(self, address, timeout = 5):
+        return self._run(self.client.disconnect(address, timeout), timeout)
+
+    def kill_server(self, timeout = 5):
+        return self._run(self.client.kill_server(timeout), timeout)
+
+    def shell(self, cmdStr, timeout = 5):
+        return self._run(self.client.shell(cmdStr, timeout), timeout)
+
+    def exec_out(self, cmdStr, timeout = 5):
+        return self._run(self.client.exec_out(cmdStr, timeout), timeout)
+
+    def exec_out_into(self, cmdStr, buffer, timeout = 5):
+        return self._run(self.client.exec_out_into(cmdStr, buffer, timeout), timeout)
+
+    def tap(self, pos, timeout = 5):
+        return self._run(self.client.tap(pos, timeout), timeout)
+
+    def stats(self):
+        return self.client.stats()
+
+############################################
+# 本地的adb server替身, 不需要模拟器即可测试上面的客户端.
+# shell_handler(cmdStr) -> str 生成shell输出; screen为exec:screencap返回的BGR画面; delay模拟设备端耗时.
+class FakeAdbServer:
+    def __init__(self, serial = 'emulator-5554', screen = None, shell_handler = None, delay = 0.0):
+        self.serial = serial
+        self.screen = screen if screen is not None else np.zeros((1600, 900, 3), dtype=np.uint8)
+        self.shell_handler = shell_handler if shell_handler is not None else (lambda cmdStr: '')
+        self.delay = delay
+        self.requests = []
+        self.port = None
+        self._server = None
+
+    async def start(self, host = ADB_HOST, port = 0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _reply(self, writer, payload = None):
+        writer.write(b'OKAY')
+        if payload is not None:
+            data = payload.encode('utf-8')
+            writer.write(b'%04x' % len(data) + data)
+        await writer.drain()
+
+    async def _fail(self, writer, message):
+        data = message.encode('utf-8')
+        writer.write(b'FAIL' + b'%04x' % len(data) + data)
+        await writer.drain()
+
+    def _raw_screen(self):
+        rgba = cv2.cvtColor(self.screen, cv2.COLOR_BGR2RGBA)
+        return struct.pack('<IIII', rgba.shape[1], rgba.shape[0], 1, 0) + rgba.tobytes()
+
+    async def _handle(self, reader, writer):
+        transport = None
+        try:
+            while True:
+                request = (await reader.readexactly(int(await reader.readexactly(4), 16))).decode('utf-8')
+                self.requests.append(request)
+                if request == 'host:version':
+                    await self._reply(writer, '0029')
+                    break
+                if request in ('host:devices', 'host:devices-l'):
+                    await self._reply(writer, f"{self.serial}\tdevice\n")
+                    break
+                if request.startswith('host:connect:'):
+                    address = request[len('host:connect:'):]
+                    await self._reply(writer, f"{'already connected' if address == self.serial else 'connected'} to {address}")
+                    break
+                if request.startswith('host:disconnect:'):
+                    await self._reply(writer, f"disconnected {request[len('host:disconnect:'):]}")
+                    break
+                if request == 'host:kill':
+                    await self._reply(writer)
+                    break
+                if request.startswith('host:transport:'):
+                    transport = request[len('host:transport:'):]
+                    if transport != self.serial:
+                        await self._fail(writer, f"device '{transport}' not found")
+                        break
+                    await self._reply(writer)
+                    continue
+                if transport is None:
+                    await self._fail(writer, f"unknown host service: {request}")
+                    break
+                await asyncio.sleep(self.delay)
+                if request.startswith('shell:'):
+                    await self._reply(writer)
+                    writer.write(self.shell_handler(request[len('shell:'):]).encode('utf-8'))
+                elif request == 'exec:screencap':
+                    await self._reply(writer)
+                    writer.write(self._raw_screen())
+                else:
+                    await self._fail(writer, f"unsupported service: {request}")
+                await writer.drain()
+                break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
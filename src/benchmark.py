@@ -0,0 +1,343 @@
+# 性能测试脚本.
+# python src/benchmark.py pyramid [--frames 截图目录] [--repeat 次数]
+#   对比 TEMPLATE_MATCH_OPTIONS 中启用了金字塔匹配的模板, 在整帧匹配和金字塔匹配下的速度与结果是否一致.
+#   截图目录中的png需为1600x900的游戏截图(例如重启前保存在logs中的截图); 不指定时使用合成画面.
+# python src/benchmark.py channel [--frames 截图目录] [--repeat 次数]
+#   对比 TEMPLATE_MATCH_OPTIONS 中配置了channel的模板, 在BGR匹配和单通道匹配下的速度与结果是否一致.
+# python src/benchmark.py roi [--frames 截图目录] [--repeat 次数]
+#   对比任务(quest.json)中带roi的目标, 在原先的整帧涂抹(CutRoI)匹配和RoI视图匹配下的速度与结果是否一致.
+#   不指定截图目录时, 把模板放在每个roi的边界和排除区域附近合成画面, 包括部分超出搜索范围的位置.
+# python src/benchmark.py stream [--file 视频或截图目录] [--fps 帧率] [--seconds 秒数] [--interval 取帧间隔]
+#   不连接模拟器, 用本地文件代替截图源运行流式截图, 输出帧率, 截取耗时和帧龄. 不指定文件时使用合成画面.
+# python src/benchmark.py latency [--serial 设备] [--count 次数] [--pos x y]
+#   连接模拟器, 对比input tap和sendevent点击的耗时. 会真的点击--pos(默认[1,1], 与脚本中的空白点击相同).
+# python src/benchmark.py adb [--delay 秒] [--count 次数]
+#   启动本地的adb server替身, 对比asyncio客户端依次执行和同时执行截图与shell请求的耗时.
+import argparse
+import glob
+from utils import *
+from vision import *
+from capture import *
+from device import *
+from adb_async import *
+from ppadb.client import Client as AdbClient
+
+def LoadFrames(frames_dir):
+    frames = []
+    for path in sorted(glob.glob(os.path.join(frames_dir, '*.png'))):
+        img = LoadImage(path)
+        if img is not None and img.shape == (1600, 900, 3):
+            frames.append((os.path.basename(path), img))
+    return frames
+
+def SyntheticFrames(shortPaths, seed = 0):
+    """每个模板生成一张包含它的画面, 以及一张不包含任何模板的画面."""
+    rng = np.random.default_rng(seed)
+    base = cv2.GaussianBlur(rng.integers(0, 255, (1600, 900, 3), dtype=np.uint8), (7, 7), 0)
+    frames = [('negative', base)]
+    for shortPath in shortPaths:
+        template = LoadTemplateImage(shortPath)
+        th, tw = template.shape[:2]
+        x = int(rng.integers(0, 900 - tw + 1))
+        y = int(rng.integers(0, 1600 - th + 1))
+        frame = base.copy()
+        frame[y:y+th, x:x+tw] = template
+        frames.append((f'{shortPath}@{x},{y}', frame))
+    return frames
+
+def BenchmarkPyramid(frames_dir, repeat):
+    shortPaths = [p for p in TEMPLATE_MATCH_OPTIONS if TemplateOption(p, 'pyramid') and LoadTemplateImage(p) is not None]
+    frames = LoadFrames(frames_dir) if frames_dir else SyntheticFrames(shortPaths)
+    if not frames:
+        print(f"{frames_dir}中没有可用的截图.")
+        return
+    print(f"{len(shortPaths)}个模板, {len(frames)}帧, 每组重复{repeat}次.")
+    print(f"{'模板':<24}{'倍数':>4}{'整帧(ms)':>10}{'金字塔(ms)':>12}{'加速':>7}{'结果不一致':>10}")
+    total_full = total_pyramid = 0.0
+    total_mismatch = 0
+    for shortPath in shortPaths:
+        template = LoadTemplateImage(shortPath)
+        scale = TemplateOption(shortPath, 'pyramid')
+        t_full = t_pyramid = 0.0
+        mismatch = 0
+        for name, frame in frames:
+            for _ in range(repeat):
+                t = time.perf_counter()
+                full_val, full_loc = MatchTemplate(frame, template)
+                t_full += time.perf_counter() - t
+                t = time.perf_counter()
+                pyramid_val, pyramid_loc = MatchTemplatePyramid(frame, template, shortPath, scale)
+                t_pyramid += time.perf_counter() - t
+            full_hit = full_val >= MATCH_THRESHOLD
+            pyramid_hit = pyramid_val >= MATCH_THRESHOLD
+            if (full_hit != pyramid_hit) or (full_hit and (abs(full_loc[0]-pyramid_loc[0]) > 2 or abs(full_loc[1]-pyramid_loc[1]) > 2)):
+                mismatch += 1
+                print(f"  不一致: {shortPath} @ {name}: 整帧{full_val*100:.2f}%{full_loc} 金字塔{pyramid_val*100:.2f}%{pyramid_loc}")
+        n = len(frames) * repeat
+        total_full += t_full
+        total_pyramid += t_pyramid
+        total_mismatch += mismatch
+        print(f"{shortPath:<24}{scale:>4}{t_full/n*1000:>10.2f}{t_pyramid/n*1000:>12.2f}{t_full/max(t_pyramid,1e-9):>7.1f}{mismatch:>10}")
+    print(f"合计: 整帧{total_full:.2f}秒, 金字塔{total_pyramid:.2f}秒, 加速{total_full/max(total_pyramid,1e-9):.1f}倍, 结果不一致{total_mismatch}次.")
+
+def BenchmarkChannel(frames_dir, repeat):
+    shortPaths = [p for p in TEMPLATE_MATCH_OPTIONS if TemplateOption(p, 'channel', 'bgr') != 'bgr' and LoadTemplateImage(p) is not None]
+    frames = LoadFrames(frames_dir) if frames_dir else SyntheticFrames(shortPaths)
+    if not frames:
+        print(f"{frames_dir}中没有可用的截图.")
+        return
+    print(f"{len(shortPaths)}个模板, {len(frames)}帧, 每组重复{repeat}次.")
+    print(f"{'模板':<24}{'通道':>6}{'BGR(ms)':>10}{'单通道(ms)':>12}{'加速':>7}{'结果不一致':>10}")
+    total_bgr = total_channel = 0.0
+    total_mismatch = 0
+    for shortPath in shortPaths:
+        template = LoadTemplateImage(shortPath)
+        mode = TemplateOption(shortPath, 'channel')
+        t_bgr = t_channel = 0.0
+        mismatch = 0
+        for name, frame in frames:
+            for _ in range(repeat):
+                frame = frame.copy() # 每次都是新的一帧, 计入单通道画面的转换开销
+                t = time.perf_counter()
+                bgr_val, bgr_loc = MatchTemplate(frame, template)
+                t_bgr += time.perf_counter() - t
+                t = time.perf_counter()
+                channel_frame, channel_template = ChannelViews(frame, template, shortPath)
+                channel_val, channel_loc = MatchTemplate(channel_frame, channel_template)
+                t_channel += time.perf_counter() - t
+            bgr_hit = bgr_val >= MATCH_THRESHOLD
+            channel_hit = channel_val >= MATCH_THRESHOLD
+            if (bgr_hit != channel_hit) or (bgr_hit and (abs(bgr_loc[0]-channel_loc[0]) > 2 or abs(bgr_loc[1]-channel_loc[1]) > 2)):
+                mismatch += 1
+                print(f"  不一致: {shortPath} @ {name}: BGR{bgr_val*100:.2f}%{bgr_loc} 单通道{channel_val*100:.2f}%{channel_loc}")
+        n = len(frames) * repeat
+        total_bgr += t_bgr
+        total_channel += t_channel
+        total_mismatch += mismatch
+        print(f"{shortPath:<24}{mode:>6}{t_bgr/n*1000:>10.2f}{t_channel/n*1000:>12.2f}{t_bgr/max(t_channel,1e-9):>7.1f}{mismatch:>10}")
+    print(f"合计: BGR{total_bgr:.2f}秒, 单通道{total_channel:.2f}秒, 加速{total_bgr/max(total_channel,1e-9):.1f}倍, 结果不一致{total_mismatch}次.")
+
+def RoITargets():
+    """quest.json中所有(模板, roi)组合. roi为矩形列表的才算, 宝箱与TargetInfo一样加上地图的默认排除区域."""
+    targets = []
+    for quest in LoadJson(ResourcePath(QUEST_FILE)).values():
+        for info in quest.get('_TARGETINFOLIST', []):
+            target = info[0]
+            roi = info[2] if len(info) > 2 else None
+            if roi == 'default':
+                roi = [[0,0,900,1600]] + MAP_ROI_EXCLUSIONS
+            if target == 'chest':
+                roi = (roi or [[0,0,900,1600]]) + MAP_ROI_EXCLUSIONS
+            if not (isinstance(roi, list) and roi and all(isinstance(r, list) and len(r) == 4 for r in roi)):
+                continue
+            if LoadTemplateImage(target) is not None and (target, roi) not in targets:
+                targets.append((target, roi))
+    return targets
+
+def RoIFrames(shortPath, roi, count = 8, seed = 0):
+    """模板放在搜索范围和排除区域的边界上(部分重叠)以及搜索范围内的画面."""
+    rng = np.random.default_rng(seed)
+    base = cv2.GaussianBlur(rng.integers(0, 255, (1600, 900, 3), dtype=np.uint8), (7, 7), 0)
+    template = LoadTemplateImage(shortPath)
+    th, tw = template.shape[:2]
+    frames = [('negative', base)]
+    edges = []
+    for x, y, w, h in roi:
+        edges += [(x - tw//3, y + h//2 - th//2), (x + w - 2*tw//3, y + h//2 - th//2), (x + w//2 - tw//2, y - th//3), (x + w//2 - tw//2, y + h - 2*th//3)]
+    x, y, w, h = roi[0]
+    edges += [(int(rng.integers(x, max(x+1, x+w-tw))), int(rng.integers(y, max(y+1, y+h-th)))) for _ in range(count)]
+    for x, y in edges:
+        x = min(max(0, x), 900 - tw)
+        y = min(max(0, y), 1600 - th)
+        frame = base.copy()
+        frame[y:y+th, x:x+tw] = template
+        frames.append((f'{x},{y}', frame))
+    return frames
+
+def BenchmarkRoI(frames_dir, repeat):
+    targets = RoITargets()
+    frames = LoadFrames(frames_dir) if frames_dir else None
+    if frames == []:
+        print(f"{frames_dir}中没有可用的截图.")
+        return
+    print(f"{len(targets)}个带roi的目标, 每组重复{repeat}次.")
+    print(f"{'模板':<24}{'排除区域':>8}{'涂抹(ms)':>10}{'视图(ms)':>10}{'加速':>7}{'命中':>6}{'结果不一致':>10}")
+    total_paint = total_view = 0.0
+    total_mismatch = 0
+    for shortPath, roi in targets:
+        template = LoadTemplateImage(shortPath)
+        t_paint = t_view = 0.0
+        hits = mismatch = 0
+        testFrames = frames if frames is not None else RoIFrames(shortPath, roi)
+        for name, frame in testFrames:
+            compiled = RoI(roi)
+            for _ in range(repeat):
+                t = time.perf_counter()
+                result = cv2.matchTemplate(CutRoI(frame.copy(), roi), template, cv2.TM_CCOEFF_NORMED)
+                _, paint_val, _, paint_loc = cv2.minMaxLoc(result)
+                t_paint += time.perf_counter() - t
+                t = time.perf_counter()
+                view_val, view_loc = MatchTemplate(frame, template, compiled)
+                t_view += time.perf_counter() - t
+            paint_hit = paint_val >= MATCH_THRESHOLD
+            view_hit = view_loc is not None and view_val >= MATCH_THRESHOLD
+            hits += paint_hit
+            if (paint_hit != view_hit) or (paint_hit and (abs(paint_loc[0]-view_loc[0]) > 2 or abs(paint_loc[1]-view_loc[1]) > 2)):
+                mismatch += 1
+                print(f"  不一致: {shortPath}{roi[0]} @ {name}: 涂抹{paint_val*100:.2f}%{paint_loc} 视图{view_val*100:.2f}%{view_loc}")
+        n = len(testFrames) * repeat
+        total_paint += t_paint
+        total_view += t_view
+        total_mismatch += mismatch
+        print(f"{shortPath:<24}{len(roi)-1:>8}{t_paint/n*1000:>10.2f}{t_view/n*1000:>10.2f}{t_paint/max(t_view,1e-9):>7.1f}{hits:>6}{mismatch:>10}")
+    print(f"合计: 涂抹{total_paint:.2f}秒, 视图{total_view:.2f}秒, 加速{total_paint/max(total_view,1e-9):.1f}倍, 结果不一致{total_mismatch}次.")
+
+def BenchmarkStream(path, fps, seconds, interval):
+    if path:
+        source = FileFrameSource(path, fps)
+    else:
+        frames = [frame for _, frame in SyntheticFrames(list(TEMPLATE_MATCH_OPTIONS)[:8])]
+        delay = 1.0 / fps if fps else 0.0
+        counter = iter(range(1 << 62))
+        def source():
+            time.sleep(delay)
+            return frames[next(counter) % len(frames)]
+    stream = FrameStream(source)
+    stream.start()
+    print(f"运行{seconds}秒, 每{interval*1000:.0f}ms取一帧, 每取5帧模拟一次输入.")
+    start = time.monotonic()
+    ages = []
+    count = 0
+    try:
+        while time.monotonic() - start < seconds:
+            count += 1
+            if count % 5 == 0:
+                stream.mark_input()
+            _, age = stream.latest()
+            ages.append(age)
+            time.sleep(interval)
+    finally:
+        stream.stop()
+        if path:
+            source.close()
+    s = stream.stats()
+    ages.sort()
+    print(f"截取{s['captured']}帧, {s['fps']:.1f}fps, 平均每帧{s['capture_latency']*1000:.1f}ms.")
+    print(f"取帧{s['served']}次, 帧龄 平均{s['served_age']*1000:.1f}ms / 中位{ages[len(ages)//2]*1000:.1f}ms / 最大{ages[-1]*1000:.1f}ms.")
+    print(f"输入后等待新帧{s['waits']}次, 平均{s['wait_time']*1000:.1f}ms. 出错{s['errors']}次.")
+
+def BenchmarkLatency(host, port, serial, count, pos):
+    client = AdbClient(host=host, port=port)
+    device = client.device(serial) if serial else next(iter(client.devices()), None)
+    if device is None:
+        print("没有找到设备.")
+        return
+    session = ShellSession(lambda: device)
+    touch = ParseGetevent(session.run("getevent -p").result(10))
+    if touch is None:
+        print("没有找到触摸屏设备, 只测试input tap.")
+    elif session.run(f"test -w {touch.path} && echo ok").result(10).strip() != 'ok':
+        print(f"没有{touch.path}的写入权限, 只测试input tap.")
+        touch = None
+    else:
+        print(f"触摸屏: {touch.path}")
+    cases = [('input tap', lambda: f"input tap {pos[0]} {pos[1]}")]
+    if touch is not None:
+        cases.append(('sendevent', lambda: touch.tap(pos)))
+    print(f"{'方式':<12}{'平均(ms)':>10}{'中位(ms)':>10}{'最小(ms)':>10}{'最大(ms)':>10}")
+    try:
+        for name, script in cases:
+            costs = []
+            for _ in range(count):
+                t = time.perf_counter()
+                session.run(script()).result(10)
+                costs.append(time.perf_counter() - t)
+                time.sleep(0.2)
+            costs.sort()
+            print(f"{name:<12}{sum(costs)/len(costs)*1000:>10.1f}{costs[len(costs)//2]*1000:>10.1f}{costs[0]*1000:>10.1f}{costs[-1]*1000:>10.1f}")
+    finally:
+        session.close()
+
+def BenchmarkAdb(delay, count):
+    loop = AdbEventLoop()
+    server = asyncio.run_coroutine_threadsafe(FakeAdbServer(delay=delay, shell_handler=lambda cmdStr: f"{cmdStr}\n").start(), loop).result()
+    adb = AdbSyncClient(port=server.port, serial=server.serial)
+    try:
+        print(f"adb server替身: 端口{server.port}, 每个请求的设备端耗时{delay*1000:.0f}ms. adb版本: {adb.host_query('host:version')}")
+        capture = RawScreencap()
+        assert capture.capture(adb).shape == (1600, 900, 3)
+        assert adb.shell('echo ok') == 'echo ok\n'
+
+        t = time.perf_counter()
+        for i in range(count):
+            capture.capture(adb)
+            adb.tap([1, 1])
+            adb.shell('date')
+        sequential = time.perf_counter() - t
+
+        t = time.perf_counter()
+        for i in range(count):
+            futures = [adb.submit(adb.client.exec_out('screencap')), adb.submit(adb.client.tap([1, 1])), adb.submit(adb.client.shell('date'))]
+            for future in futures:
+                future.result(10)
+        concurrent = time.perf_counter() - t
+
+        print(f"截图+点击+查询 x{count}: 依次执行{sequential:.2f}秒, 同时执行{concurrent:.2f}秒, 最多同时{adb.client.max_in_flight}个请求.")
+        for kind, s in sorted(adb.stats().items()):
+            print(f"  {kind:<16}{s['count']:>5}次 平均{s['mean']*1000:>7.1f}ms 最大{s['max']*1000:>7.1f}ms")
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='WvDAS benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pyramid = subparsers.add_parser('pyramid', help='Compare full-resolution and pyramid template matching')
+    pyramid.add_argument('--frames', type=str, default=None, help='Directory of 1600x900 screenshots (default: synthetic frames)')
+    pyramid.add_argument('--repeat', type=int, default=3, help='Repetitions per template and frame')
+
+    channel = subparsers.add_parser('channel', help='Compare BGR and grayscale/single-channel template matching')
+    channel.add_argument('--frames', type=str, default=None, help='Directory of 1600x900 screenshots (default: synthetic frames)')
+    channel.add_argument('--repeat', type=int, default=3, help='Repetitions per template and frame')
+
+    roi = subparsers.add_parser('roi', help='Compare painted full-frame and RoI view template matching for quest targets')
+    roi.add_argument('--frames', type=str, default=None, help='Directory of 1600x900 screenshots (default: synthetic frames)')
+    roi.add_argument('--repeat', type=int, default=3, help='Repetitions per target and frame')
+
+    stream = subparsers.add_parser('stream', help='Run streaming capture against a local stand-in source')
+    stream.add_argument('--file', type=str, default=None, help='Video file or directory of screenshots (default: synthetic frames)')
+    stream.add_argument('--fps', type=float, default=10, help='Frame rate of the stand-in source')
+    stream.add_argument('--seconds', type=float, default=5, help='Duration of the run')
+    stream.add_argument('--interval', type=float, default=0.05, help='Seconds between frame requests')
+
+    latency = subparsers.add_parser('latency', help='Compare input tap and sendevent tap latency on a connected device')
+    latency.add_argument('--host', type=str, default='127.0.0.1', help='adb server host')
+    latency.add_argument('--port', type=int, default=5037, help='adb server port')
+    latency.add_argument('--serial', type=str, default=None, help='Device serial (default: first device)')
+    latency.add_argument('--count', type=int, default=10, help='Taps per backend')
+    latency.add_argument('--pos', type=int, nargs=2, default=[1, 1], help='Tap position')
+
+    adb = subparsers.add_parser('adb', help='Exercise the asyncio adb client against a local fake adb server')
+    adb.add_argument('--delay', type=float, default=0.05, help='Simulated device-side latency per request (seconds)')
+    adb.add_argument('--count', type=int, default=10, help='Rounds of capture + tap + shell')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    match args.command:
+        case 'pyramid':
+            BenchmarkPyramid(args.frames, args.repeat)
+        case 'channel':
+            BenchmarkChannel(args.frames, args.repeat)
+        case 'roi':
+            BenchmarkRoI(args.frames, args.repeat)
+        case 'stream':
+            BenchmarkStream(args.file, args.fps, args.seconds, args.interval)
+        case 'latency':
+            BenchmarkLatency(args.host, args.port, args.serial, args.count, args.pos)
+        case 'adb':
+            BenchmarkAdb(args.delay, args.count)
+
+if __name__ == "__main__":
+    main()
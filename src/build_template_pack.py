@@ -0,0 +1,9 @@
+# 构建模板打包文件 resources/templates.pack.
+# 在pyinstaller打包之前运行: python src/build_template_pack.py
+# 运行时如果打包文件缺失或过期, 会自动回退到逐个解码png.
+import sys
+from utils import *
+
+if __name__ == "__main__":
+    RegisterConsoleHandler()
+    BuildTemplatePack(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+from utils import *
+
+############################################
+# 等待时间校准. 代码中的等待时间(WaitUntil的timeout)是按作者的电脑写的:
+# 快的电脑上白白等待, 慢的电脑上等不到画面, 反复重启后_MAXRETRYLIMIT越来越大.
+# 每次WaitUntil(见script.py, 包括FindCoordsOrElseExecuteFallbackAndWait每次重试前的等待)结束时,
+# 记录从发出操作到认出下一个画面的实际耗时, 按名称(即转换)分别保存. 超时的等待也记录下来, 作为删失样本:
+# 只知道耗时超过了当时的等待时间. 分位数用Kaplan-Meier估计, 不会因为只统计等到了的样本而偏小.
+# 之后的timeout取该转换耗时的quantile分位数乘以margin, 限制在默认值的[min_scale, max_scale]倍之间.
+# 超时的比例太高, 分位数落在等待时间之外时:
+#   等到了的样本有的已经接近等待时间 -> 等待时间截断了耗时的分布, 说明这台电脑上这一步更慢, 把等待时间加倍.
+#   等到了的样本都远小于等待时间 -> 超时是因为还需要再操作一次(例如对话要点好几下), 与快慢无关, 只用等到了的样本.
+# 校准模式: 所有等待都使用默认值的max_scale倍, 让慢的转换也能被完整测量, 结束时输出报告.
+# 结果保存在CALIBRATION_FILE中, 下次启动继续使用. 报告也可以用命令行参数-calibration-report输出.
+CALIBRATION_FILE = 'calibration.json'
+
+class SleepProfile:
+    def __init__(self, path = CALIBRATION_FILE, quantile = 95, margin = 1.5, min_samples = 5, max_samples = 200, min_scale = 0.5, max_scale = 2.0):
+        self.path = path
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.max_samples = max_samples # 每个转换只保留最近的样本
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.calibrating = False
+        self._lock = threading.Lock()
+        self._transitions = LoadJson(path) # 名称 -> {'default': 默认等待, 'samples': [[耗时, 是否超时]], 'timeouts': 次数}
+        self._dirty = False
+        self._last_save = time.time()
+        self._upgrade()
+
+    def _upgrade(self):
+        # 旧的记录只有等到了的耗时.
+        for entry in self._transitions.values():
+            entry['samples'] = [sample if isinstance(sample, list) else [sample, 0] for sample in entry['samples']]
+            entry.pop('expired', None)
+
+    def _quantile(self, samples):
+        """带删失样本的分位数(Kaplan-Meier). 超时的样本在它之后不再计入风险集. 估计不到时返回None."""
+        atRisk = len(samples)
+        survival = 1.0
+        for value, censored in sorted(samples): # 同一时间先算等到了的样本
+            if not censored:
+                survival *= 1 - 1 / atRisk
+                if 1 - survival >= self.quantile / 100:
+                    return value
+            atRisk -= 1
+        return None
+
+    def _calibrated(self, entry, default, min_scale = None):
+        samples = entry['samples']
+        if len(samples) < self.min_samples:
+            return None
+        value = self._quantile(samples)
+        if value is None:
+            met = [v for v, censored in samples if not censored]
+            limit = max(v for v, censored in samples if censored)
+            if not met or max(met) >= 0.75 * limit:
+                value = limit * 2 / self.margin
+            else:
+                value = float(np.percentile(met, self.quantile))
+        min_scale = self.min_scale if min_scale is None else min_scale
+        return min(max(value * self.margin, default * min_scale), default * self.max_scale)
+
+    def timeout(self, name, default, min_scale = None):
+        """转换name的等待时间. default为代码中写的等待时间. min_scale: 代替self.min_scale, 例如不允许缩短时为1."""
+        if self.calibrating:
+            return default * self.max_scale
+        with self._lock:
+            entry = self._transitions.get(name)
+            if entry is None:
+                return default
+            value = self._calibrated(entry, default, min_scale)
+            return default if value is None else value
+
+    def record(self, name, waited, default, met):
+        with self._lock:
+            entry = self._transitions.setdefault(name, {'default': default, 'samples': [], 'timeouts': 0})
+            entry['default'] = default
+            entry['samples'].append([round(waited, 3), 0 if met else 1])
+            del entry['samples'][:-self.max_samples]
+            if not met:
+                entry['timeouts'] += 1
+            self._dirty = True
+
+    def use_file(self, path):
+        """改为读写path. path还不存在时保留当前已经载入的记录, 之后保存到path."""
+        with self._lock:
+            self.path = path
+            if os.path.exists(path):
+                self._transitions = LoadJson(path)
+                self._dirty = False
+            self._upgrade()
+
+    def save(self, force = False):
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._last_save < 60):
+                return
+            data = json.loads(json.dumps(self._transitions))
+            self._dirty = False
+            self._last_save = time.time()
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+        except Exception as e:
+            logger.error(f"保存等待时间校准时发生错误: {e}")
+
+    def report(self):
+        """每个转换一行: 样本数, 超时次数, 等到了的耗时的p50/p90/p95, 默认等待和校准后的等待."""
+        rows = []
+        with self._lock:
+            for name, entry in sorted(self._transitions.items()):
+                samples = entry['samples']
+                met = [v for v, censored in samples if not censored]
+                default = entry['default']
+                row = {'name': name, 'samples': len(samples), 'timeouts': len(samples) - len(met), 'default': default,
+                       'p50': None, 'p90': None, 'p95': None, 'calibrated': self._calibrated(entry, default)}
+                if met:
+                    row['p50'], row['p90'], row['p95'] = (float(v) for v in np.percentile(met, [50, 90, 95]))
+                rows.append(row)
+        return rows
+
+    def log_report(self):
+        rows = self.report()
+        if not rows:
+            logger.info("等待时间校准: 还没有任何记录.")
+            return
+        def seconds(value):
+            return f"{value:.2f}秒" if value is not None else "-"
+        lines = []
+        for row in rows:
+            calibrated = row['calibrated']
+            change = f"{(calibrated - row['default']) / row['default']:+.0%}" if calibrated is not None and row['default'] else "样本不足"
+            lines.append(f"{row['name']}: {row['samples']}次/超时{row['timeouts']}次, "
+                         f"p50 {seconds(row['p50'])}, p90 {seconds(row['p90'])}, p95 {seconds(row['p95'])}, "
+                         f"默认{seconds(row['default'])} -> 校准{seconds(calibrated)} ({change})")
+        logger.info("等待时间校准报告:\n" + "\n".join(lines), extra={"summary": True})
+
+SLEEP_PROFILE = SleepProfile()
@@ -0,0 +1,465 @@
+import cv2
+import numpy as np
+import os
+import glob
+import time
+import struct
+import threading
+from collections import deque
+from utils import *
+from vision import *
+
+############################################
+# 截图方式.
+# png: ppadb的screencap(), 设备端执行screencap -p编码png, 本地再用cv2.imdecode解码. 兼容性最好, 但编解码都很慢.
+# raw: 通过exec-out执行不带-p的screencap, 直接读取帧缓冲(头部 + RGBA像素), 不需要任何编解码.
+# stream: 后台线程连续执行raw截图, 截图时直接取最新的一帧, 不再等待一次完整的截图.
+# 默认仍为png, 与以前相同; raw和stream需要在设置中选择.
+CAPTURE_MODES = ['png', 'raw', 'stream']
+DEFAULT_CAPTURE_MODE = 'png'
+
+# screencap的原始输出: width, height, format(, colorSpace)均为uint32小端, android 9以后头部多了colorSpace.
+RAW_HEADER_SIZES = (16, 12)
+RAW_PIXEL_FORMATS = {1: 'RGBA_8888', 2: 'RGBX_8888'} # 只支持每像素4字节的格式
+RAW_INITIAL_BUFFER = 16 + 1600*900*4
+
+class RawScreencap:
+    """exec-out screencap. 接收缓冲区在多次截图之间复用, 像素数据用np.frombuffer直接读取.
+    返回的BGR图像每次都是新的数组: 调用方会同时持有多帧, 匹配时的派生图像缓存也以数组本身区分帧."""
+    def __init__(self):
+        self._buffer = bytearray(RAW_INITIAL_BUFFER)
+        self._lock = threading.Lock()
+        self.frames = 0
+
+    def _receive(self, device, timeout):
+        if hasattr(device, 'exec_out_into'):
+            # AdbSyncClient(adb_async.py): 在事件循环中读入同一个缓冲区.
+            self._buffer, length = device.exec_out_into("screencap", self._buffer, timeout)
+            return length
+        conn = device.create_connection(timeout=timeout)
+        with conn:
+            conn.send("exec:screencap")
+            length = 0
+            while True:
+                if length == len(self._buffer):
+                    self._buffer.extend(bytes(len(self._buffer)))
+                received = conn.socket.recv_into(memoryview(self._buffer)[length:])
+                if received == 0:
+                    break
+                length += received
+        return length
+
+    def _parse(self, length):
+        if length < max(RAW_HEADER_SIZES):
+            raise RuntimeError(f"截图数据过短: {length}字节")
+        width, height, pixel_format = struct.unpack_from('<III', self._buffer, 0)
+        payload = width * height * 4
+        header = length - payload
+        if header < min(RAW_HEADER_SIZES):
+            raise RuntimeError(f"截图数据不完整: {width}x{height}, 只收到{length}字节")
+        if header not in RAW_HEADER_SIZES:
+            # 数据比头部描述的多, 说明screencap的输出不是预期的格式.
+            raise ValueError(f"无法解析原始截图: {width}x{height}, 格式{pixel_format}, 共{length}字节")
+        if pixel_format not in RAW_PIXEL_FORMATS:
+            raise ValueError(f"不支持的像素格式: {pixel_format}")
+        rgba = np.frombuffer(self._buffer, dtype=np.uint8, count=payload, offset=header).reshape(height, width, 4)
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+    def capture(self, device, timeout = 5):
+        with self._lock:
+            length = self._receive(device, timeout)
+            image = self._parse(length)
+            self.frames += 1
+            return image
+
+def ScreencapPng(device):
+    screenshot = device.screencap()
+    screenshot_np = np.frombuffer(screenshot, dtype=np.uint8)
+
+    if screenshot_np.size == 0:
+        logger.error("截图数据为空！")
+        raise RuntimeError("截图数据为空")
+
+    image = cv2.imdecode(screenshot_np, cv2.IMREAD_COLOR)
+
+    if image is None:
+        logger.error("OpenCV解码失败：图像数据损坏")
+        raise RuntimeError("图像解码失败")
+    return image
+
+############################################
+# 带时间戳的画面. taken为开始截取时的本机时间(time.time()).
+# 设备在收到screencap命令后立刻读取帧缓冲, 之后的耗时都花在编码和传输上, 所以用开始时间代表画面的时间.
+# TimedFrame同时是Frame(vision.py), 派生图像和匹配结果缓存在画面上.
+class TimedFrame(Frame):
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        self.taken = getattr(obj, 'taken', None)
+def Timestamped(image, taken):
+    frame = image.view(TimedFrame)
+    frame.taken = taken
+    return frame
+def FrameTime(image):
+    """画面的截取时间(本机时间). 不是截图得到的画面返回None."""
+    return getattr(image, 'taken', None)
+
+############################################
+# 设备时钟. 像NTP一样估计设备时钟与本机时钟之差, 之后需要设备时间时不再执行date.
+# 每次采样: 本机t0 -> 设备date -> 本机t1, 视为设备在(t0+t1)/2读取了时间. 往返越短的采样越可信.
+class DeviceClock:
+    def __init__(self, read_device_time, samples = 5, resync_interval = 600):
+        self.read_device_time = read_device_time # 无参数, 返回设备时间(秒)字符串或数值的函数
+        self.samples = samples
+        self.resync_interval = resync_interval
+        self.offset = 0.0   # 设备时间 - 本机时间
+        self.rtt = None     # 最佳采样的往返时间, offset的误差不超过rtt/2
+        self.jitter = None  # 往返较短的一半采样中offset的极差
+        self.synced_at = None
+        self.syncs = 0
+
+    def sync(self):
+        results = []
+        for _ in range(self.samples):
+            t0 = time.time()
+            device_time = float(str(self.read_device_time()).strip())
+            t1 = time.time()
+            results.append((t1 - t0, device_time - (t0 + t1) / 2))
+        results.sort()
+        offsets = [offset for _, offset in results[:len(results)//2 + 1]]
+        self.rtt, self.offset = results[0]
+        self.jitter = max(offsets) - min(offsets)
+        self.synced_at = time.monotonic()
+        self.syncs += 1
+        logger.debug(f"设备时钟: 偏差{self.offset*1000:+.1f}ms, 往返{self.rtt*1000:.1f}ms, 抖动{self.jitter*1000:.1f}ms.")
+
+    def ensure(self):
+        if self.synced_at is None or time.monotonic() - self.synced_at > self.resync_interval:
+            self.sync()
+
+    def invalidate(self):
+        """设备重连/模拟器重启后时钟可能变化, 下次使用时重新同步."""
+        self.synced_at = None
+
+    def to_device(self, host_time):
+        self.ensure()
+        return host_time + self.offset
+
+    def now(self):
+        return self.to_device(time.time())
+
+############################################
+# 流式截图. 后台线程不断从source取帧放进一个很小的环形缓冲区, 取帧时只拿最新的一帧.
+# 输入(点击, 滑动等)之后画面会变化, 因此mark_input()之后, 只有在输入之后才开始截取的帧才会被返回.
+class StreamFrame:
+    def __init__(self, image, seq, started, captured):
+        self.image = image # TimedFrame
+        self.seq = seq
+        self.started = started   # 开始截取的时间(time.monotonic)
+        self.captured = captured # 截取完成的时间
+
+class FrameStream:
+    def __init__(self, source, size = 3, name = 'FrameStream'):
+        self.source = source # 无参数, 返回一帧BGR画面的函数
+        self.name = name
+        self._frames = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        self._seq = 0
+        self._input_time = 0.0
+        self._recent = deque(maxlen=30) # 最近几帧的完成时间, 用于计算fps
+
+        self.captured = 0
+        self.served = 0
+        self.waits = 0
+        self.errors = 0
+        self.capture_time = 0.0 # 截取耗时总和
+        self.served_age = 0.0   # 返回的帧的帧龄总和
+        self.wait_time = 0.0    # 等待新帧的时间总和
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logger.debug(f"{self.name}已启动.")
+
+    def stop(self, timeout = 2):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._cond:
+            self._frames.clear()
+            self._error = None
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            taken = time.time()
+            try:
+                image = Timestamped(self.source(), taken)
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self.errors += 1
+                    self._cond.notify_all()
+                # 交给取帧的一方处理(例如重启adb), 这里稍等再重试.
+                self._stop.wait(0.5)
+                continue
+            captured = time.monotonic()
+            with self._cond:
+                self._seq += 1
+                self._frames.append(StreamFrame(image, self._seq, started, captured))
+                self._recent.append(captured)
+                self._error = None
+                self.captured += 1
+                self.capture_time += captured - started
+                self._cond.notify_all()
+
+    def mark_input(self):
+        """通知画面即将/已经被输入改变. 之后latest()只返回在此之后开始截取的帧."""
+        with self._cond:
+            self._input_time = time.monotonic()
+
+    def latest(self, timeout = 5):
+        """返回(画面, 帧龄秒数). 没有合格的帧时等待下一帧; 后台截图出错时在这里抛出."""
+        deadline = time.monotonic() + timeout
+        waited_from = None
+        with self._cond:
+            while True:
+                if self._frames and self._frames[-1].started >= self._input_time:
+                    frame = self._frames[-1]
+                    break
+                if self._error is not None:
+                    error, self._error = self._error, None
+                    raise error
+                if not self.running:
+                    raise RuntimeError(f"{self.name}未运行")
+                now = time.monotonic()
+                if now >= deadline:
+                    raise TimeoutError(f"{self.name}在{timeout}秒内没有新的画面")
+                if waited_from is None:
+                    waited_from = now
+                    self.waits += 1
+                self._cond.wait(deadline - now)
+            now = time.monotonic()
+            age = now - frame.captured
+            self.served += 1
+            self.served_age += age
+            if waited_from is not None:
+                self.wait_time += now - waited_from
+        return frame.image, age
+
+    def fps(self):
+        with self._cond:
+            if len(self._recent) < 2:
+                return 0.0
+            return (len(self._recent) - 1) / max(self._recent[-1] - self._recent[0], 1e-9)
+
+    def stats(self):
+        fps = self.fps()
+        with self._cond:
+            return {
+                'captured': self.captured,
+                'served': self.served,
+                'waits': self.waits,
+                'errors': self.errors,
+                'fps': fps,
+                'capture_latency': self.capture_time / max(self.captured, 1),
+                'served_age': self.served_age / max(self.served, 1),
+                'wait_time': self.wait_time / max(self.waits, 1),
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        if s['captured'] == 0:
+            return
+        logger.info(f"流式截图: 截取{s['captured']}帧({s['fps']:.1f}fps, 平均每帧{s['capture_latency']*1000:.0f}ms), "
+                    f"使用{s['served']}帧(平均帧龄{s['served_age']*1000:.0f}ms), "
+                    f"等待新帧{s['waits']}次(平均{s['wait_time']*1000:.0f}ms), 出错{s['errors']}次.")
+
+############################################
+# 截图缓存. 上一次截图之后没有发出任何输入, 并且那一帧还不超过ttl秒时, 直接返回那一帧, 不再截图.
+# 帧龄从截取时(FrameTime)算起, 包括截图和解码的耗时以及流式截图中这一帧已经等待的时间.
+# 连续的CheckIf(例如IdentifyState一轮中的多次截图)之间画面通常没有变化, 这样可以省掉大部分截图.
+# 输入发出时和执行完时都要invalidate(): 发出时避免流水线(wait=False)的命令之后拿到旧画面,
+# 执行完时丢掉命令执行期间截到的画面. 截图开始前取begin()的编号, 期间发生过输入的画面不会被put()缓存.
+# ttl为0时不缓存.
+DEFAULT_SCREENSHOT_TTL = 0.2
+
+class ScreenCache:
+    def __init__(self, ttl = DEFAULT_SCREENSHOT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._image = None
+        self._age = 0.0
+        self._stored = 0.0
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def begin(self):
+        """截图开始前调用, 返回值交给put()."""
+        with self._lock:
+            return self._generation
+
+    def put(self, image, age, generation):
+        """age为画面此时的帧龄. 画面带有截取时间时以截取时间为准."""
+        taken = FrameTime(image)
+        if taken is not None:
+            age = max(age, time.time() - taken)
+        with self._lock:
+            if self.ttl <= 0 or generation != self._generation or age > self.ttl:
+                return
+            self._image = image
+            self._age = age
+            self._stored = time.monotonic()
+
+    def get(self):
+        """返回(画面, 帧龄)或None."""
+        with self._lock:
+            if self._image is not None:
+                age = self._age + time.monotonic() - self._stored
+                if age <= self.ttl:
+                    self.hits += 1
+                    return self._image, age
+                self._image = None
+            self.misses += 1
+            return None
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            if self._image is not None:
+                self.invalidations += 1
+            self._image = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        if not s['hits'] and not s['misses']:
+            return
+        logger.info(f"截图缓存(ttl {s['ttl']*1000:.0f}ms): 省去{s['hits']}次截图({s['hit_rate']:.0%}), "
+                    f"实际截图{s['misses']}次, 因输入作废{s['invalidations']}次.")
+
+############################################
+# 等待画面. WaitUntil(script.py)代替固定的Sleep: 按poll间隔截图检查条件, 满足时立即返回, 最多等待timeout秒.
+# timeout就是原来Sleep的时间, 所以最坏情况与原来相同; 提前结束时省下的时间记在WaitStats中, 每圈输出一次.
+# ScreenStable: 连续两帧的灰度平均差小于threshold, 例如拖动地图之后画面停止滚动.
+class ScreenStable:
+    def __init__(self, threshold = 0.01):
+        self.threshold = threshold
+        self._last = None
+
+    def __call__(self, screen):
+        gray = FrameGray(screen)
+        last = self._last
+        if gray is last:
+            # 截图缓存返回了同一帧, 不能说明画面已经静止.
+            return False
+        self._last = gray
+        if last is None or last.shape != gray.shape:
+            return False
+        return cv2.absdiff(gray, last).mean()/255 < self.threshold
+
+class WaitStats:
+    def __init__(self):
+        self._waits = {} # 名称 -> [次数, 提前结束次数, 等待总时间, 节省总时间]
+        self.lap_saved = 0.0
+        self.total_saved = 0.0
+
+    def record(self, name, waited, timeout, met):
+        stat = self._waits.setdefault(name, [0, 0, 0.0, 0.0])
+        saved = max(timeout - waited, 0.0) if met else 0.0
+        stat[0] += 1
+        stat[1] += 1 if met else 0
+        stat[2] += waited
+        stat[3] += saved
+        self.lap_saved += saved
+        self.total_saved += saved
+        return saved
+
+    def lap(self):
+        """返回上次lap()之后省下的秒数."""
+        saved, self.lap_saved = self.lap_saved, 0.0
+        return saved
+
+    def stats(self):
+        return {name: {'count': n, 'met': met, 'mean': waited / n, 'saved': saved}
+                for name, (n, met, waited, saved) in self._waits.items()}
+
+    def log_stats(self):
+        s = self.stats()
+        if not s:
+            return
+        waits = ", ".join(f"{name}:{v['met']}/{v['count']}次提前/平均等待{v['mean']:.1f}秒/节省{v['saved']:.0f}秒"
+                          for name, v in sorted(s.items(), key=lambda item: -item[1]['saved']))
+        logger.info(f"等待画面: 共节省{self.total_saved:.0f}秒. {waits}.")
+
+class FileFrameSource:
+    """从本地的视频文件(例如用screenrecord录下的mp4)或截图目录读取画面, 代替模拟器测试流式截图. 读完后从头循环.
+    fps不为None时按该帧率供给画面, 模拟真实的截图耗时."""
+    def __init__(self, path, fps = None):
+        self.path = path
+        self._interval = 1.0 / fps if fps else 0.0
+        self._next = 0.0
+        self._video = None
+        self._files = None
+        self._index = 0
+        if os.path.isdir(path):
+            self._files = sorted(glob.glob(os.path.join(path, '*.png')))
+            if not self._files:
+                raise RuntimeError(f"{path}中没有png截图")
+        else:
+            self._video = cv2.VideoCapture(path)
+            if not self._video.isOpened():
+                raise RuntimeError(f"无法打开视频: {path}")
+
+    def _pace(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self._interval
+
+    def __call__(self):
+        self._pace()
+        if self._video is not None:
+            ok, frame = self._video.read()
+            if not ok:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self._video.read()
+                if not ok:
+                    raise RuntimeError(f"无法从{self.path}读取画面")
+            return frame
+        frame = LoadImage(self._files[self._index % len(self._files)])
+        self._index += 1
+        if frame is None:
+            raise RuntimeError(f"无法读取截图: {self._files[(self._index-1) % len(self._files)]}")
+        return frame
+
+    def close(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
@@ -0,0 +1,373 @@
+import threading
+import itertools
+import time
+from collections import deque
+from utils import *
+
+############################################
+# SHELL SESSION. 每台设备保持一个长连接的shell(shell:sh), 所有命令都写进同一个连接.
+# 命令按顺序执行, 每条命令后面跟一行哨兵, 读线程读到哨兵时就知道该命令的输出结束了.
+# 不需要结果的命令写入后直接返回(流水线), 连接断开后下一条命令会自动重新连接.
+SHELL_SENTINEL = '__WVD_END_'
+
+def CommandKind(cmdStr):
+    """统计耗时用的命令类别, 例如'input tap', 'input swipe', 'date', 'am'."""
+    words = cmdStr.replace('{', ' ').split()
+    if not words:
+        return ''
+    if words[0] == 'input' and len(words) > 1:
+        return f"input {words[1]}"
+    return words[0]
+
+class ShellCommand:
+    def __init__(self, seq, cmdStr):
+        self.seq = seq
+        self.cmd = cmdStr
+        self.kind = CommandKind(cmdStr)
+        self.sent = None
+        self.finished = None
+        self.output = None
+        self.error = None
+        self._done = threading.Event()
+
+    def _finish(self, output = None, error = None):
+        self.output = output
+        self.error = error
+        self.finished = time.perf_counter()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout = None):
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"命令在{timeout}秒内未完成: {self.cmd}")
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+class ShellSession:
+    def __init__(self, get_device, on_done = None):
+        self.get_device = get_device # 无参数, 返回当前ppadb设备的函数. 重连时重新获取.
+        self.on_done = on_done       # 每条命令执行完成后调用, 参数为ShellCommand
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._conn = None
+        self._reader = None
+        self._pending = deque()
+        self._stats_lock = threading.Lock()
+        self._latency = {} # kind -> [次数, 总耗时, 最大耗时]
+        self.connects = 0
+        self.disconnects = 0
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    def _connect(self):
+        device = self.get_device()
+        if device is None:
+            raise RuntimeError("没有可用的adb设备")
+        conn = device.create_connection(timeout=5)
+        conn.send("shell:sh")
+        conn.socket.settimeout(None) # 长连接, 空闲时读线程一直阻塞
+        self._conn = conn
+        self._reader = threading.Thread(target=self._read, args=(conn,), name='ShellSessionReader', daemon=True)
+        self._reader.start()
+        self.connects += 1
+        logger.debug(f"shell长连接已建立(第{self.connects}次).")
+
+    def _drop(self, conn, error):
+        """连接失效: 关闭连接, 让所有未完成的命令失败. 只处理仍是当前连接的情况."""
+        with self._lock:
+            if self._conn is not conn:
+                return
+            self._conn = None
+            pending = list(self._pending)
+            self._pending.clear()
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.disconnects += 1
+        for command in pending:
+            command._finish(error = error)
+
+    def _read(self, conn):
+        buffer = b''
+        lines = []
+        try:
+            while True:
+                data = conn.socket.recv(65536)
+                if not data:
+                    raise ConnectionResetError("shell长连接已被关闭")
+                buffer += data
+                while (index := buffer.find(b'\n')) >= 0:
+                    line, buffer = buffer[:index+1], buffer[index+1:]
+                    text = line.decode('utf-8', errors='replace')
+                    if text.startswith(SHELL_SENTINEL):
+                        self._complete(int(text[len(SHELL_SENTINEL):].strip()), ''.join(lines))
+                        lines = []
+                    else:
+                        lines.append(text)
+        except Exception as e:
+            self._drop(conn, e if isinstance(e, OSError) else ConnectionResetError(str(e)))
+
+    def _complete(self, seq, output):
+        with self._lock:
+            command = self._pending.popleft() if self._pending else None
+        if command is None or command.seq != seq:
+            logger.warning(f"shell长连接的输出顺序错乱(期望{command.seq if command else None}, 收到{seq}).")
+            if command is not None:
+                command._finish(error = ConnectionResetError("shell长连接的输出顺序错乱"))
+            return
+        # 哨兵前面的换行是为了防止没有换行结尾的输出和哨兵连在一起, 这里去掉.
+        command._finish(output = output[:-1] if output.endswith('\n') else output)
+        with self._stats_lock:
+            stat = self._latency.setdefault(command.kind, [0, 0.0, 0.0])
+            cost = command.finished - command.sent
+            stat[0] += 1
+            stat[1] += cost
+            stat[2] = max(stat[2], cost)
+        if self.on_done is not None:
+            self.on_done(command)
+
+    def run(self, cmdStr):
+        """写入一条命令, 立刻返回ShellCommand. 需要结果时调用其result(timeout)."""
+        command = ShellCommand(next(self._seq), cmdStr)
+        # 命令放在{}中执行: 不会读走后面的命令(stdin), 错误输出也按顺序出现在结果中.
+        payload = f"{{ {cmdStr}\n}} </dev/null 2>&1\nprintf '\\n{SHELL_SENTINEL}%d\\n' {command.seq}\n".encode('utf-8')
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            conn = self._conn
+            self._pending.append(command)
+            command.sent = time.perf_counter()
+            try:
+                conn.socket.sendall(payload)
+            except OSError as e:
+                self._pending.remove(command)
+                error = e
+            else:
+                error = None
+        if error is not None:
+            self._drop(conn, error)
+            raise error
+        return command
+
+    def close(self):
+        with self._lock:
+            conn = self._conn
+        if conn is not None:
+            self._drop(conn, ConnectionResetError("shell长连接已关闭"))
+
+    def stats(self):
+        with self._stats_lock:
+            return {kind: {'count': n, 'mean': total / n, 'max': worst} for kind, (n, total, worst) in self._latency.items()}
+
+    def log_stats(self):
+        stats = self.stats()
+        if not stats:
+            return
+        summary = ", ".join(f"{kind}:{s['count']}次/平均{s['mean']*1000:.0f}ms/最大{s['max']*1000:.0f}ms"
+                            for kind, s in sorted(stats.items(), key=lambda item: -item[1]['count']))
+        logger.info(f"shell命令耗时: {summary}. 连接{self.connects}次, 断开{self.disconnects}次.")
+
+############################################
+# TOUCH SCREEN. input tap每次都要在设备上启动一个java进程(app_process), 通常需要200~400ms.
+# 直接用sendevent向触摸屏的/dev/input/eventN写入多点触控(type B)事件, 点击只需要几毫秒.
+# 触摸屏通过getevent -p查找: 同时支持ABS_MT_POSITION_X和ABS_MT_POSITION_Y的设备.
+EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+SYN_REPORT = 0
+BTN_TOUCH = 0x14a
+ABS_MT_SLOT = 0x2f
+ABS_MT_TOUCH_MAJOR = 0x30
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+ABS_MT_PRESSURE = 0x3a
+SCREEN_SIZE = (900, 1600) # 截图的(宽, 高), 点击坐标都在这个坐标系下
+TOUCH_MODES = ['input', 'sendevent']
+DEFAULT_TOUCH_MODE = 'input'
+
+class TouchScreen:
+    def __init__(self, path, abs_ranges, keys):
+        self.path = path
+        self.abs_ranges = abs_ranges # code -> (min, max)
+        self.keys = keys             # 支持的EV_KEY code
+        self._tracking_id = 0
+
+    def _scale(self, pos):
+        (x_min, x_max), (y_min, y_max) = self.abs_ranges[ABS_MT_POSITION_X], self.abs_ranges[ABS_MT_POSITION_Y]
+        x = x_min + round(pos[0] * (x_max - x_min) / (SCREEN_SIZE[0] - 1))
+        y = y_min + round(pos[1] * (y_max - y_min) / (SCREEN_SIZE[1] - 1))
+        return min(max(x, x_min), x_max), min(max(y, y_min), y_max)
+
+    def _event(self, type, code, value):
+        return f"sendevent {self.path} {type} {code} {value}"
+
+    def _down(self, pos):
+        self._tracking_id = (self._tracking_id + 1) % 0xffff
+        x, y = self._scale(pos)
+        events = []
+        if ABS_MT_SLOT in self.abs_ranges:
+            events.append(self._event(EV_ABS, ABS_MT_SLOT, 0))
+        events.append(self._event(EV_ABS, ABS_MT_TRACKING_ID, self._tracking_id))
+        if ABS_MT_TOUCH_MAJOR in self.abs_ranges:
+            events.append(self._event(EV_ABS, ABS_MT_TOUCH_MAJOR, max(1, self.abs_ranges[ABS_MT_TOUCH_MAJOR][1] // 8)))
+        if ABS_MT_PRESSURE in self.abs_ranges:
+            events.append(self._event(EV_ABS, ABS_MT_PRESSURE, max(1, self.abs_ranges[ABS_MT_PRESSURE][1] // 2)))
+        events += self._move(pos)[:-1]
+        if BTN_TOUCH in self.keys:
+            events.append(self._event(EV_KEY, BTN_TOUCH, 1))
+        events.append(self._event(EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def _move(self, pos):
+        x, y = self._scale(pos)
+        return [self._event(EV_ABS, ABS_MT_POSITION_X, x), self._event(EV_ABS, ABS_MT_POSITION_Y, y), self._event(EV_SYN, SYN_REPORT, 0)]
+
+    def _up(self):
+        events = []
+        if ABS_MT_SLOT in self.abs_ranges:
+            events.append(self._event(EV_ABS, ABS_MT_SLOT, 0))
+        events.append(self._event(EV_ABS, ABS_MT_TRACKING_ID, -1))
+        if BTN_TOUCH in self.keys:
+            events.append(self._event(EV_KEY, BTN_TOUCH, 0))
+        events.append(self._event(EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def tap(self, pos, hold = 0.05):
+        """一次点击的shell脚本. 按下后保持hold秒再抬起, 太短的点击会被部分游戏忽略."""
+        return "\n".join(self._down(pos) + [f"sleep {_Seconds(hold)}"] + self._up())
+
+    def swipe(self, start, end, duration = 300):
+        steps = max(2, int(duration) // 20)
+        lines = self._down(start)
+        for i in range(1, steps + 1):
+            lines.append(f"sleep {_Seconds(duration / 1000 / steps)}")
+            lines += self._move([start[0] + (end[0] - start[0]) * i / steps, start[1] + (end[1] - start[1]) * i / steps])
+        return "\n".join(lines + self._up())
+
+def ParseSwipe(cmdStr):
+    """'input swipe x1 y1 x2 y2 [duration]' -> (start, end, duration或None). 不是滑动命令时返回None."""
+    words = cmdStr.split()
+    if words[:2] != ['input', 'swipe'] or len(words) not in (6, 7):
+        return None
+    try:
+        values = [int(float(w)) for w in words[2:]]
+    except ValueError:
+        return None
+    return values[0:2], values[2:4], values[4] if len(values) == 5 else None
+
+def ParseGetevent(output):
+    """解析getevent -p的输出, 返回触摸屏的TouchScreen; 找不到时返回None.
+    格式:
+    add device 1: /dev/input/event2
+      name:     "..."
+      events:
+        KEY (0001): 014a
+        ABS (0003): 0035  : value 0, min 0, max 899, fuzz 0, flat 0, resolution 0
+                    0036  : value 0, min 0, max 1599, fuzz 0, flat 0, resolution 0"""
+    devices = []
+    section = None
+    for line in output.splitlines():
+        if line.startswith('add device'):
+            devices.append({'path': line.split(':', 1)[1].strip(), 'abs': {}, 'keys': set()})
+            section = None
+            continue
+        if not devices:
+            continue
+        text = line.strip()
+        if text.startswith('KEY ('):
+            section = 'KEY'
+            text = text.split(':', 1)[1]
+        elif text.startswith('ABS ('):
+            section = 'ABS'
+            text = text.split(':', 1)[1]
+        elif text.startswith(('name:', 'events:', 'input props:')) or (text[:3].isupper() and ' (' in text[:8]):
+            section = None
+            continue
+        if section == 'KEY':
+            for word in text.split():
+                try:
+                    devices[-1]['keys'].add(int(word, 16))
+                except ValueError:
+                    pass
+        elif section == 'ABS' and ':' in text:
+            code, info = text.split(':', 1)
+            fields = dict(item.strip().split(' ', 1) for item in info.split(',') if ' ' in item.strip())
+            try:
+                devices[-1]['abs'][int(code.strip(), 16)] = (int(fields['min']), int(fields['max']))
+            except (KeyError, ValueError):
+                pass
+    for device in devices:
+        if ABS_MT_POSITION_X in device['abs'] and ABS_MT_POSITION_Y in device['abs']:
+            return TouchScreen(device['path'], device['abs'], device['keys'])
+    return None
+
+############################################
+# INPUT SEQUENCE. 把一串点击, 按键, 滑动和等待编译成一段shell脚本, 通过一次DeviceShell在设备上执行.
+# 等待用设备上的sleep完成, 不受adb往返时间的影响.
+# pace: 相邻两次输入开始之间的最短间隔. 输入在后台执行的同时sleep, 再wait两者都结束,
+#       即间隔为max(输入耗时, pace), 与以前"点击后补足剩余时间"的写法相同, 且输入之间不会重叠.
+# compile时提供TouchScreen则点击和滑动使用sendevent, 按键仍然使用input keyevent.
+def _Seconds(seconds):
+    return format(round(seconds, 3), 'g')
+
+class InputSequence:
+    def __init__(self, pace = None):
+        self.pace = pace
+        self._steps = [] # ('tap', pos) / ('key', keycode) / ('swipe', start, end, duration) / ('wait', seconds)
+        self._inputs = 0
+        self._waits = 0.0
+
+    def _input(self, step):
+        self._steps.append(step)
+        self._inputs += 1
+        return self
+
+    def tap(self, pos):
+        return self._input(('tap', [int(pos[0]), int(pos[1])]))
+
+    def key(self, keycode):
+        return self._input(('key', keycode))
+
+    def swipe(self, start, end, duration = None):
+        return self._input(('swipe', [int(start[0]), int(start[1])], [int(end[0]), int(end[1])], duration))
+
+    def wait(self, seconds):
+        if seconds > 0:
+            self._steps.append(('wait', seconds))
+            self._waits += seconds
+        return self
+
+    def duration(self):
+        """不计输入本身耗时的最短执行时间."""
+        return self._waits + (self.pace or 0) * self._inputs
+
+    def _render(self, step, touch):
+        match step:
+            case ('tap', pos):
+                return touch.tap(pos) if touch else f"input tap {pos[0]} {pos[1]}"
+            case ('key', keycode):
+                return f"input keyevent {keycode}"
+            case ('swipe', start, end, duration):
+                if touch:
+                    return touch.swipe(start, end, 300 if duration is None else duration)
+                args = f"input swipe {start[0]} {start[1]} {end[0]} {end[1]}"
+                return args if duration is None else f"{args} {int(duration)}"
+
+    def compile(self, touch = None):
+        lines = []
+        for step in self._steps:
+            if step[0] == 'wait':
+                lines.append(f"sleep {_Seconds(step[1])}")
+            elif self.pace:
+                lines.append(f"{{ {self._render(step, touch)}\n}} & sleep {_Seconds(self.pace)}; wait")
+            else:
+                lines.append(self._render(step, touch))
+        return "\n".join(lines)
+
+    def __len__(self):
+        return self._inputs
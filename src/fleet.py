@@ -0,0 +1,213 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+from script import *
+from utils import *
+
+############################################
+# FLEET. 一个无界面的启动器, 为每个模拟器端口启动一个独立的worker进程运行Farm.
+# fleet.json:
+#   {
+#     "config": "config.json",              # 所有实例共用的基础设置(可选, 默认config.json)
+#     "report_interval": 300,               # 汇总报告的间隔(秒, 可选)
+#     "instances": [
+#       {"name": "mumu-0", "port": 16384},
+#       {"name": "mumu-1", "port": 16416, "config": {"_FARMTARGET": "..."}}   # config: 覆盖基础设置中的项
+#     ]
+#   }
+# 模板在启动器中解码一次, 放入共享内存(ShareTemplatePack), worker直接读取, 不再各自解码.
+# 每个worker的热点(hotspots_<name>.json)和等待校准(calibration_<name>.json)也写在自己的文件中.
+# adb server和模拟器进程是所有实例共用的, fleet模式下adb恢复不会升级到重启adb server或重启模拟器.
+# 每个worker的完整日志写在自己的文件中; INFO以上的日志转发给启动器, 带上实例名后统一输出到控制台和一个汇总文件.
+# worker定期汇报统计信息(RuntimeContext), 启动器按间隔输出所有实例的吞吐量报告.
+FLEET_REPORT_INTERVAL = 300
+
+class _InstanceFilter(logging.Filter):
+    def __init__(self, name):
+        super().__init__()
+        self.instance = name
+
+    def filter(self, record):
+        record.instance = self.instance
+        return True
+
+def _SetupWorkerLogging(name, logQueue):
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    os.makedirs(LOGS_FOLDER_NAME, exist_ok=True)
+    file_handler = logging.FileHandler(f"{LOG_FILE_PREFIX}_{name}_{time.strftime('%y%m%d-%H%M%S')}.txt", mode='a', encoding='utf-8')
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(levelname)s - [%(module)s:%(funcName)s:%(lineno)d] - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    logger.addHandler(file_handler)
+    queue_handler = logging.handlers.QueueHandler(logQueue)
+    queue_handler.setLevel(logging.INFO)
+    queue_handler.addFilter(_InstanceFilter(name))
+    logger.addHandler(queue_handler)
+
+def InstanceFile(path, name):
+    """hotspots.json -> hotspots_<name>.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}_{name}{ext}"
+
+def _RuntimeStats(setting, started):
+    context = setting._RUNTIMECONTEXT
+    stats = {'uptime': time.time() - started, 'runs': 0, 'chests': 0, 'combats': 0, 'farm_time': 0.0}
+    if context is not None:
+        stats.update(runs = context._COUNTERDUNG, chests = context._COUNTERCHEST, combats = context._COUNTERCOMBAT,
+                     farm_time = context._TOTALTIME)
+    return stats
+
+def FleetWorker(instance, baseConfig, templateShm, logQueue, statsQueue, stopEvent, reportInterval):
+    name = instance['name']
+    _SetupWorkerLogging(name, logQueue)
+    TEMPLATE_PACK.attach_shared(templateShm)
+    # 每个实例读写自己的热点和等待校准文件(第一次运行时以共用的文件为起点), 避免互相覆盖.
+    HOTSPOTS.use_file(InstanceFile(HOTSPOT_FILE, name))
+    SLEEP_PROFILE.use_file(InstanceFile(CALIBRATION_FILE, name))
+
+    setting = FarmConfig()
+    config = dict(baseConfig)
+    config.update(instance.get('config', {}))
+    for _, _, var_config_name, var_default_value in CONFIG_VAR_LIST:
+        setattr(setting, var_config_name, config.get(var_config_name, var_default_value))
+    setting._ADBPORT = instance['port']
+    setting._FLEETINSTANCE = name
+    setting._FORCESTOPING = stopEvent
+    setting._MSGQUEUE = queue.Queue()
+    setting._FINISHINGCALLBACK = lambda: logger.info("Stopped.")
+
+    started = time.time()
+    def Report():
+        while not stopEvent.wait(reportInterval):
+            statsQueue.put((name, _RuntimeStats(setting, started)))
+    threading.Thread(target=Report, daemon=True).start()
+
+    logger.info(f"实例{name}启动, 端口{setting._ADBPORT}, 任务\"{setting._FARMTARGET_TEXT}\".")
+    try:
+        while True:
+            try:
+                Factory()(setting)
+            except SystemExit:
+                pass # TimeLeap放入turn_to_7000G后用SystemExit结束任务. GUI中任务线程就此结束, 这里要留在循环中.
+            # 与AppController相同: 复活次数用完时转为刷7000G.
+            try:
+                command, _ = setting._MSGQUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if command != 'turn_to_7000G' or stopEvent.is_set():
+                break
+            logger.info('Starting money run...')
+            setting._FARMTARGET = "7000G"
+            setting._COUNTERDUNG = 0
+    except Exception as e:
+        logger.exception(f"实例{name}异常退出: {e}")
+    finally:
+        statsQueue.put((name, _RuntimeStats(setting, started)))
+        # 释放所有指向共享内存的数组, 否则退出时无法关闭共享内存.
+        ReleaseViews()
+        TEMPLATE_STORE.invalidate()
+        TEMPLATE_PACK.close()
+
+def FleetReport(stats):
+    """所有实例的吞吐量. stats: {实例名: _RuntimeStats()}."""
+    lines = []
+    totals = {'runs': 0, 'chests': 0, 'combats': 0}
+    def line(name, s, hours):
+        return (f"{name}: {s['runs']}次/{s['chests']}箱/{s['combats']}战, "
+                f"{s['runs']/hours:.1f}次/小时, {s['chests']/hours:.1f}箱/小时")
+    for name, s in sorted(stats.items()):
+        hours = max(s['uptime'], 1) / 3600
+        lines.append(line(name, s, hours))
+        for key in totals:
+            totals[key] += s[key]
+    # 实例同时运行, 合计按最长的运行时间折算.
+    hours = max([s['uptime'] for s in stats.values()] + [1]) / 3600
+    lines.append(line(f"合计({len(stats)}个实例)", totals, hours))
+    return "\n".join(lines)
+
+def RunFleet(fleet_path):
+    # 启动器自己的日志也经过logQueue, 与各实例的日志一起输出.
+    logQueue = multiprocessing.Queue(-1)
+    statsQueue = multiprocessing.Queue(-1)
+    fleetFormatter = logging.Formatter('%(asctime)s - [%(instance)s] %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(fleetFormatter)
+    fleet_file_handler = logging.FileHandler(f"{LOG_FILE_PREFIX}_fleet_{time.strftime('%y%m%d-%H%M%S')}.txt", mode='a', encoding='utf-8')
+    fleet_file_handler.setFormatter(fleetFormatter)
+    listener = logging.handlers.QueueListener(logQueue, console_handler, fleet_file_handler)
+    listener.start()
+    logger.setLevel(logging.DEBUG)
+    queue_handler = logging.handlers.QueueHandler(logQueue)
+    queue_handler.setLevel(logging.INFO)
+    queue_handler.addFilter(_InstanceFilter('fleet'))
+    logger.addHandler(queue_handler)
+
+    fleet = LoadJson(fleet_path)
+    instances = fleet.get('instances', [])
+    if not instances:
+        logger.error(f"{fleet_path}中没有instances.")
+        listener.stop()
+        return
+    for index, instance in enumerate(instances):
+        instance.setdefault('name', f"{index}-{instance['port']}")
+    baseConfig = LoadConfigFromFile(fleet.get('config'))
+    reportInterval = fleet.get('report_interval', FLEET_REPORT_INTERVAL)
+
+    templateShm = ShareTemplatePack()
+    workers = []
+    stopEvents = [] # 每个实例一个: Farm自己也会set停止事件(例如复活次数用完), 不能影响其他实例.
+    try:
+        for instance in instances:
+            stopEvent = multiprocessing.Event()
+            worker = multiprocessing.Process(target=FleetWorker, name=f"wvd-{instance['name']}",
+                                             args=(instance, baseConfig, templateShm.name, logQueue, statsQueue, stopEvent, reportInterval))
+            worker.start()
+            workers.append(worker)
+            stopEvents.append(stopEvent)
+        logger.info(f"fleet: 已启动{len(workers)}个实例.")
+
+        stats = {}
+        lastReport = time.time()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    name, s = statsQueue.get(timeout=1)
+                    stats[name] = s
+                except queue.Empty:
+                    pass
+                if stats and time.time() - lastReport >= reportInterval:
+                    lastReport = time.time()
+                    logger.info(f"fleet吞吐量:\n{FleetReport(stats)}", extra={"summary": True})
+        except KeyboardInterrupt:
+            logger.info("fleet: 正在停止所有实例...")
+            for stopEvent in stopEvents:
+                stopEvent.set()
+            for worker in workers:
+                worker.join()
+
+        while True:
+            try:
+                name, s = statsQueue.get_nowait()
+                stats[name] = s
+            except queue.Empty:
+                break
+        if stats:
+            report = FleetReport(stats)
+            logger.info(f"fleet最终吞吐量:\n{report}", extra={"summary": True})
+            with open(f"{LOG_FILE_PREFIX}_fleet_report_{time.strftime('%y%m%d-%H%M%S')}.json", 'w', encoding='utf-8') as f:
+                json.dump({'instances': stats, 'report': report}, f, ensure_ascii=False, indent=4)
+    finally:
+        for stopEvent in stopEvents:
+            stopEvent.set()
+        for worker in workers:
+            worker.join(5)
+        listener.stop()
+        templateShm.close()
+        templateShm.unlink()
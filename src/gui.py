@@ -495,6 +495,93 @@ class ConfigPanelApp(tk.Toplevel):
         )
         self.active_csc.grid(row=0, column=0)
 
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        ttk.Label(frame_row, text="Screenshot mode:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.capture_mode_combobox = ttk.Combobox(
+            frame_row,
+            textvariable=self.capture_mode_var,
+            values=CAPTURE_MODES,
+            state="readonly",
+            width=6
+        )
+        self.capture_mode_combobox.grid(row=0, column=1, sticky=tk.W, pady=5)
+        self.capture_mode_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        ttk.Label(frame_row, text="(raw is faster; use png if screenshots fail)").grid(row=0, column=2, sticky=tk.W, pady=5)
+
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        ttk.Label(frame_row, text="Touch mode:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.touch_mode_combobox = ttk.Combobox(
+            frame_row,
+            textvariable=self.touch_mode_var,
+            values=TOUCH_MODES,
+            state="readonly",
+            width=9
+        )
+        self.touch_mode_combobox.grid(row=0, column=1, sticky=tk.W, pady=5)
+        self.touch_mode_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        ttk.Label(frame_row, text="(sendevent taps faster; needs a writable touchscreen)").grid(row=0, column=2, sticky=tk.W, pady=5)
+
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        ttk.Label(frame_row, text="ADB transport:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.adb_transport_combobox = ttk.Combobox(
+            frame_row,
+            textvariable=self.adb_transport_var,
+            values=ADB_TRANSPORTS,
+            state="readonly",
+            width=6
+        )
+        self.adb_transport_combobox.grid(row=0, column=1, sticky=tk.W, pady=5)
+        self.adb_transport_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        ttk.Label(frame_row, text="(direct talks to the emulator without adb server)").grid(row=0, column=2, sticky=tk.W, pady=5)
+
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        ttk.Label(frame_row, text="Vision workers:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.vision_workers_combobox = ttk.Combobox(
+            frame_row,
+            textvariable=self.vision_workers_var,
+            values=[0, 2, 3, 4],
+            state="readonly",
+            width=6
+        )
+        self.vision_workers_combobox.grid(row=0, column=1, sticky=tk.W, pady=5)
+        self.vision_workers_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        ttk.Label(frame_row, text="(match templates in separate processes; 0 = off)").grid(row=0, column=2, sticky=tk.W, pady=5)
+
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        ttk.Label(frame_row, text="Screenshot TTL:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.screenshot_ttl_combobox = ttk.Combobox(
+            frame_row,
+            textvariable=self.screenshot_ttl_var,
+            values=[0, 0.1, 0.2, 0.3, 0.5],
+            state="readonly",
+            width=6
+        )
+        self.screenshot_ttl_combobox.grid(row=0, column=1, sticky=tk.W, pady=5)
+        self.screenshot_ttl_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        ttk.Label(frame_row, text="(seconds to reuse the last screenshot while no input is sent; 0 = off)").grid(row=0, column=2, sticky=tk.W, pady=5)
+
+        row_counter += 1
+        frame_row = ttk.Frame(self.main_frame)
+        frame_row.grid(row=row_counter, column=0, sticky="ew", pady=5)
+        self.calibrate_check = ttk.Checkbutton(
+            frame_row,
+            text="Calibration run (measure waits on this machine)",
+            variable=self.calibrate_var,
+            command=self.save_config,
+            style="Custom.TCheckbutton"
+        )
+        self.calibrate_check.grid(row=0, column=0, sticky=tk.W, pady=5)
+
         # Separator
         row_counter += 1
         self.update_sep = ttk.Separator(self.main_frame, orient='horizontal')
@@ -614,6 +701,7 @@ class ConfigPanelApp(tk.Toplevel):
     def set_controls_state(self, state):
         self.button_and_entry = [
             self.adb_path_change_button,
+            self.calibrate_check,
             self.random_chest_check,
             self.who_will_open_combobox,
             self.system_auto_check,
@@ -634,10 +722,20 @@ class ConfigPanelApp(tk.Toplevel):
 
         if state == tk.DISABLED:
             self.farm_target_combo.configure(state="disabled")
+            self.capture_mode_combobox.configure(state="disabled")
+            self.touch_mode_combobox.configure(state="disabled")
+            self.adb_transport_combobox.configure(state="disabled")
+            self.vision_workers_combobox.configure(state="disabled")
+            self.screenshot_ttl_combobox.configure(state="disabled")
             for widget in self.button_and_entry:
                 widget.configure(state="disabled")
         else:
             self.farm_target_combo.configure(state="readonly")
+            self.capture_mode_combobox.configure(state="readonly")
+            self.touch_mode_combobox.configure(state="readonly")
+            self.adb_transport_combobox.configure(state="readonly")
+            self.vision_workers_combobox.configure(state="readonly")
+            self.screenshot_ttl_combobox.configure(state="readonly")
             for widget in self.button_and_entry:
                 widget.configure(state="normal")
             self.update_active_rest_state()
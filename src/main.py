@@ -1,4 +1,5 @@
 from gui import *
+from fleet import *
 import argparse
 
 __version__ = '1.9.2' 
@@ -168,12 +169,36 @@ def parse_args():
         default=None,
         help='Path to config file (e.g., c:/config.json)'
     )
+
+    parser.add_argument(
+        '-fleet',
+        '--fleet',
+        type=str,
+        default=None,
+        help='Path to fleet file; runs one headless farm per emulator port (e.g., c:/fleet.json)'
+    )
+
+    parser.add_argument(
+        '-calibration-report',
+        '--calibration-report',
+        action='store_true',
+        help='Print the calibrated waits learned on this machine next to the defaults, then exit'
+    )
     
     return parser.parse_args()
 
 def main():
     args = parse_args()
 
+    if args.fleet:
+        RunFleet(args.fleet)
+        return
+
+    if args.calibration_report:
+        RegisterConsoleHandler()
+        SLEEP_PROFILE.log_report()
+        return
+
     controller = AppController(args.headless, args.config)
     controller.mainloop()
 
@@ -192,4 +217,5 @@ def HeadlessActive(config_path, msg_queue):
     logger.info(f"WvDAS Wizardry Daphne Auto-Farm v{__version__} @Dellyla(Bilibili)")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # fleet的worker进程在打包后的exe中同样从这里启动
     main()
@@ -0,0 +1,131 @@
+import time
+from utils import *
+
+############################################
+# 分级恢复. adb出错时先用代价最小的手段, 无效时才升级到下一级, 例如:
+#   重试 -> 重新打开设备句柄 -> 重新连接 -> 重启adb server -> 重启模拟器.
+# 每一级执行完之后用probe()检查是否恢复; 级与级之间按指数退避等待.
+# 熔断: 某一级"修好"之后没多久(relapse_window秒内)又出错, 说明它治标不治本.
+#   连续trip_after次这样之后熔断这一级, 之后的恢复直接从更高一级开始, 直到healthy_reset秒内没有再出错.
+# 每一级记录尝试次数, 生效次数和耗时, 结束时由log_stats()输出.
+class RecoveryRung:
+    def __init__(self, name, action):
+        self.name = name
+        self.action = action
+        self.attempts = 0
+        self.fixes = 0
+        self.relapses = 0 # 修好之后很快又出错的次数
+        self.strikes = 0 # 连续的relapses, 用于熔断
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class RecoveryLadder:
+    def __init__(self, probe, backoff = 1.0, max_backoff = 30.0, relapse_window = 60, trip_after = 2, healthy_reset = 600):
+        self.probe = probe
+        self.rungs = []
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.relapse_window = relapse_window
+        self.trip_after = trip_after
+        self.healthy_reset = healthy_reset
+        self.floor = 0 # 熔断后的起始级
+        self.recoveries = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.total_time = 0.0
+        self._last_fix = None # (生效的级, 时间)
+        self._last_end = None
+
+    def add(self, name, action):
+        self.rungs.append(RecoveryRung(name, action))
+        return self
+
+    def remove(self, name):
+        self.rungs = [rung for rung in self.rungs if rung.name != name]
+        self.floor = min(self.floor, max(len(self.rungs) - 1, 0))
+        self._last_fix = None
+        return self
+
+    def _update_breaker(self, now):
+        if self._last_end is not None and now - self._last_end > self.healthy_reset:
+            if self.floor:
+                logger.info(f"adb恢复: {self.healthy_reset}秒内没有出错, 解除熔断.")
+            self.floor = 0
+            for rung in self.rungs:
+                rung.strikes = 0
+        if self._last_fix is None:
+            return
+        index, fixedAt = self._last_fix
+        rung = self.rungs[index]
+        if now - fixedAt > self.relapse_window:
+            rung.strikes = 0
+            return
+        rung.relapses += 1
+        rung.strikes += 1
+        if rung.strikes >= self.trip_after and index + 1 < len(self.rungs) and self.floor <= index:
+            self.floor = index + 1
+            rung.strikes = 0
+            logger.info(f"adb恢复: \"{rung.name}\"修好后{now - fixedAt:.0f}秒内又出错{self.trip_after}次, 熔断. 之后从\"{self.rungs[self.floor].name}\"开始.")
+
+    def _check(self):
+        try:
+            return bool(self.probe())
+        except Exception as e:
+            logger.debug(f"adb恢复: 检查失败 ({type(e).__name__}): {e}")
+            return False
+
+    def recover(self, error = None):
+        """依次执行各级恢复, 直到probe()成功. 返回是否恢复."""
+        start = time.monotonic()
+        self._update_breaker(start)
+        if error is not None:
+            logger.info(f"adb恢复: 开始处理 {type(error).__name__}: {error}")
+        if self.consecutive_failures:
+            # 整个梯子都失败过, 再次尝试前先等待.
+            time.sleep(min(self.backoff * 2 ** self.consecutive_failures, self.max_backoff))
+        delay = self.backoff
+        try:
+            for index in range(self.floor, len(self.rungs)):
+                rung = self.rungs[index]
+                rungStart = time.monotonic()
+                try:
+                    rung.action()
+                    fixed = self._check()
+                except Exception as e:
+                    logger.warning(f"adb恢复: \"{rung.name}\"出错 ({type(e).__name__}): {e}")
+                    fixed = False
+                cost = time.monotonic() - rungStart
+                rung.attempts += 1
+                rung.total_time += cost
+                rung.max_time = max(rung.max_time, cost)
+                if fixed:
+                    rung.fixes += 1
+                    self.recoveries += 1
+                    self.consecutive_failures = 0
+                    self._last_fix = (index, time.monotonic())
+                    logger.info(f"adb恢复: 第{index + 1}级\"{rung.name}\"生效. 本级{cost:.1f}秒, 共{time.monotonic() - start:.1f}秒.")
+                    return True
+                if index + 1 < len(self.rungs):
+                    logger.info(f"adb恢复: 第{index + 1}级\"{rung.name}\"无效({cost:.1f}秒), {delay:.0f}秒后尝试\"{self.rungs[index + 1].name}\".")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+            self.failures += 1
+            self.consecutive_failures += 1
+            self._last_fix = None
+            logger.warning(f"adb恢复: 所有级别都无效, 共{time.monotonic() - start:.1f}秒.")
+            return False
+        finally:
+            self._last_end = time.monotonic()
+            self.total_time += self._last_end - start
+
+    def stats(self):
+        return [{'name': rung.name, 'attempts': rung.attempts, 'fixes': rung.fixes, 'relapses': rung.relapses,
+                 'mean': rung.total_time / rung.attempts if rung.attempts else 0.0, 'max': rung.max_time}
+                for rung in self.rungs]
+
+    def log_stats(self):
+        if not self.recoveries and not self.failures:
+            return
+        summary = ", ".join(f"{s['name']}:{s['fixes']}/{s['attempts']}次生效/平均{s['mean']:.1f}秒/最大{s['max']:.1f}秒"
+                            for s in self.stats() if s['attempts'])
+        logger.info(f"adb恢复: 成功{self.recoveries}次, 失败{self.failures}次, 共耗时{self.total_time:.0f}秒. {summary}.")
@@ -0,0 +1,157 @@
+import time
+from utils import *
+from vision import *
+
+############################################
+# 规则表驱动的状态识别. 每条规则: 模板(可以是多个, 取第一个命中的), 区域(RoI), 优先级, 动作, 结果.
+# 规则分成若干阶段(stage), 按加入的顺序检查. 同一阶段的模板在同一帧上一次匹配完(MatchPlan),
+# 然后按优先级依次执行命中的规则, 某条规则给出结果时立即结束(后面的阶段也不再匹配).
+# 规则的结果:
+#   RULE_NEXT: 继续检查后面的规则(例如点掉一个对话框之后再看别的).
+#   RULE_RESTART: 重新截图, 从头开始识别(代替以前的递归调用).
+#   其他值: 识别结果, 由evaluate()返回.
+# 动作的签名为action(pos, screen), 返回None时使用规则声明的结果, 返回False表示这次不算命中, 返回其他值时作为结果.
+# 没有模板的规则每次都会执行, 用于"第n轮之后"的兜底操作(after).
+# 任务相关的规则(例如特殊的对话选项)通过inject()注入到某个阶段, 内容变化时替换.
+# 每条规则记录检查次数, 命中次数和动作耗时; 每个阶段记录匹配次数和耗时. 结束时由log_stats()输出.
+RULE_NEXT = 'next'
+RULE_RESTART = 'restart'
+
+class StateRule:
+    def __init__(self, name, templates = None, action = None, result = RULE_NEXT, priority = 0, roi = None, after = 0):
+        self.name = name
+        if isinstance(templates, str):
+            templates = [templates]
+        self.templates = list(templates or [])
+        self.action = action
+        self.result = result
+        self.priority = priority
+        self.roi = roi
+        self.after = after # 从第几轮开始检查
+        self.group = None # 注入的规则所属的组
+
+        self.checks = 0
+        self.hits = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class RuleStage:
+    def __init__(self, name, first = False):
+        self.name = name
+        self.first = first # 阶段内的规则命中即给出结果, 匹配时按优先级取第一个命中的模板即可
+        self.rules = []
+        self._plans = {}
+
+        self.runs = 0
+        self.match_time = 0.0
+
+    def active(self, round):
+        return [rule for rule in self.rules if rule.after <= round]
+
+    def plan(self, rules):
+        key = tuple((t, rule.name) for rule in rules for t in rule.templates)
+        plan = self._plans.get(key)
+        if plan is None:
+            items = [(t, rule.roi) if rule.roi is not None else t for rule in rules for t in rule.templates]
+            plan = self._plans[key] = MatchPlan(items, priority = self.first)
+        return plan
+
+class RuleEngine:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self._groups = {} # 注入组名 -> key
+
+        self.evaluations = 0
+        self.restarts = 0
+
+    def stage(self, name, first = False):
+        stage = RuleStage(name, first)
+        self.stages.append(stage)
+        return stage
+
+    def _stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(f"{self.name}: 没有阶段{name}")
+
+    def add(self, stageName, *rules):
+        stage = self._stage(stageName)
+        stage.rules.extend(rules)
+        stage.rules.sort(key=lambda rule: rule.priority) # 稳定排序, 同优先级的保持加入顺序
+        stage._plans.clear()
+        return self
+
+    def inject(self, stageName, group, rules, key = None):
+        """用rules替换stageName阶段中属于group的规则. key与上次相同时不做任何事."""
+        if key is not None and self._groups.get(group) == key:
+            return
+        self._groups[group] = key
+        stage = self._stage(stageName)
+        stage.rules = [rule for rule in stage.rules if rule.group != group]
+        for rule in rules:
+            rule.group = group
+        self.add(stageName, *rules)
+
+    def evaluate(self, screen, round = 0):
+        """按阶段和优先级检查所有规则. 返回第一个给出的结果, 都没有给出结果时返回None."""
+        self.evaluations += 1
+        for stage in self.stages:
+            rules = stage.active(round)
+            if not rules:
+                continue
+            found = {}
+            if any(rule.templates for rule in rules):
+                t = time.perf_counter()
+                found = {r.target: r.pos for r in stage.plan([rule for rule in rules if rule.templates]).run(screen)}
+                stage.runs += 1
+                stage.match_time += time.perf_counter() - t
+            for rule in rules:
+                rule.checks += 1
+                pos = None
+                if rule.templates:
+                    pos = next((found[t] for t in rule.templates if found.get(t) is not None), None)
+                    if pos is None:
+                        continue
+                outcome = None
+                if rule.action is not None:
+                    t = time.perf_counter()
+                    outcome = rule.action(pos, screen)
+                    cost = time.perf_counter() - t
+                    rule.total_time += cost
+                    rule.max_time = max(rule.max_time, cost)
+                if outcome is False:
+                    continue
+                rule.hits += 1
+                if outcome is None or outcome is True:
+                    outcome = rule.result
+                if outcome == RULE_NEXT:
+                    continue
+                logger.debug(f"{self.name}: 规则\"{rule.name}\"命中, 结果{outcome}.")
+                if outcome == RULE_RESTART:
+                    self.restarts += 1
+                return outcome
+        return None
+
+    def stats(self):
+        return {
+            'evaluations': self.evaluations,
+            'restarts': self.restarts,
+            'stages': [{'name': stage.name, 'runs': stage.runs, 'mean': stage.match_time / stage.runs if stage.runs else 0.0}
+                       for stage in self.stages],
+            'rules': [{'name': rule.name, 'stage': stage.name, 'checks': rule.checks, 'hits': rule.hits,
+                       'mean': rule.total_time / rule.hits if rule.hits else 0.0, 'max': rule.max_time}
+                      for stage in self.stages for rule in stage.rules],
+        }
+
+    def log_stats(self):
+        s = self.stats()
+        if not s['evaluations']:
+            return
+        stages = ", ".join(f"{v['name']}:{v['runs']}次/平均{v['mean']*1000:.0f}ms" for v in s['stages'] if v['runs'])
+        rules = ", ".join(f"{v['name']}:{v['hits']}/{v['checks']}次/平均{v['mean']:.2f}秒"
+                          for v in sorted(s['rules'], key=lambda v: -v['hits']) if v['hits'])
+        logger.info(f"{self.name}: 识别{s['evaluations']}轮, 重新识别{s['restarts']}次. 匹配: {stages}.")
+        if rules:
+            logger.info(f"{self.name}规则命中: {rules}.")
@@ -7,8 +7,17 @@ from datetime import datetime
 import os
 import subprocess
 from utils import *
+from vision import *
+from capture import *
+from device import *
+from adb_async import *
+from adbd import *
+from recovery import *
+from visionpool import *
+from rules import *
+from calibration import *
 import random
-from threading import Thread,Event
+from collections import deque
 from pathlib import Path
 import numpy as np
 import copy
@@ -55,7 +64,13 @@ CONFIG_VAR_LIST = [
             ["last_version",                tk.StringVar,  "LAST_VERSION",               ""],
             ["latest_version",              tk.StringVar,  "LATEST_VERSION",             None],
             ["_spell_skill_config_internal",list,          "_SPELLSKILLCONFIG",          []],
-            ["active_csc_var",              tk.BooleanVar, "ACTIVE_CSC",                 True]
+            ["active_csc_var",              tk.BooleanVar, "ACTIVE_CSC",                 True],
+            ["capture_mode_var",            tk.StringVar,  "_CAPTUREMODE",               DEFAULT_CAPTURE_MODE],
+            ["touch_mode_var",              tk.StringVar,  "_TOUCHMODE",                 DEFAULT_TOUCH_MODE],
+            ["adb_transport_var",           tk.StringVar,  "_ADBTRANSPORT",              DEFAULT_ADB_TRANSPORT],
+            ["vision_workers_var",          tk.IntVar,     "_VISIONWORKERS",             0],
+            ["screenshot_ttl_var",          tk.DoubleVar,  "_SCREENSHOTTTL",             DEFAULT_SCREENSHOT_TTL],
+            ["calibrate_var",               tk.BooleanVar, "_CALIBRATE",                 False]
             ]
 
 class FarmConfig:
@@ -66,6 +81,8 @@ class FarmConfig:
         self._FORCESTOPING = None
         self._FINISHINGCALLBACK = None
         self._MSGQUEUE = None
+        self._RUNTIMECONTEXT = None # 当前的统计信息, fleet模式下由worker定期汇报
+        self._FLEETINSTANCE = None # fleet模式下的实例名. 同一台电脑上还有其他实例, 不能重启adb server和模拟器
         #### 底层接口
         self._ADBDEVICE = None
     def __getattr__(self, name):
@@ -149,16 +166,27 @@ class TargetInfo:
     @roi.setter
     def roi(self, value):
         if value == 'default':
-            value = [[0,0,900,1600],[0,0,900,208],[0,1265,900,335],[0,636,137,222],[763,636,137,222], [336,208,228,77],[336,1168,228,97]]
+            value = [[0,0,900,1600]] + MAP_ROI_EXCLUSIONS
         if self.target == 'chest':
             if value == None:
                 value = [[0,0,900,1600]]
-            value += [[0,0,900,208],[0,1265,900,335],[0,636,137,222],[763,636,137,222], [336,208,228,77],[336,1168,228,97]]
+            value += MAP_ROI_EXCLUSIONS
 
         self._roi = value
+        self._compiledRoI = None
+
+    @property
+    def compiledRoI(self):
+        # 只有roi是矩形列表时才有意义(position/楼梯目标的roi是坐标). 排除区域的掩码缓存在这个对象里.
+        if self._compiledRoI is None and self._roi is not None:
+            self._compiledRoI = RoI(self._roi)
+        return self._compiledRoI
 
 ##################################################################
 def KillAdb(setting : FarmConfig):
+    if setting._FLEETINSTANCE is not None:
+        logger.info("fleet模式: adb server由所有实例共用, 不关闭adb.")
+        return
     adb_path = GetADBPath(setting)
     try:
         logger.info(f"正在检查并关闭adb...")
@@ -192,6 +220,10 @@ def KillAdb(setting : FarmConfig):
         logger.error(f"终止模拟器进程时出错: {str(e)}")
     
 def KillEmulator(setting : FarmConfig):
+    if setting._FLEETINSTANCE is not None:
+        # 按进程名结束会关掉这台电脑上的所有模拟器实例.
+        logger.info("fleet模式: 不关闭模拟器, 以免影响其他实例.")
+        return
     emulator_name = os.path.basename(setting._EMUPATH)
     emulator_SVC = "MuMuVMMSVC.exe"
     try:
@@ -269,10 +301,26 @@ def CMDLine(cmd):
     logger.debug(f"cmd line: {cmd}")
     return subprocess.run(cmd,shell=True, capture_output=True, text=True, timeout=10,encoding='utf-8')
 
+def StartAdbServer(setting: FarmConfig, timeout = 10):
+    # 只有启动adb server需要运行adb程序. 启动后等到server能够应答为止, 不再固定等待.
+    adbServer = AdbSyncClient()
+    CMDLine(f"\"{GetADBPath(setting)}\" start-server")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            logger.debug(f"adb server版本: {adbServer.version()}")
+            return True
+        except (AdbError, TimeoutError):
+            time.sleep(0.2)
+    logger.info("adb server没有在规定时间内启动.")
+    return False
+
 def CheckRestartConnectADB(setting: FarmConfig):
+    # devices/connect/kill-server直接通过adb server的socket查询(adb_async.py), 不再每次启动adb进程.
     MAXRETRIES = 20
 
-    adb_path = GetADBPath(setting)
+    adbServer = AdbSyncClient()
+    target_device = f"127.0.0.1:{setting._ADBPORT}"
 
     for attempt in range(MAXRETRIES):
         logger.info(f"-----------------------\n开始尝试连接adb. 次数:{attempt + 1}/{MAXRETRIES}...")
@@ -285,36 +333,38 @@ def CheckRestartConnectADB(setting: FarmConfig):
         
         try:
             logger.info("检查adb服务...")
-            result = CMDLine(f"\"{adb_path}\" devices")
-            logger.debug(f"adb链接返回(输出信息):{result.stdout}")
-            logger.debug(f"adb链接返回(错误信息):{result.stderr}")
-            
-            if ("daemon not running" in result.stderr) or ("offline" in result.stdout):
+            try:
+                devices = adbServer.devices()
+                logger.debug(f"adb设备列表:{devices}")
+            except AdbError as e:
+                logger.debug(f"adb服务无应答:{e}")
+                devices = None
+
+            if (devices is None) or any(state == "offline" for serial, state in devices):
                 logger.info("adb服务未启动!\n启动adb服务...")
-                CMDLine(f"\"{adb_path}\" kill-server")
-                CMDLine(f"\"{adb_path}\" start-server")
-                time.sleep(2)
+                if devices is not None and setting._FLEETINSTANCE is None:
+                    adbServer.kill_server()
+                StartAdbServer(setting)
 
             logger.debug(f"尝试连接到adb...")
-            result = CMDLine(f"\"{adb_path}\" connect 127.0.0.1:{setting._ADBPORT}")
-            logger.debug(f"adb链接返回(输出信息):{result.stdout}")
-            logger.debug(f"adb链接返回(错误信息):{result.stderr}")
+            result = adbServer.connect(target_device)
+            logger.debug(f"adb链接返回:{result}")
             
-            if result.returncode == 0 and ("connected" in result.stdout or "already" in result.stdout):
+            if ("connected" in result or "already" in result):
                 logger.info("成功连接到模拟器")
                 break
-            if ("refused" in result.stderr) or ("cannot connect" in result.stdout):
+            if ("refused" in result) or ("cannot connect" in result) or ("failed to connect" in result):
                 logger.info("模拟器未运行，尝试启动...")
                 StartEmulator(setting)
                 logger.info("模拟器(应该)启动完毕.")
                 logger.info("尝试连接到模拟器...")
-                result = CMDLine(f"\"{adb_path}\" connect 127.0.0.1:{setting._ADBPORT}")
-                if result.returncode == 0 and ("connected" in result.stdout or "already" in result.stdout):
+                result = adbServer.connect(target_device)
+                if ("connected" in result or "already" in result):
                     logger.info("成功连接到模拟器")
                     break
                 logger.info("无法连接. 检查adb端口.")
 
-            logger.info(f"连接失败: {result.stderr.strip()}")
+            logger.info(f"连接失败: {result.strip()}")
             time.sleep(2)
             KillEmulator(setting)
             KillAdb(setting)
@@ -330,6 +380,10 @@ def CheckRestartConnectADB(setting: FarmConfig):
         logger.info("达到最大重试次数，连接失败")
         return None
 
+    return GetADBDevice(setting)
+
+def GetADBDevice(setting: FarmConfig):
+    # 从adb server取得已连接的设备对象, 不执行adb命令.
     try:
         client = AdbClient(host="127.0.0.1", port=5037)
         devices = client.devices()
@@ -345,46 +399,7 @@ def CheckRestartConnectADB(setting: FarmConfig):
     
     return None
 ##################################################################
-def CutRoI(screenshot,roi):
-    if roi is None:
-        return screenshot
-
-    img_height, img_width = screenshot.shape[:2]
-    roi_copy = roi.copy()
-    roi1_rect = roi_copy.pop(0)  # 第一个矩形 (x, y, width, height)
-
-    x1, y1, w1, h1 = roi1_rect
-
-    roi1_y_start_clipped = max(0, y1)
-    roi1_y_end_clipped = min(img_height, y1 + h1)
-    roi1_x_start_clipped = max(0, x1)
-    roi1_x_end_clipped = min(img_width, x1 + w1)
-
-    pixels_not_in_roi1_mask = np.ones((img_height, img_width), dtype=bool)
-    if roi1_x_start_clipped < roi1_x_end_clipped and roi1_y_start_clipped < roi1_y_end_clipped:
-        pixels_not_in_roi1_mask[roi1_y_start_clipped:roi1_y_end_clipped, roi1_x_start_clipped:roi1_x_end_clipped] = False
-
-    screenshot[pixels_not_in_roi1_mask] = 255
-
-    if (roi is not []):
-        for roi2_rect in roi_copy:
-            x2, y2, w2, h2 = roi2_rect
-
-            roi2_y_start_clipped = max(0, y2)
-            roi2_y_end_clipped = min(img_height, y2 + h2)
-            roi2_x_start_clipped = max(0, x2)
-            roi2_x_end_clipped = min(img_width, x2 + w2)
-
-            if roi2_x_start_clipped < roi2_x_end_clipped and roi2_y_start_clipped < roi2_y_end_clipped:
-                pixels_in_roi2_mask_for_current_op = np.zeros((img_height, img_width), dtype=bool)
-                pixels_in_roi2_mask_for_current_op[roi2_y_start_clipped:roi2_y_end_clipped, roi2_x_start_clipped:roi2_x_end_clipped] = True
-
-                # 将位于 roi2 中的像素设置为0
-                # (如果这些像素之前因为不在roi1中已经被设为0，则此操作无额外效果)
-                screenshot[pixels_in_roi2_mask_for_current_op] = 0
-
-    # cv2.imwrite(f'CutRoI_{time.time()}.png', screenshot)
-    return screenshot
+FASTFORWARD_OFF_ROI = [[190,1440,100,100]] # 快进按钮(240,1490)附近
 ##################################################################
 
 def Factory():
@@ -422,73 +437,175 @@ def Factory():
                     logger.info(f"Warning: Config has no attribute '{key}' to override")
         return quest
     ##################################################################
+    def AttachDevice(device):
+        nonlocal touchScreen, adbIO
+        setting._ADBDEVICE = device
+        adbIO = device if isinstance(device, AdbdDevice) else AdbSyncClient.for_device(device)
+        shellSession.close()
+        unwaited.clear()
+        touchScreen = None
+        deviceClock.invalidate()
+    def ReleaseDevice(keepTransport = False):
+        # 关闭设备上打开的连接. 超时的命令可能一直占着shell长连接.
+        # keepTransport: 直连adbd时只关闭shell和截图的流, 保留底层的连接.
+        shellSession.close()
+        unwaited.clear() # 主动关闭导致的失败不需要报告
+        frameStream.stop()
+        if isinstance(setting._ADBDEVICE, AdbdDevice) and not keepTransport:
+            setting._ADBDEVICE.close()
     def ResetADBDevice():
         nonlocal setting # 修改device
-        if device := CheckRestartConnectADB(setting):
-            setting._ADBDEVICE = device
+        ReleaseDevice()
+        device = None
+        if setting._ADBTRANSPORT == 'direct':
+            # 直接连接模拟器的adbd, 不需要adb server. 连接失败时退回到adb server.
+            device = ConnectAdbd("127.0.0.1", setting._ADBPORT)
+        if device is None:
+            device = CheckRestartConnectADB(setting)
+        if device:
+            AttachDevice(device)
             logger.info("ADB服务成功启动，设备已连接.")
-    def DeviceShell(cmdStr):
+    # 分级恢复(recovery.py). 每一级只做比上一级多的那部分工作, 最后一级才重启模拟器.
+    def ReopenDevice():
+        if isinstance(setting._ADBDEVICE, AdbdDevice):
+            # adbd的每个服务都是新打开的流: 关闭旧的流, 之后的命令在同一个连接上重新打开. 连接本身断了时由下一级重新连接.
+            ReleaseDevice(keepTransport = True)
+            return
+        ReleaseDevice()
+        if device := GetADBDevice(setting):
+            AttachDevice(device)
+    def ReconnectDevice():
+        ReleaseDevice()
+        device = None
+        if setting._ADBTRANSPORT == 'direct':
+            device = ConnectAdbd("127.0.0.1", setting._ADBPORT)
+        if device is None:
+            adbServer = AdbSyncClient()
+            try:
+                adbServer.disconnect(f"127.0.0.1:{setting._ADBPORT}")
+            except AdbError:
+                pass # 本来就没有连接
+            logger.debug(adbServer.connect(f"127.0.0.1:{setting._ADBPORT}"))
+            device = GetADBDevice(setting)
+        if device:
+            AttachDevice(device)
+    def RestartAdbServer():
+        ReleaseDevice()
+        try:
+            AdbSyncClient().kill_server()
+        except (AdbError, TimeoutError):
+            pass
+        KillAdb(setting) # 模拟器自带的adb(例如HD-Adb)可能不响应host:kill
+        StartAdbServer(setting)
+        ReconnectDevice()
+    def RestartEmulator():
+        ReleaseDevice()
+        KillEmulator(setting)
+        ResetADBDevice() # 连接被拒绝时CheckRestartConnectADB会启动模拟器
+    def ProbeDevice():
+        # 不经过DeviceShell, 避免恢复过程中再次触发恢复.
+        if adbIO is None:
+            return False
+        return adbIO.shell("echo wvd", timeout = 3).strip() == "wvd" and shellSession.run("echo wvd").result(timeout = 3).strip() == "wvd"
+    adbRecovery = RecoveryLadder(ProbeDevice)
+    adbRecovery.add("重试", lambda: None)
+    adbRecovery.add("重新打开设备", ReopenDevice)
+    adbRecovery.add("重新连接", ReconnectDevice)
+    adbRecovery.add("重启adb server", RestartAdbServer)
+    adbRecovery.add("重启模拟器", RestartEmulator)
+    SHARED_RECOVERY_RUNGS = ["重启adb server", "重启模拟器"] # 会影响同一台电脑上的所有模拟器
+    # 所有shell命令共用一个长连接. 每条命令完成后通知流式截图: 之后不再使用命令执行前截取的画面.
+    def OnShellDone(command):
+        frameStream.mark_input()
+        screenCache.invalidate()
+    shellSession = ShellSession(lambda: setting._ADBDEVICE, on_done = OnShellDone)
+    unwaited = deque() # 没有等待结果的命令(ShellCommand, 超时时间), 它们的错误由下一条命令或下一次截图报告
+    def CheckUnwaited(block = False):
+        # 报告已经完成的流水线命令的错误. block: 等待所有流水线命令执行完(截图前, 否则可能截到输入之前的画面).
+        while unwaited:
+            command, timeout = unwaited[0]
+            remaining = timeout - (time.perf_counter() - command.sent)
+            try:
+                if not block and not command.done() and remaining > 0:
+                    return
+                command.result(timeout = max(0, remaining))
+            except Exception as e:
+                shellSession.close() # 超时的命令可能一直占着这个连接
+                unwaited.clear()
+                raise ConnectionResetError(f"没有等待结果的命令\"{command.cmd}\"失败: {e}") from e
+            unwaited.popleft()
+    def DeviceShell(cmdStr, wait = True, timeout = 7):
         logger.debug(f"DeviceShell {cmdStr}")
 
+        # 任何shell命令都可能改变画面, 发出前先作废截图缓存.
+        screenCache.invalidate()
         while True:
-            exception = None
-            result = None
-            completed = Event()
-            
-            def adb_command_thread():
-                nonlocal exception, result
-                try:
-                    result = setting._ADBDEVICE.shell(cmdStr, timeout=5)
-                except Exception as e:
-                    exception = e
-                finally:
-                    completed.set()
-            
-            thread = Thread(target=adb_command_thread)
-            thread.daemon = True
-            thread.start()
-            
             try:
-                if not completed.wait(timeout=7):
-                    # 线程超时未完成
-                    logger.warning(f"ADB命令执行超时: {cmdStr}")
-                    raise TimeoutError(f"ADB命令在{7}秒内未完成")
-                
-                if exception is not None:
-                    raise exception
-                    
-                return result
-            except (TimeoutError, RuntimeError, ConnectionResetError, cv2.error) as e:
+                CheckUnwaited()
+                command = shellSession.run(cmdStr)
+                if not wait:
+                    # 流水线: 不等待结果. 之后的命令会排在它后面执行, 出错时由之后的命令报告并恢复.
+                    unwaited.append((command, timeout))
+                    return None
+                return command.result(timeout=timeout)
+            except (ConnectionResetError, TimeoutError, RuntimeError, OSError, cv2.error) as e:
                 logger.warning(f"ADB操作失败 ({type(e).__name__}): {e}")
-                logger.info("尝试重启ADB服务...")
-                
-                ResetADBDevice()
-                time.sleep(1)
-
-                continue
+                shellSession.close() # 超时的命令可能一直占着这个连接
+                unwaited.clear()
+                adbRecovery.recover(e)
             except Exception as e:
                 # 非预期异常直接抛出
                 logger.error(f"非预期的ADB异常: {type(e).__name__}: {e}")
                 raise
     
     def Sleep(t=1):
+        # 点击等不等待结果都一样: 从流水线中的输入在设备上执行完时开始计时, 与以前等待点击返回后再Sleep相同.
+        try:
+            CheckUnwaited(block = True)
+        except ConnectionResetError as e:
+            logger.warning(f"ADB操作失败 ({type(e).__name__}): {e}")
+            adbRecovery.recover(e)
         time.sleep(t)
-    def ScreenShot():
+    # 截图走asyncio的adb客户端(adb_async.py), 每次截图是事件循环上一个独立的请求, 有自己的超时.
+    adbIO = None
+    rawScreencap = RawScreencap()
+    frameStream = FrameStream(lambda: rawScreencap.capture(adbIO))
+    screenCache = ScreenCache()
+    deviceClock = DeviceClock(lambda: DeviceShell("date +%s.%N"))
+    visionPool = None
+    def CaptureFrame():
+        # 返回(画面, 帧龄). 画面带有截取时间(FrameTime), 同步截图的帧龄为0.
+        mode = setting._CAPTUREMODE
+        if visionPool is not None and mode == 'raw':
+            # 使用匹配进程池时同时使用流式截图: 进程池匹配第N帧时, 第N+1帧已经在后台截取.
+            mode = 'stream'
+        match mode:
+            case 'stream':
+                frameStream.start()
+                return frameStream.latest()
+            case 'raw':
+                taken = time.time()
+                return Timestamped(rawScreencap.capture(adbIO), taken), 0.0
+            case _:
+                taken = time.time()
+                return Timestamped(ScreencapPng(setting._ADBDEVICE), taken), 0.0
+    def ScreenShot(withAge = False):
+        # 上次截图之后没有任何输入, 并且那一帧还足够新时直接复用.
+        cached = screenCache.get()
+        if cached is not None:
+            return cached if withAge else cached[0]
         while True:
             try:
                 # logger.debug('ScreenShot')
-                screenshot = setting._ADBDEVICE.screencap()
-                screenshot_np = np.frombuffer(screenshot, dtype=np.uint8)
-
-                if screenshot_np.size == 0:
-                    logger.error("截图数据为空！")
-                    raise RuntimeError("截图数据为空")
-
-                image = cv2.imdecode(screenshot_np, cv2.IMREAD_COLOR)
-
-                if image is None:
-                    logger.error("OpenCV解码失败：图像数据损坏")
-                    raise RuntimeError("图像解码失败")
+                CheckUnwaited(block = True)
+                generation = screenCache.begin()
+                try:
+                    image, age = CaptureFrame()
+                except ValueError as e:
+                    logger.warning(f"原始截图不可用({e}), 改用png截图.")
+                    frameStream.stop()
+                    setting._CAPTUREMODE = 'png'
+                    continue
 
                 if image.shape != (1600, 900, 3):  # OpenCV格式为(高, 宽, 通道)
                     if image.shape == (900, 1600, 3):
@@ -500,20 +617,20 @@ def Factory():
                         raise RuntimeError("截图尺寸异常")
 
                 #cv2.imwrite('screen.png', image)
-                return image
+                screenCache.put(image, age, generation)
+                return (image, age) if withAge else image
             except Exception as e:
                 logger.debug(f"{e}")
-                if isinstance(e, (AttributeError,RuntimeError, ConnectionResetError, cv2.error)):
-                    logger.info("adb重启中...")
-                    ResetADBDevice()
+                if isinstance(e, (AttributeError,RuntimeError, ConnectionResetError, TimeoutError, cv2.error)):
+                    adbRecovery.recover(e)
     def CheckIf(screenImage, shortPathOfTarget, roi = None, outputMatchResult = False):
         template = LoadTemplateImage(shortPathOfTarget)
-        screenshot = screenImage.copy()
-        threshold = 0.80
+        threshold = MATCH_THRESHOLD
         pos = None
-        search_area = CutRoI(screenshot, roi)
         try:
-            result = cv2.matchTemplate(search_area, template, cv2.TM_CCOEFF_NORMED)
+            # 只在roi裁剪出的视图上匹配, 不再复制和涂抹整帧. 没有roi时优先搜索该模板的热点区域.
+            # 与上一帧相比搜索区域没有变化时直接复用上次的结果(MATCH_CACHE).
+            max_val, max_loc = MatchOnFrame(screenImage, shortPathOfTarget, template, roi, threshold)
         except Exception as e:
                 logger.error(f"{e}")
                 logger.info(f"{e}")
@@ -524,9 +641,12 @@ def Factory():
                     # cv2.imwrite(file_path, ScreenShot())
                     return None
 
-        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if max_loc is None:
+            logger.debug(f"{shortPathOfTarget}大于搜索区域{roi}, 跳过.")
+            return None
 
         if outputMatchResult:
+            screenshot = CutRoI(screenImage.copy(), roi.rects if isinstance(roi, RoI) else roi)
             cv2.imwrite("origin.png", screenshot)
             cv2.rectangle(screenshot, max_loc, (max_loc[0] + template.shape[1], max_loc[1] + template.shape[0]), (0, 255, 0), 2)
             cv2.imwrite("matched.png", screenshot)
@@ -540,6 +660,46 @@ def Factory():
 
         pos=[max_loc[0] + template.shape[1]//2, max_loc[1] + template.shape[0]//2]
         return pos
+    def CheckIfAll(screenImage, targets):
+        # 在同一帧上并行匹配多个模板, 返回{target: pos}, 未找到的为None.
+        return {r.target: r.pos for r in MatchPlan(targets).run(screenImage)}
+    waitStats = WaitStats()
+    def WaitUntil(condition, timeout, poll = 0.3, least = 0, name = None, min_scale = None):
+        # 代替固定的Sleep(timeout): 每poll秒截图检查一次, 条件满足时立即返回, 见capture.py的WaitStats.
+        # condition: 模板, 模板列表(任意一个出现即可), 或者接受画面的函数(例如ScreenStable()).
+        # least: 至少等待的秒数, 之前不检查. 返回条件的结果(模板为位置), 超时返回None.
+        # timeout是默认值, 实际的等待时间由这台电脑上测得的耗时校准, 见calibration.py. name即转换的名称.
+        # min_scale: 校准后最短为默认值的几倍, 不指定时使用SLEEP_PROFILE.min_scale.
+        if isinstance(condition, (str, list, tuple)):
+            targets = [condition] if isinstance(condition, str) else list(condition)
+            plan = MatchPlan(targets, priority = True)
+            check = lambda screen: (hit.pos if (hit := plan.first(screen)) else None)
+            name = name or "/".join(targets)
+        else:
+            check = condition
+            name = name or type(condition).__name__
+        default = timeout
+        timeout = SLEEP_PROFILE.timeout(name, default, min_scale)
+        start = time.monotonic()
+        deadline = start + timeout
+        if least:
+            Sleep(least)
+        result = None
+        while not setting._FORCESTOPING.is_set():
+            result = check(ScreenShot())
+            if result:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            Sleep(min(poll, remaining))
+        waited = time.monotonic() - start
+        if not setting._FORCESTOPING.is_set():
+            SLEEP_PROFILE.record(name, waited, default, bool(result))
+        saved = waitStats.record(name, waited, default, bool(result))
+        if result:
+            logger.debug(f"等待{name}: {waited:.1f}秒后满足, 节省{saved:.1f}秒.")
+        return result or None
     def CheckIf_MultiRect(screenImage, shortPathOfTarget):
         template = LoadTemplateImage(shortPathOfTarget)
         screenshot = screenImage
@@ -640,31 +800,56 @@ def Factory():
                 logger.info("判定为楼梯存在, 尚未通过.")
                 return position
             return None
-    def CheckIf_fastForwardOff(screenImage):
-        position = [240,1490]
-        template =  LoadTemplateImage(f"fastforward_off")
-        screenshot =  screenImage
-        cropped = screenshot[position[1]-50:position[1]+50, position[0]-50:position[0]+50]
-        
-        result = cv2.matchTemplate(cropped, template, cv2.TM_CCOEFF_NORMED)
-        _, max_val, _, max_loc = cv2.minMaxLoc(result)
-        threshold = 0.80
-        pos=[position[0]+max_loc[0] - cropped.shape[1]//2, position[1]+max_loc[1] -cropped.shape[0]//2]
-
-        if max_val > threshold:
-            logger.info(f"快进未开启, 即将开启.{pos}")
-            return pos
-        return None
+    touchScreen = None # None: 尚未检测; False: 不可用
+    def GetTouchScreen():
+        # _TOUCHMODE为sendevent时返回触摸屏, 否则(或者找不到可写的触摸屏时)返回None, 使用input tap.
+        nonlocal touchScreen
+        if setting._TOUCHMODE != 'sendevent':
+            return None
+        if touchScreen is None:
+            touchScreen = ParseGetevent(DeviceShell("getevent -p")) or False
+            if touchScreen and DeviceShell(f"test -w {touchScreen.path} && echo ok").strip() != 'ok':
+                logger.warning(f"没有{touchScreen.path}的写入权限, 使用input tap.")
+                touchScreen = False
+            elif touchScreen:
+                logger.info(f"使用sendevent直接向{touchScreen.path}发送点击.")
+            else:
+                logger.warning("没有找到触摸屏设备, 使用input tap.")
+        return touchScreen or None
+    def TapLatency():
+        # 从发出点击到点击生效的时间. input tap的0.270秒是实测的经验值;
+        # sendevent没有启动java进程的开销, 使用实测的命令往返时间.
+        if GetTouchScreen():
+            stat = shellSession.stats().get('sendevent')
+            return stat['mean'] if stat else 0.03
+        return 0.270
     def Press(pos):
         if pos!=None:
-            DeviceShell(f"input tap {pos[0]} {pos[1]}")
+            # 点击不需要结果, 不等待往返. 下一次截图或Sleep前会等它执行完, 见CheckUnwaited.
+            if touch := GetTouchScreen():
+                DeviceShell(touch.tap(pos), wait = False)
+            else:
+                DeviceShell(f"input tap {pos[0]} {pos[1]}", wait = False)
             return True
         return False
+    def Swipe(start, end, duration = None):
+        # 与input swipe相同; sendevent模式下直接写触摸屏, 不需要每次启动app_process.
+        if touch := GetTouchScreen():
+            DeviceShell(touch.swipe(start, end, 300 if duration is None else duration))
+        else:
+            args = f"input swipe {start[0]} {start[1]} {end[0]} {end[1]}"
+            DeviceShell(args if duration is None else f"{args} {int(duration)}")
     def PressReturn():
-        DeviceShell('input keyevent KEYCODE_BACK')
+        DeviceShell('input keyevent KEYCODE_BACK', wait = False)
+    def RunInputSequence(sequence):
+        # 整个序列在设备上一次执行完, 超时时间加上序列中的等待时间.
+        if not len(sequence):
+            return False
+        DeviceShell(sequence.compile(GetTouchScreen()), timeout = 7 + sequence.duration())
+        return True
     def WrapImage(image,r,g,b):
-        scn_b = image * np.array([b, g, r])
-        return np.clip(scn_b, 0, 255).astype(np.uint8)
+        # 同一帧的同一组权重只计算一次, 见vision.py的FrameView.
+        return FrameWeighted(image, r, g, b)
     def AddImportantInfo(str):
         nonlocal runtimeContext
         if runtimeContext._IMPORTANTINFO == "":
@@ -674,31 +859,34 @@ def Factory():
     ##################################################################
     def FindCoordsOrElseExecuteFallbackAndWait(targetPattern, fallback,waitTime):
         # fallback可以是坐标[x,y]或者字符串. 当为字符串的时候, 视为图片地址
+        targets = list(targetPattern) if isinstance(targetPattern, (list, tuple)) else [targetPattern]
+        # 目标, 重试和快进在同一帧上一次匹配完, 按顺序取第一个命中的.
+        plan = MatchPlan(targets + ['retry', 'retry_blank', ('fastforward_off', FASTFORWARD_OFF_ROI)], priority = True)
         while True:
             for _ in range(runtimeContext._MAXRETRYLIMIT):
                 if setting._FORCESTOPING.is_set():
                     return None
                 scn = ScreenShot()
-                if isinstance(targetPattern, (list, tuple)):
-                    for pattern in targetPattern:
-                        p = CheckIf(scn,pattern)
-                        if p:
-                            return p
-                else:
-                    pos = CheckIf(scn,targetPattern)
-                    if pos:
-                        return pos # FindCoords
+                results = plan.run(scn)
+                hit = next((i for i, r in enumerate(results) if r.pos is not None), None)
+                if hit is not None and hit < len(targets):
+                    return results[hit].pos # FindCoords
                 # OrElse
-                if Press(CheckIf(scn,'retry')) or Press(CheckIf(scn,'retry_blank')):
+                if hit is not None and results[hit].target.startswith('retry'):
+                    Press(results[hit].pos)
                     logger.info("发现并点击了\"重试\". 你遇到了网络波动.")
                     Sleep(1)
                     continue
-                if Press(CheckIf_fastForwardOff(scn)):
+                if hit is not None:
+                    logger.info(f"快进未开启, 即将开启.{results[hit].pos}")
+                    Press(results[hit].pos)
                     Sleep(1)
                     continue
                 def pressTarget(target):
                     if target.lower() == 'return':
                         PressReturn()
+                    elif swipe := ParseSwipe(target):
+                        Swipe(*swipe)
                     elif target.startswith("input swipe"):
                         DeviceShell(target)
                     else:
@@ -708,18 +896,22 @@ def Factory():
                         if (len(fallback) == 2) and all(isinstance(x, (int, float)) for x in fallback):
                             Press(fallback)
                         else:
+                            # 连续的坐标合并成一个输入序列一次执行, 遇到需要截图判断的字符串目标时先执行已有的部分.
+                            sequence = InputSequence(pace = 0.1)
                             for p in fallback:
-                                if isinstance(p, str):
+                                if isinstance(p, str) and (swipe := ParseSwipe(p)):
+                                    sequence.swipe(*swipe)
+                                elif isinstance(p, str):
+                                    RunInputSequence(sequence)
+                                    sequence = InputSequence(pace = 0.1)
                                     pressTarget(p)
                                 elif isinstance(p, (list, tuple)) and len(p) == 2:
-                                    t = time.time()
-                                    Press(p)
-                                    if (waittime:=(time.time()-t)) < 0.1:
-                                        Sleep(0.1-waittime)
+                                    sequence.tap(p)
                                 else:
                                     logger.debug(f"错误: 非法的目标{p}.")
                                     setting._FORCESTOPING.set()
                                     return None
+                            RunInputSequence(sequence)
                     else:
                         if isinstance(fallback, str):
                             pressTarget(fallback)
@@ -727,7 +919,9 @@ def Factory():
                             logger.debug("错误: 非法的目标.")
                             setting._FORCESTOPING.set()
                             return None
-                Sleep(waitTime) # and wait
+                if waitTime > 0: # and wait. 目标出现时立即结束, 等待时间由calibration.py按这台电脑校准.
+                    # 这个等待也决定了重启前总共等多久, 所以只允许延长, 不允许缩短.
+                    WaitUntil(targets, waitTime, name = "查找" + "/".join(targets), min_scale = 1.0)
 
             logger.info(f"{runtimeContext._MAXRETRYLIMIT}次截图依旧没有找到目标{targetPattern}, 疑似卡死. 重启游戏.")
             Sleep()
@@ -760,7 +954,9 @@ def Factory():
         Sleep(2)
         logger.info("巫术, 启动!")
         logger.debug(DeviceShell(f"am start -n {mainAct}"))
-        Sleep(10)
+        # 启动画面和加载画面也会静止, 不能用画面稳定判断. 只有直接回到了状态识别认得的画面时才提前结束,
+        # 否则(例如停在标题画面)与原来一样等满10秒再交给状态识别.
+        WaitUntil(['Inn','dungFlag','combatActive','combatActive_2','mapFlag','startdownload'], 10, poll = 0.5, name = "启动游戏")
         raise RestartSignal()
     class RestartSignal(Exception):
         pass
@@ -800,7 +996,7 @@ def Factory():
     def findWidestRectMid(input):
         crop_area = (30,62),(880,115)
         # 转换为灰度图
-        gray = cv2.cvtColor(input, cv2.COLOR_BGR2GRAY)
+        gray = FrameGray(input)
 
         # 裁剪图像 (y1:y2, x1:x2)
         (x1, y1), (x2, y2) = crop_area
@@ -868,12 +1064,13 @@ def Factory():
         logger.info("开始智能开箱(?)...")
         ts = []
         xs = []
-        t0 = float(DeviceShell("date +%s.%N").strip())
+        # 用画面的截取时间换算出设备时间, 不再为每个采样执行一次date.
+        t0 = deviceClock.now()
         while 1:
             while 1:
                 Sleep(0.2)
-                t = float(DeviceShell("date +%s.%N").strip())
                 s = ScreenShot()
+                t = deviceClock.to_device(FrameTime(s))
                 x = getCursorCoordinates(s)
                 if x != None:
                     ts.append(t-t0)
@@ -888,8 +1085,8 @@ def Factory():
             spd = 2/p*900
             logger.debug(f"s = {2/p*900}")
 
-            t = float(DeviceShell("date +%s.%N").strip())
             s = ScreenShot()
+            t = deviceClock.to_device(FrameTime(s))
             x = getCursorCoordinates(s)
             target = findWidestRectMid(s)
             logger.debug(f"理论点: {triangularWave(t-t0,p,c)*900}")
@@ -907,10 +1104,11 @@ def Factory():
                     waittime = (x+target)/spd
                     logger.debug("先向左再向右")
 
-                if waittime > 0.270 :
+                latency = TapLatency()
+                if waittime > latency :
                     logger.debug(f"预计等待 {waittime}")
-                    Sleep(waittime-0.270)
-                    DeviceShell(f"input tap 527 920") # 这里和retry重合, 也和to_title+retry重合.
+                    Sleep(waittime-latency)
+                    Press([527,920]) # 这里和retry重合, 也和to_title+retry重合.
                     Sleep(3)
                 else:
                     logger.debug(f"等待时间过短: {waittime}")
@@ -949,10 +1147,10 @@ def Factory():
         # 往下都是确保了现在能看见'worldmapflag', 并尝试看见'target'
         Sleep(0.5)
         if not runtimeContext._ZOOMWORLDMAP:
+            sequence = InputSequence()
             for _ in range(3):
-                Press([100,1500])
-                Sleep(0.5)
-            Press([250,1500])
+                sequence.tap([100,1500]).wait(0.5)
+            RunInputSequence(sequence.tap([250,1500]))
             runtimeContext._ZOOMWORLDMAP = True
         pos = FindCoordsOrElseExecuteFallbackAndWait(target,[swipe,[550,1]],1)
 
@@ -982,8 +1180,8 @@ def Factory():
         Press(FindCoordsOrElseExecuteFallbackAndWait('cursedWheel',['ruins',[1,1]],1))
         Press(FindCoordsOrElseExecuteFallbackAndWait('cursedwheel_impregnableFortress',['cursedWheelTapRight','cursedWheel',[1,1]],1))
         if not Press(CheckIf(ScreenShot(),target)):
-            DeviceShell(f"input swipe 450 1200 450 200")
-            Sleep(2)
+            Swipe([450,1200],[450,200])
+            WaitUntil(ScreenStable(), 2, name = "滑动列表")
             Press(FindCoordsOrElseExecuteFallbackAndWait(target,'input swipe 50 1200 50 1300',1))
         Sleep(1)
 
@@ -991,13 +1189,14 @@ def Factory():
         while CheckIf(ScreenShot(), 'leap'):
             if CSC_symbol != None:
                 FindCoordsOrElseExecuteFallbackAndWait(CSC_symbol,'CSC',1)
-                last_scn = CutRoI(ScreenShot(), [[77,349,757,1068]])
+                # CutRoI会涂抹传入的画面, 而流式截图可能把同一帧返回给多个调用, 所以先复制.
+                last_scn = CutRoI(ScreenShot().copy(), [[77,349,757,1068]])
                 # 先关闭所有因果
                 while 1:
                     Press(CheckIf(WrapImage(ScreenShot(),2,0,0),'didnottakethequest'))
-                    DeviceShell(f"input swipe 150 500 150 400")
+                    Swipe([150,500],[150,400])
                     Sleep(1)
-                    scn = CutRoI(ScreenShot(), [[77,349,757,1068]])
+                    scn = CutRoI(ScreenShot().copy(), [[77,349,757,1068]])
                     logger.debug(f"因果: 滑动后的截图误差={cv2.absdiff(scn, last_scn).mean()/255:.6f}")
                     if cv2.absdiff(scn, last_scn).mean()/255 < 0.006:
                         break
@@ -1005,14 +1204,14 @@ def Factory():
                         last_scn = scn
                 # 然后调整每个因果
                 if CSC_setting!=None:
-                    last_scn = CutRoI(ScreenShot(), [[77,349,757,1068]])
+                    last_scn = CutRoI(ScreenShot().copy(), [[77,349,757,1068]])
                     while 1:
                         for option, r, g, b in CSC_setting:
                             Press(CheckIf(WrapImage(ScreenShot(),r,g,b),option))
                             Sleep(1)
-                        DeviceShell(f"input swipe 150 400 150 500")
+                        Swipe([150,400],[150,500])
                         Sleep(1)
-                        scn = CutRoI(ScreenShot(), [[77,349,757,1068]])
+                        scn = CutRoI(ScreenShot().copy(), [[77,349,757,1068]])
                         logger.debug(f"因果: 滑动后的截图误差={cv2.absdiff(scn, last_scn).mean()/255:.6f}")
                         if cv2.absdiff(scn, last_scn).mean()/255 < 0.006:
                             break
@@ -1038,204 +1237,180 @@ def Factory():
         # logger.info("REZ.")
         Press([450,750])
         Sleep(10)
+    ##################################################################
+    # 状态识别的规则表, 见rules.py. 阶段按顺序检查:
+    #   retry: 网络波动的"重试", 点掉之后继续识别.
+    #   dungeon: 地下城中的几种状态, 命中即返回.
+    #   town: 城镇/世界地图和常见的对话, 以及任务注入的规则(_SPECIALFORCESTOPINGSYMBOL, _SPECIALDIALOGOPTION).
+    #   anomaly: 第4轮之后才检查的各种罕见的对话框, 最后按两次返回.
+    #   fallback: 长时间无法识别时的兜底: 点击角落, 黑屏警告, 重启游戏.
+    def BuildIdentifyRules():
+        def PressAndSleep(message = None, info = None, wait = 2):
+            def action(pos, screen):
+                Press(pos)
+                if message:
+                    logger.info(message)
+                if info:
+                    AddImportantInfo(info)
+                Sleep(wait)
+            return action
+        def Revive(pos, screen):
+            AddImportantInfo("他们活了,活了!")
+            sequence = InputSequence()
+            for _ in range(5):
+                sequence.tap([400+random.randint(0,100),750+random.randint(0,100)]).wait(1)
+            RunInputSequence(sequence)
+        def ReturnToTown(pos, screen):
+            FindCoordsOrElseExecuteFallbackAndWait('Inn',['return',[1,1]],1)
+        def EnterCity(target):
+            def action(pos, screen):
+                FindCoordsOrElseExecuteFallbackAndWait(['Inn','dungFlag'],[target,[1,1]],1)
+                if CheckIf(scn:=ScreenShot(),'Inn'):
+                    return State.Inn,DungeonState.Quit
+                elif CheckIf(scn,'dungFlag'):
+                    return State.Dungeon,None
+            return action
+        def ZoomWorldMap(pos, screen):
+            sequence = InputSequence()
+            for _ in range(3):
+                sequence.tap([100,1500]).wait(0.5)
+            RunInputSequence(sequence.tap([250,1500]))
+        def TimeLeap(pos, screen):
+            setting._MSGQUEUE.put(('turn_to_7000G',""))
+            raise SystemExit
+        def AdjustKarma(sign, flipped, message):
+            # 善恶值调整: "-n"时选择伏击, "+n"时选择忽略, 每次把剩余次数减一, 用完后切换到另一边的0.
+            def action(pos, screen):
+                if not setting._KARMAADJUST.startswith(sign):
+                    return False
+                num_str = setting._KARMAADJUST[1:]
+                if not num_str.isdigit():
+                    return False
+                num = int(num_str)
+                new_str = f"{sign}{num - 1}" if num != 0 else f"{flipped}0"
+                logger.info(f"即将进行善恶值调整. 剩余次数:{new_str}")
+                AddImportantInfo(f"新的善恶:{new_str}")
+                setting._KARMAADJUST = new_str
+                SetOneVarInConfig("_KARMAADJUST",setting._KARMAADJUST)
+                Press(pos)
+                logger.info(message)
+                Sleep(2)
+            return action
+        def MultiPeopleDead(pos, screen):
+            runtimeContext._SUICIDE = True # 准备尝试自杀
+            logger.info("死了好几个, 惨哦")
+            # logger.info("Corpses strew the screen")
+            Press(CheckIf(screen, 'skull'))
+            Sleep(2)
+        def PressReturnTwice(pos, screen):
+            PressReturn()
+            Sleep(0.5)
+            PressReturn()
+        def BlackScreenWarning(pos, screen):
+            black = LoadTemplateImage("blackScreen")
+            mean_diff = cv2.absdiff(black, screen).mean()/255
+            if mean_diff<0.02:
+                logger.info(f"警告: 游戏画面长时间处于黑屏中, 即将重启({25-identifyRound})")
+        def Restart(pos, screen):
+            logger.info("看起来遇到了一些非同寻常的情况...重启游戏.")
+            restartGame()
+        def TapCorner(pos, screen):
+            Press([1,1])
+            Sleep(0.25)
+            Press([1,1])
+            Sleep(0.25)
+            Press([1,1])
+
+        engine = RuleEngine("状态识别")
+        engine.stage('retry', first = True)
+        engine.stage('dungeon', first = True)
+        engine.stage('town')
+        engine.stage('anomaly')
+        engine.stage('fallback')
+        engine.add('retry',
+            StateRule('retry', ['retry','retry_blank'], PressAndSleep("发现并点击了\"重试\". 你遇到了网络波动.")),
+            )
+        engine.add('dungeon',
+            StateRule('combatActive', ['combatActive','combatActive_2'], result = (State.Dungeon, DungeonState.Combat)),
+            StateRule('dungFlag',     'dungFlag',                        result = (State.Dungeon, DungeonState.Dungeon)),
+            StateRule('chestFlag',    ['chestFlag','whowillopenit'],     result = (State.Dungeon, DungeonState.Chest)),
+            StateRule('mapFlag',      'mapFlag',                         result = (State.Dungeon, DungeonState.Map)),
+            )
+        engine.add('town',
+            StateRule('someonedead',       'someonedead',       Revive,                                   priority = 10),
+            StateRule('returnText',        'returnText',        PressAndSleep(),  RULE_RESTART,           priority = 20),
+            StateRule('returntoTown',      'returntoTown',      ReturnToTown,     (State.Inn, DungeonState.Quit), priority = 30),
+            StateRule('openworldmap',      'openworldmap',      PressAndSleep(wait = 0), RULE_RESTART,    priority = 40),
+            StateRule('RoyalCityLuknalia', 'RoyalCityLuknalia', EnterCity('RoyalCityLuknalia'),           priority = 50),
+            StateRule('fortressworldmap',  'fortressworldmap',  EnterCity('fortressworldmap'),            priority = 60),
+            StateRule('Inn',               'Inn',               result = (State.Inn, None),               priority = 70),
+            )
+        engine.add('anomaly',
+            StateRule('RiseAgain',            'RiseAgain',            lambda pos, screen: RiseAgainReset(reason = 'combat'), RULE_RESTART, after = 4),
+            StateRule('worldmapflag',         'worldmapflag',         ZoomWorldMap, after = 4),
+            StateRule('sandman_recover',      'sandman_recover',      PressAndSleep(wait = 0), RULE_RESTART, after = 4),
+            StateRule('cursedWheel_timeLeap', 'cursedWheel_timeLeap', TimeLeap, after = 4),
+            StateRule('ambush',               'ambush',               AdjustKarma('-', '+', "伏击起手!"), after = 4),
+            StateRule('ignore',               'ignore',               AdjustKarma('+', '-', "积善行德!"), after = 4),
+            StateRule('strange_things',       'strange_things',       PressAndSleep(), after = 4),
+            StateRule('blessing',             'blessing',             PressAndSleep("我要选安戈拉的祝福!...好吧随便选一个吧."), after = 4),
+            StateRule('DontBuyIt',            'DontBuyIt',            PressAndSleep("等我买? 你白等了, 我不买."), after = 4),
+            StateRule('donthelp',             'donthelp',             PressAndSleep("不帮你了."), after = 4),
+            StateRule('adventurersbones',     'adventurersbones',     PressAndSleep("是骨头!", "购买了骨头."), after = 4),
+            StateRule('halfBone',             'halfBone',             PressAndSleep("半根骨头也是骨头!", "购买了尸油."), after = 4),
+            StateRule('buyNothing',           'buyNothing',           PressAndSleep("有骨头的话我会买的."), after = 4),
+            StateRule('Nope',                 'Nope',                 PressAndSleep("但是, 我拒绝."), after = 4),
+            StateRule('ignorethequest',       'ignorethequest',       PressAndSleep("忽略任务."), after = 4),
+            StateRule('dontGiveAntitoxin',    'dontGiveAntitoxin',    PressAndSleep("但是, 我拒绝."), after = 4),
+            StateRule('multipeopledead',      'multipeopledead',      MultiPeopleDead, after = 4),
+            StateRule('startdownload',        'startdownload',        PressAndSleep("确认, 下载, 确认."), after = 4),
+            StateRule('totitle',              'totitle',              PressAndSleep("网络故障警报! 网络故障警报! 返回标题, 重复, 返回标题!", wait = 0), RULE_RESTART, after = 4),
+            StateRule('pressReturn',          None,                   PressReturnTwice, after = 4),
+            )
+        engine.add('fallback',
+            StateRule('blackScreen', None, BlackScreenWarning, after = 16),
+            StateRule('restartGame', None, Restart, RULE_RESTART, after = 25),
+            StateRule('tapCorner',   None, TapCorner, after = 4),
+            )
+        return engine
+    identifyRules = None
+    identifyRound = 0
+    def InjectQuestRules():
+        # 任务在运行中会修改这两项, 每轮识别前同步一次.
+        symbols = quest._SPECIALFORCESTOPINGSYMBOL or []
+        options = quest._SPECIALDIALOGOPTION or []
+        identifyRules.inject('town', 'quest',
+            [StateRule(symbol, symbol, result = (State.Quit, DungeonState.Quit), priority = 80) for symbol in symbols] +
+            [StateRule(option, option, lambda pos, screen: Press(pos), RULE_RESTART, priority = 90) for option in options],
+            key = (tuple(symbols), tuple(options)))
     def IdentifyState():
-        nonlocal setting # 修改因果
-        counter = 0
+        nonlocal identifyRules, identifyRound
+        if identifyRules is None:
+            identifyRules = BuildIdentifyRules()
+        identifyRound = 0
         while 1:
+            HOTSPOTS.save() # 每分钟最多保存一次
+            SLEEP_PROFILE.save()
             screen = ScreenShot()
-            logger.info(f'状态机检查中...(第{counter+1}次)')
+            logger.info(f'状态机检查中...(第{identifyRound+1}次)')
 
             if setting._FORCESTOPING.is_set():
                 return State.Quit, DungeonState.Quit, screen
 
-            if Press(CheckIf(screen,'retry')) or Press(CheckIf(screen,'retry_blank')):
-                    logger.info("发现并点击了\"重试\". 你遇到了网络波动.")
-                    # logger.info("ka le.")
-                    Sleep(2)
-
-            identifyConfig = [
-                ('combatActive',  DungeonState.Combat),
-                ('combatActive_2',DungeonState.Combat),
-                ('dungFlag',      DungeonState.Dungeon),
-                ('chestFlag',     DungeonState.Chest),
-                ('whowillopenit', DungeonState.Chest),
-                ('mapFlag',       DungeonState.Map),
-                ]
-            for pattern, state in identifyConfig:
-                if CheckIf(screen, pattern):
-                    return State.Dungeon, state, screen
-
-            if CheckIf(screen,'someonedead'):
-                AddImportantInfo("他们活了,活了!")
-                for _ in range(5):
-                    Press([400+random.randint(0,100),750+random.randint(0,100)])
-                    Sleep(1)
-
-            if Press(CheckIf(screen, "returnText")):
-                Sleep(2)
-                return IdentifyState()
-
-            if CheckIf(screen,"returntoTown"):
-                FindCoordsOrElseExecuteFallbackAndWait('Inn',['return',[1,1]],1)
-                return State.Inn,DungeonState.Quit, screen
-
-            if Press(CheckIf(screen,"openworldmap")):
-                return IdentifyState()
-
-            if CheckIf(screen,"RoyalCityLuknalia"):
-                FindCoordsOrElseExecuteFallbackAndWait(['Inn','dungFlag'],['RoyalCityLuknalia',[1,1]],1)
-                if CheckIf(scn:=ScreenShot(),'Inn'):
-                    return State.Inn,DungeonState.Quit, screen
-                elif CheckIf(scn,'dungFlag'):
-                    return State.Dungeon,None, screen
-
-            if CheckIf(screen,"fortressworldmap"):
-                FindCoordsOrElseExecuteFallbackAndWait(['Inn','dungFlag'],['fortressworldmap',[1,1]],1)
-                if CheckIf(scn:=ScreenShot(),'Inn'):
-                    return State.Inn,DungeonState.Quit, screen
-                elif CheckIf(scn,'dungFlag'):
-                    return State.Dungeon,None, screen
-
-            if (CheckIf(screen,'Inn')):
-                return State.Inn, None, screen
-
-            if quest._SPECIALFORCESTOPINGSYMBOL != None:
-                for symbol in quest._SPECIALFORCESTOPINGSYMBOL:
-                        if CheckIf(screen,symbol):
-                            return State.Quit,DungeonState.Quit,screen
-                        
-            if quest._SPECIALDIALOGOPTION != None:
-                for option in quest._SPECIALDIALOGOPTION:
-                    if Press(CheckIf(screen,option)):
-                        return IdentifyState()
-
-            if counter>=4:
+            if identifyRound >= 4:
                 logger.info("看起来遇到了一些不太寻常的情况...")
-                if (CheckIf(screen,'RiseAgain')):
-                    RiseAgainReset(reason = 'combat')
-                    return IdentifyState()
-                if CheckIf(screen, 'worldmapflag'):
-                    for _ in range(3):
-                        Press([100,1500])
-                        Sleep(0.5)
-                    Press([250,1500])
-                    # 这里不需要continue或者递归 直接继续进行就行
-                if Press(CheckIf(screen, 'sandman_recover')):
-                    return IdentifyState()
-                if (CheckIf(screen,'cursedWheel_timeLeap')):
-                    setting._MSGQUEUE.put(('turn_to_7000G',""))
-                    raise SystemExit
-                if (pos:=CheckIf(screen,'ambush')) and setting._KARMAADJUST.startswith('-'):
-                    new_str = None
-                    num_str = setting._KARMAADJUST[1:]
-                    if num_str.isdigit():
-                        num = int(num_str)
-                        if num != 0:
-                            new_str = f"-{num - 1}"
-                        else:
-                            new_str = f"+0"
-                    if new_str is not None:
-                        logger.info(f"即将进行善恶值调整. 剩余次数:{new_str}")
-                        AddImportantInfo("新的善恶:{new_str}")
-                        setting._KARMAADJUST = new_str
-                        SetOneVarInConfig("_KARMAADJUST",setting._KARMAADJUST)
-                        Press(pos)
-                        logger.info("伏击起手!")
-                        # logger.info("Ambush! Always starts with Ambush.")
-                        Sleep(2)
-                if (pos:=CheckIf(screen,'ignore')) and setting._KARMAADJUST.startswith('+'):
-                    new_str = None
-                    num_str = setting._KARMAADJUST[1:]
-                    if num_str.isdigit():
-                        num = int(num_str)
-                        if num != 0:
-                            new_str = f"+{num - 1}"
-                        else:
-                            new_str = f"-0"
-                    if new_str is not None:
-                        logger.info(f"即将进行善恶值调整. 剩余次数:{new_str}")
-                        AddImportantInfo("新的善恶:{new_str}")
-                        setting._KARMAADJUST = new_str
-                        SetOneVarInConfig("_KARMAADJUST",setting._KARMAADJUST)
-                        Press(pos)
-                        logger.info("积善行德!")
-                        # logger.info("")
-                        Sleep(2)
-                if Press(CheckIf(screen,'strange_things')):
-                    Sleep(2)
-                if Press(CheckIf(screen,'blessing')):
-                    logger.info("我要选安戈拉的祝福!...好吧随便选一个吧.")
-                    # logger.info("Blessing of... of course Angora! Fine, anything.")
-                    Sleep(2)
-                if Press(CheckIf(screen,'DontBuyIt')):
-                    logger.info("等我买? 你白等了, 我不买.")
-                    # logger.info("wait for paurch? Wait for someone else.")
-                    Sleep(2)
-                if Press(CheckIf(screen,'donthelp')):
-                    logger.info("不帮你了.")
-                    # logger.info("")
-                    Sleep(2)
-                if Press(CheckIf(screen,'adventurersbones')):
-                    logger.info("是骨头!")
-                    AddImportantInfo("购买了骨头.")
-                    # logger.info("")
-                    Sleep(2)
-                if Press(CheckIf(screen,'halfBone')):
-                    logger.info("半根骨头也是骨头!")
-                    AddImportantInfo("购买了尸油.")
-                    # logger.info("")
-                    Sleep(2)
-                if Press(CheckIf(screen,'buyNothing')):
-                    logger.info("有骨头的话我会买的.")
-                    # logger.info("No Bones No Buy.")
-                    Sleep(2)
-                if Press(CheckIf(screen,'Nope')):
-                    logger.info("但是, 我拒绝.")
-                    # logger.info("And what, must we give in return?")
-                    Sleep(2)
-                if Press(CheckIf(screen,'ignorethequest')):
-                    logger.info("忽略任务.")
-                    # logger.info("")
-                    Sleep(2)
-                if Press(CheckIf(screen,'dontGiveAntitoxin')):
-                    logger.info("但是, 我拒绝.")
-                    # logger.info("")
-                    Sleep(2)
-                if (CheckIf(screen,'multipeopledead')):
-                    runtimeContext._SUICIDE = True # 准备尝试自杀
-                    logger.info("死了好几个, 惨哦")
-                    # logger.info("Corpses strew the screen")
-                    Press(CheckIf(screen,'skull'))
-                    Sleep(2)
-                if Press(CheckIf(screen,'startdownload')):
-                    logger.info("确认, 下载, 确认.")
-                    # logger.info("")
-                    Sleep(2)
-                if Press(CheckIf(screen,'totitle')):
-                    logger.info("网络故障警报! 网络故障警报! 返回标题, 重复, 返回标题!")
-                    return IdentifyState()
-                PressReturn()
-                Sleep(0.5)
-                PressReturn()
-            if counter>15:
-                black = LoadTemplateImage("blackScreen")
-                mean_diff = cv2.absdiff(black, screen).mean()/255
-                if mean_diff<0.02:
-                    logger.info(f"警告: 游戏画面长时间处于黑屏中, 即将重启({25-counter})")
-            if counter>= 25:
-                logger.info("看起来遇到了一些非同寻常的情况...重启游戏.")
-                restartGame()
-                counter = 0
-            if counter>=4:
-                Press([1,1])
-                Sleep(0.25)
-                Press([1,1])
-                Sleep(0.25)
-                Press([1,1])
+            InjectQuestRules()
+            outcome = identifyRules.evaluate(screen, identifyRound)
+            if outcome == RULE_RESTART:
+                # 点掉了某个对话框, 马上重新识别.
+                identifyRound = 0
+                continue
+            if outcome is not None:
+                state, dungState = outcome
+                return state, dungState, screen
 
             Sleep(1)
-            counter += 1
-        return None, None, screen
+            identifyRound += 1
     def GameFrozenCheck(queue, scn):
         if scn is None:
             raise ValueError("GameFrozenCheck被传入了一个空值.")
@@ -1248,8 +1423,9 @@ def Factory():
         t = time.time()
         if len(queue)==LENGTH:
             for i in range(1,LENGTH):
-                grayThis = cv2.cvtColor(queue[i], cv2.COLOR_BGR2GRAY)
-                grayLast = cv2.cvtColor(queue[i-1], cv2.COLOR_BGR2GRAY)
+                # 每一帧的灰度图缓存在帧上, 队列中的每一帧只转换一次.
+                grayThis = FrameGray(queue[i])
+                grayLast = FrameGray(queue[i-1])
                 mean_diff = cv2.absdiff(grayThis, grayLast).mean()/255
                 totalDiff += mean_diff
             logger.info(f"卡死检测耗时: {time.time()-t:.5f}秒")
@@ -1280,7 +1456,7 @@ def Factory():
     def StateCombat():
         def doubleConfirmCastSpell():
             is_success_aoe = False
-            Sleep(1)
+            WaitUntil(['OK','next'], 1, poll = 0.2, name = "施法确认")
             scn = ScreenShot()
             if Press(CheckIf(scn,'OK')):
                 is_success_aoe = True
@@ -1301,18 +1477,10 @@ def Factory():
                     Press([pos[0]-15+random.randint(0,30),pos[1]+150+random.randint(0,30)])
                     Sleep(1)
             else:
-                Press([150,750])
-                Sleep(0.1)
-                Press([300,750])
-                Sleep(0.1)
-                Press([450,750])
-                Sleep(0.1)
-                Press([550,750])
-                Sleep(0.1)
-                Press([650,750])
-                Sleep(0.1)
-                Press([750,750])
-                Sleep(0.1)
+                sequence = InputSequence()
+                for x in [150,300,450,550,650,750]:
+                    sequence.tap([x,750]).wait(0.1)
+                RunInputSequence(sequence)
                 Sleep(2)
             Sleep(1)
             return (is_success_aoe)
@@ -1393,8 +1561,8 @@ def Factory():
             swipeDir = targetInfo.swipeDir[i]
             if swipeDir!=None:
                 logger.debug(f"拖动地图:{swipeDir[0]} {swipeDir[1]} {swipeDir[2]} {swipeDir[3]}")
-                DeviceShell(f"input swipe {swipeDir[0]} {swipeDir[1]} {swipeDir[2]} {swipeDir[3]}")
-                Sleep(2)
+                Swipe([swipeDir[0],swipeDir[1]],[swipeDir[2],swipeDir[3]])
+                WaitUntil(ScreenStable(), 2, name = "拖动地图")
                 scn = ScreenShot()
             
             targetPos = None
@@ -1406,7 +1574,7 @@ def Factory():
                 targetPos = CheckIf_throughStair(scn,targetInfo)
             else:
                 logger.info(f"搜索{target}...")
-                if targetPos:=CheckIf(scn,target,roi):
+                if targetPos:=CheckIf(scn,target,targetInfo.compiledRoI):
                     logger.info(f'找到了 {target}! {targetPos}')
                     if (target == 'chest') and (swipeDir!= None):
                         logger.debug(f"宝箱热力图: 地图:{setting._FARMTARGET} 方向:{swipeDir} 位置:{targetPos}")
@@ -1417,7 +1585,7 @@ def Factory():
                         # 二次确认也不拖动了 太容易触发bug
                         Sleep(2)
                         Press([1,1255])
-                        targetPos = CheckIf(ScreenShot(),target,roi)
+                        targetPos = CheckIf(ScreenShot(),target,targetInfo.compiledRoI)
                     break
         return targetPos
     def StateMoving_CheckFrozen():
@@ -1436,8 +1604,8 @@ def Factory():
                 logger.info(f"已退出移动状态. 当前状态: {dungState}.")
                 break
             if lastscreen is not None:
-                gray1 = cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY)
-                gray2 = cv2.cvtColor(lastscreen, cv2.COLOR_BGR2GRAY)
+                gray1 = FrameGray(screen)
+                gray2 = FrameGray(lastscreen)
                 mean_diff = cv2.absdiff(gray1, gray2).mean()/255
                 logger.debug(f"移动停止检查:{mean_diff:.2f}")
                 if mean_diff < 0.1:
@@ -1545,12 +1713,11 @@ def Factory():
                         Press(pos)
                         Sleep(1.5)
                         if not setting._SMARTDISARMCHEST:
+                            sequence = InputSequence(pace = 0.3)
                             for _ in range(8):
-                                t = time.time()
-                                Press(disarm)
-                                if time.time()-t<0.3:
-                                    Sleep(0.3-(time.time()-t))
-                                
+                                sequence.tap(disarm)
+                            RunInputSequence(sequence)
+
                         break
                 if not haveBeenTried:
                     haveBeenTried = True
@@ -1685,11 +1852,10 @@ def Factory():
                                     Sleep(1.5)
                                     Press([600,1200])
                                     Sleep(1)
+                                    sequence = InputSequence(pace = 0.3)
                                     for _ in range(5):
-                                        t = time.time()
-                                        PressReturn()
-                                        if time.time()-t<0.3:
-                                            Sleep(0.3-(time.time()-t))
+                                        sequence.key('KEYCODE_BACK')
+                                    RunInputSequence(sequence)
                                     shouldRecover = False
                                     break
                     ########### OPEN MAP
@@ -1740,8 +1906,8 @@ def Factory():
         Press(FindCoordsOrElseExecuteFallbackAndWait('guildFeatured',['guildRequest',[1,1]],1))
         for _ in range(3):
             Sleep(1)
-            DeviceShell(f"input swipe 150 1000 150 200")
-        Sleep(2)
+            Swipe([150,1000],[150,200])
+        WaitUntil(ScreenStable(), 2, name = "滑动列表")
         pos = FindCoordsOrElseExecuteFallbackAndWait(request,['input swipe 150 200 150 250',[1,1]],1)
         if not CheckIf(ScreenShot(),'request_accepted',[[0,pos[1]-200,900,pos[1]+200]]):
             FindCoordsOrElseExecuteFallbackAndWait(['Inn','guildRequest'],[[pos[0]+pressbias[0],pos[1]+pressbias[1]],'return',[1,1]],1)
@@ -1781,6 +1947,11 @@ def Factory():
                         if runtimeContext._COUNTERCOMBAT > 0:
                             summary_text += f"累计战斗{runtimeContext._COUNTERCOMBAT}次.战斗平均用时{round(runtimeContext._TIME_COMBAT_TOTAL/runtimeContext._COUNTERCOMBAT,2)}秒."
                         logger.info(f"{runtimeContext._IMPORTANTINFO}{summary_text}",extra={"summary": True})
+                        TEMPLATE_STORE.log_stats()
+                        HOTSPOTS.log_stats()
+                        MATCH_CACHE.log_stats()
+                        logger.info(f"本圈等待画面节省{waitStats.lap():.1f}秒.")
+                        HOTSPOTS.save(force = True)
                     runtimeContext._LAPTIME = time.time()
                     runtimeContext._COUNTERDUNG+=1
                     if not runtimeContext._MEET_CHEST_OR_COMBAT:
@@ -1825,7 +1996,7 @@ def Factory():
                         Press(FindCoordsOrElseExecuteFallbackAndWait('cursedwheel_impregnableFortress',['cursedWheelTapRight',[1,1]],1))
 
                         if not Press(CheckIf(ScreenShot(),'FortressArrival')):
-                            DeviceShell(f"input swipe 450 1200 450 200")
+                            Swipe([450,1200],[450,200])
                             Press(FindCoordsOrElseExecuteFallbackAndWait('FortressArrival','input swipe 50 1200 50 1300',1))
 
                         while pos:= CheckIf(ScreenShot(), 'leap'):
@@ -1855,7 +2026,7 @@ def Factory():
                         if stepMark == -1:
                             Press(FindCoordsOrElseExecuteFallbackAndWait('guild',[1,1],1))
                             Press(FindCoordsOrElseExecuteFallbackAndWait('7000G/illgonow',[1,1],1))
-                            Sleep(15)
+                            WaitUntil(['7000G/olddist','7000G/iminhungry'], 15)
                             FindCoordsOrElseExecuteFallbackAndWait(['7000G/olddist','7000G/iminhungry'],[1,1],2)
                             if pos:=CheckIf(scn:=ScreenShot(),'7000G/olddist'):
                                 Press(pos)
@@ -1867,7 +2038,7 @@ def Factory():
                             Sleep(4)
                             Press([1,1])
                             Press([1,1])
-                            Sleep(8)
+                            WaitUntil('7000G/royalcapital', 8)
                             Press(FindCoordsOrElseExecuteFallbackAndWait('7000G/royalcapital',[1,1],2))
                             FindCoordsOrElseExecuteFallbackAndWait('intoWorldMap',[1,1],2)
                             stepMark = 1
@@ -2122,11 +2293,10 @@ def Factory():
                                     if CheckIf(ScreenShot(),'recover'):
                                         Sleep(1)
                                         Press([600,1200])
+                                        sequence = InputSequence(pace = 0.3)
                                         for _ in range(5):
-                                            t = time.time()
-                                            PressReturn()
-                                            if time.time()-t<0.3:
-                                                Sleep(0.3-(time.time()-t))
+                                            sequence.key('KEYCODE_BACK')
+                                        RunInputSequence(sequence)
                                         shouldRecover = False
                             ########### light the dark light
                             Press(FindCoordsOrElseExecuteFallbackAndWait('darklight_lightIt','darkLight',1))
@@ -2228,12 +2398,12 @@ def Factory():
                         Press(FindCoordsOrElseExecuteFallbackAndWait('guildRequest',['guild',[1,1]],1))
                         Press(FindCoordsOrElseExecuteFallbackAndWait('guildFeatured',['guildRequest',[1,1]],1))
                         Sleep(1)
-                        DeviceShell(f"input swipe 150 1300 150 200")
-                        Sleep(2)
+                        Swipe([150,1300],[150,200])
+                        WaitUntil(ScreenStable(), 2, name = "滑动列表")
                         while 1:
                             pos = CheckIf(ScreenShot(),'SSC/Request')
                             if not pos:
-                                DeviceShell(f"input swipe 150 200 150 250")
+                                Swipe([150,200],[150,250])
                                 Sleep(1)
                             else:
                                 Press([pos[0]+300,pos[1]+150])
@@ -2572,20 +2742,59 @@ def Factory():
         nonlocal quest
         nonlocal setting # 初始化
         nonlocal runtimeContext
+        nonlocal visionPool
         runtimeContext = RuntimeContext()
 
         setting = set
+        setting._RUNTIMECONTEXT = runtimeContext
+        screenCache.ttl = float(setting._SCREENSHOTTTL)
+        if setting._FLEETINSTANCE is not None:
+            # adb server由所有实例共用, 模拟器按进程名结束会关掉所有实例, 所以fleet模式下只用前几级.
+            for name in SHARED_RECOVERY_RUNGS:
+                adbRecovery.remove(name)
+        SLEEP_PROFILE.calibrating = bool(setting._CALIBRATE)
+        if SLEEP_PROFILE.calibrating:
+            logger.info(f"校准模式: 所有等待都延长到默认值的{SLEEP_PROFILE.max_scale:g}倍, 结束时输出校准报告.")
 
         Sleep(1) # 没有等utils初始化完成
         
         ResetADBDevice()
 
+        TEMPLATE_STORE.preload() # 提前解码所有模板, 之后的CheckIf不再读盘
+
+        if setting._VISIONWORKERS > 0:
+            visionPool = VisionPool(setting._VISIONWORKERS, templateShm = TEMPLATE_PACK.shared_name)
+            SetVisionPool(visionPool)
+
         quest = LoadQuest(setting._FARMTARGET)
         if quest:
-            if quest._TYPE =="dungeon":
-                DungeonFarm()
-            else:
-                QuestFarm()
+            try:
+                if quest._TYPE =="dungeon":
+                    DungeonFarm()
+                else:
+                    QuestFarm()
+            finally:
+                HOTSPOTS.save(force = True)
+                frameStream.log_stats()
+                frameStream.stop()
+                screenCache.log_stats()
+                waitStats.log_stats()
+                SLEEP_PROFILE.save(force = True)
+                if SLEEP_PROFILE.calibrating:
+                    SLEEP_PROFILE.log_report()
+                shellSession.log_stats()
+                shellSession.close()
+                adbRecovery.log_stats()
+                if identifyRules is not None:
+                    identifyRules.log_stats()
+                if visionPool is not None:
+                    SetVisionPool(None)
+                    visionPool.log_stats()
+                    visionPool.close()
+                    visionPool = None
+                if isinstance(setting._ADBDEVICE, AdbdDevice):
+                    setting._ADBDEVICE.close()
+                    setting._ADBDEVICE = None
         else:
             setting._FINISHINGCALLBACK()
     return Farm
\ No newline at end of file
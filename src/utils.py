@@ -2,12 +2,17 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext
 import json
 import os
+import mmap
+import struct
 import logging
 import logging.handlers
 import sys
 import cv2
 import time
+import threading
 import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict
 import numpy as np
 
 # 基础模块包括:
@@ -15,6 +20,8 @@ import numpy as np
 # CONFIG. 保存和写入设置.
 # CHANGES LOG. 弹窗展示更新文档.
 # TOOLTIP. 鼠标悬停时的提示.
+# TEMPLATE STORE. 模板图片的进程内缓存.
+# TEMPLATE PACK. 预先解码的模板打包文件(mmap读取). fleet模式下同样格式的数据放在共享内存中, 所有worker进程共用.
 
 ############################################
 THREE_DAYS_AGO = time.time() - 3 * 24 * 60 * 60
@@ -259,10 +266,280 @@ def BuildQuestReflection():
         raise FileNotFoundError(f"{e}")
 ###########################################
 IMAGE_FOLDER = fr'resources/images/'
+def TemplatePath(shortPathOfTarget):
+    return ResourcePath(os.path.join(IMAGE_FOLDER + f"{shortPathOfTarget}.png"))
+class TemplateStore:
+    """进程内的模板缓存.
+    同一张模板只解码一次, 之后直接返回内存中的数组(只读, 调用方不要修改).
+    文件的mtime发生变化时自动重新加载; 超过内存上限时淘汰最久未使用的模板."""
+    def __init__(self, max_bytes = 64*1024*1024, recheck_interval = 5.0):
+        self.max_bytes = max_bytes
+        self.recheck_interval = recheck_interval # 两次mtime检查之间的最短间隔(秒)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # shortPath -> [image, mtime, last_check]
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.pack_loads = 0
+        self.decode_time = 0.0
+
+    def get(self, shortPathOfTarget):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(shortPathOfTarget)
+            if entry is not None:
+                if now - entry[2] < self.recheck_interval:
+                    self._cache.move_to_end(shortPathOfTarget)
+                    self.hits += 1
+                    return entry[0]
+                entry[2] = now
+        path = TemplatePath(shortPathOfTarget)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        with self._lock:
+            entry = self._cache.get(shortPathOfTarget)
+            if entry is not None:
+                if entry[1] == mtime:
+                    self._cache.move_to_end(shortPathOfTarget)
+                    self.hits += 1
+                    return entry[0]
+                logger.debug(f"模板{shortPathOfTarget}已被修改, 重新加载.")
+                self.invalidations += 1
+                self._remove(shortPathOfTarget)
+            self.misses += 1
+        return self._load(shortPathOfTarget, path, mtime)
+
+    def _load(self, shortPathOfTarget, path, mtime):
+        t = time.perf_counter()
+        img = TEMPLATE_PACK.get(shortPathOfTarget, path)
+        fromPack = img is not None
+        if not fromPack:
+            logger.debug(f"加载{shortPathOfTarget}")
+            img = LoadImage(path)
+        cost = time.perf_counter() - t
+        with self._lock:
+            self.decode_time += cost
+            if fromPack:
+                self.pack_loads += 1
+            if img is None:
+                return None
+            img.flags.writeable = False
+            self._cache[shortPathOfTarget] = [img, mtime, time.time()]
+            self._bytes += img.nbytes
+            while self._bytes > self.max_bytes and len(self._cache) > 1:
+                oldest = next(iter(self._cache))
+                self._remove(oldest)
+                self.evictions += 1
+        return img
+
+    def _remove(self, shortPathOfTarget):
+        entry = self._cache.pop(shortPathOfTarget, None)
+        if entry is not None:
+            self._bytes -= entry[0].nbytes
+
+    def preload(self, shortPaths = None):
+        """预先解码模板. 不指定shortPaths时加载图片目录下的全部模板."""
+        if shortPaths is None:
+            shortPaths = ListTemplates()
+        t = time.perf_counter()
+        for shortPath in shortPaths:
+            self.get(shortPath)
+        logger.debug(f"预加载{len(shortPaths)}个模板, 耗时{time.perf_counter()-t:.3f}秒.")
+
+    def invalidate(self, shortPathOfTarget = None):
+        with self._lock:
+            if shortPathOfTarget is None:
+                self.invalidations += len(self._cache)
+                self._cache.clear()
+                self._bytes = 0
+            elif shortPathOfTarget in self._cache:
+                self.invalidations += 1
+                self._remove(shortPathOfTarget)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "count": len(self._cache),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "pack_loads": self.pack_loads,
+                "decode_time": self.decode_time,
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        logger.debug(f"模板缓存: {s['count']}个/{s['bytes']/1024/1024:.1f}MB, 命中{s['hits']}次, 未命中{s['misses']}次(命中率{s['hit_rate']*100:.1f}%), "
+                     f"淘汰{s['evictions']}次, 失效{s['invalidations']}次, 打包文件加载{s['pack_loads']}次, 累计加载{s['decode_time']:.3f}秒.")
+def ListTemplates():
+    """返回图片目录下所有模板的shortPath(不含扩展名, 使用/分隔)."""
+    root = ResourcePath(IMAGE_FOLDER)
+    shortPaths = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith('.png'):
+                rel = os.path.relpath(os.path.join(dirpath, filename), root)
+                shortPaths.append(os.path.splitext(rel)[0].replace(os.sep, '/'))
+    return sorted(shortPaths)
+###########################################
+TEMPLATE_PACK_FILE = 'resources/templates.pack'
+TEMPLATE_PACK_MAGIC = b'WVDTPAK1'
+TEMPLATE_PACK_ALIGN = 64
+class TemplatePack:
+    """只读的模板打包文件.
+    文件结构: 8字节魔数 + uint32索引长度 + uint32保留 + json索引 + 按64字节对齐的原始BGR数组.
+    索引以shortPath为键, 记录每张模板的偏移, 形状, 以及打包时源png的大小和mtime.
+    运行时整个文件被mmap, 取出的模板是直接指向mmap的只读数组, 不需要解码."""
+    def __init__(self, path = None):
+        self.path = path if path is not None else ResourcePath(TEMPLATE_PACK_FILE)
+        self._file = None
+        self._mmap = None
+        self._index = None
+        self._opened = False
+        self._shared = None
+        self._lock = threading.Lock()
+        self.stale = 0
+
+    def _open(self):
+        self._opened = True
+        if not os.path.exists(self.path):
+            logger.debug(f"模板打包文件不存在: {self.path}, 使用png加载.")
+            return
+        try:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse()
+            logger.debug(f"已映射模板打包文件: {self.path}, 共{len(self._index)}个模板.")
+        except Exception as e:
+            logger.error(f"模板打包文件无法读取, 使用png加载: {e}")
+            self.close()
+
+    def _parse(self):
+        magic, index_length, _ = struct.unpack_from('<8sII', self._mmap, 0)
+        if magic != TEMPLATE_PACK_MAGIC:
+            raise ValueError(f"魔数错误: {magic}")
+        header_size = struct.calcsize('<8sII')
+        entries = json.loads(bytes(self._mmap[header_size:header_size+index_length]).decode('utf-8'))['entries']
+        # 代码中的模板名大小写并不统一(例如'dungflag'和dungFlag.png), windows下按文件名加载时不受影响, 这里保持一致.
+        self._index = {k.lower(): v for k, v in entries.items()}
+
+    def attach_shared(self, name):
+        """改为使用共享内存中的模板(见ShareTemplatePack), 不再打开打包文件."""
+        with self._lock:
+            self.close()
+            self._opened = True
+            try:
+                self._shared = shared_memory.SharedMemory(name=name)
+                self._mmap = self._shared.buf
+                self._parse()
+                logger.debug(f"已连接共享内存中的模板: {name}, 共{len(self._index)}个模板.")
+            except Exception as e:
+                logger.error(f"共享内存中的模板无法读取, 使用png加载: {e}")
+                self.close()
+
+    @property
+    def shared_name(self):
+        """正在使用的共享内存的名字, 没有使用共享内存时为None."""
+        return self._shared.name if self._shared is not None else None
+
+    def close(self):
+        if self._shared is not None:
+            self._mmap = None
+            self._shared.close()
+        elif self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+        self._shared = None
+        self._mmap = None
+        self._file = None
+        self._index = None
+
+    def get(self, shortPathOfTarget, pngPath = None):
+        """返回打包文件中的模板; 不存在或已过期(源png被修改过)时返回None."""
+        with self._lock:
+            if not self._opened:
+                self._open()
+            if self._index is None:
+                return None
+            entry = self._index.get(shortPathOfTarget.lower())
+            if entry is None:
+                return None
+            if pngPath is not None and os.path.exists(pngPath):
+                st = os.stat(pngPath)
+                # 打包环境下解压出来的文件mtime不可靠, 只比较大小.
+                if (st.st_size != entry['size']) or ((not hasattr(sys, '_MEIPASS')) and int(st.st_mtime) != entry['mtime']):
+                    logger.debug(f"模板打包文件中的{shortPathOfTarget}已过期, 使用png加载.")
+                    self.stale += 1
+                    return None
+            count = int(np.prod(entry['shape']))
+            img = np.frombuffer(self._mmap, dtype=np.uint8, count=count, offset=entry['offset'])
+            return img.reshape(entry['shape'])
+def _TemplatePackLayout():
+    """解码图片目录下的全部模板并排好位置. 返回(索引, [(偏移, 数组)], 总长度)."""
+    def align(n):
+        return (n + TEMPLATE_PACK_ALIGN - 1) // TEMPLATE_PACK_ALIGN * TEMPLATE_PACK_ALIGN
+    images = []
+    for shortPath in ListTemplates():
+        path = TemplatePath(shortPath)
+        img = LoadImage(path)
+        if img is None:
+            continue
+        st = os.stat(path)
+        images.append((shortPath, np.ascontiguousarray(img), st.st_size, int(st.st_mtime)))
+
+    # 索引里的偏移依赖索引自身的长度, 因此先用占位的偏移算出长度, 再回填.
+    entries = {shortPath: {'offset': 0, 'shape': list(img.shape), 'size': size, 'mtime': mtime} for shortPath, img, size, mtime in images}
+    header_size = struct.calcsize('<8sII')
+    while True:
+        index_bytes = json.dumps({'version': 1, 'entries': entries}, ensure_ascii=False).encode('utf-8')
+        offset = align(header_size + len(index_bytes))
+        changed = False
+        for shortPath, img, _, _ in images:
+            if entries[shortPath]['offset'] != offset:
+                entries[shortPath]['offset'] = offset
+                changed = True
+            offset = align(offset + img.nbytes)
+        if not changed:
+            break
+    return index_bytes, [(entries[shortPath]['offset'], img) for shortPath, img, _, _ in images], offset
+def BuildTemplatePack(outPath = None):
+    """将图片目录下的全部模板解码后写入一个打包文件. 在打包(pyinstaller)之前运行."""
+    outPath = outPath if outPath is not None else ResourcePath(TEMPLATE_PACK_FILE)
+    index_bytes, blobs, _ = _TemplatePackLayout()
+
+    with open(outPath, 'wb') as f:
+        f.write(struct.pack('<8sII', TEMPLATE_PACK_MAGIC, len(index_bytes), 0))
+        f.write(index_bytes)
+        for offset, img in blobs:
+            f.seek(offset)
+            f.write(img.tobytes())
+    logger.info(f"模板打包完成: {outPath}, 共{len(blobs)}个模板, {os.path.getsize(outPath)/1024/1024:.1f}MB.")
+    return outPath
+def ShareTemplatePack():
+    """把全部模板按打包文件的格式放进共享内存, 其他进程用TEMPLATE_PACK.attach_shared(name)读取.
+    返回SharedMemory, 调用方负责close()和unlink()."""
+    index_bytes, blobs, size = _TemplatePackLayout()
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    header = struct.pack('<8sII', TEMPLATE_PACK_MAGIC, len(index_bytes), 0)
+    shm.buf[:len(header)] = header
+    shm.buf[len(header):len(header)+len(index_bytes)] = index_bytes
+    for offset, img in blobs:
+        np.frombuffer(shm.buf, dtype=np.uint8, count=img.nbytes, offset=offset)[:] = img.reshape(-1)
+    logger.info(f"模板已放入共享内存: {shm.name}, 共{len(blobs)}个模板, {size/1024/1024:.1f}MB.")
+    return shm
+TEMPLATE_PACK = TemplatePack()
+TEMPLATE_STORE = TemplateStore()
 def LoadTemplateImage(shortPathOfTarget):
-    logger.debug(f"加载{shortPathOfTarget}")
-    pathOfTarget = ResourcePath(os.path.join(IMAGE_FOLDER + f"{shortPathOfTarget}.png"))
-    return LoadImage(pathOfTarget)
+    return TEMPLATE_STORE.get(shortPathOfTarget)
 ###########################################
 class Tooltip:
     def __init__(self, widget, text):
@@ -0,0 +1,670 @@
+import cv2
+import numpy as np
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import *
+
+# 图像匹配的基础模块包括:
+# ROI. 预编译的搜索区域(视图+涂抹列表), 匹配只在搜索范围附近的视图上进行, 不复制整帧.
+# MATCH PLAN. 在同一帧上批量匹配多个模板, 在线程池中并行执行(OpenCV匹配时会释放GIL).
+# HOTSPOT. 记录每个模板出现过的位置, 之后优先在该位置附近搜索, 没找到再搜索整帧.
+# PYRAMID. 大模板先在缩小的画面上粗匹配, 再在原分辨率的小窗口内确认.
+# CHANNEL. 按模板选择灰度/单通道/BGR匹配, 派生出的画面每帧只计算一次.
+# MATCH CACHE. 画面按块比较, 匹配结果按(模板, roi)缓存, 依赖的区域没有变化时直接复用.
+# VISION POOL. 可选的多进程匹配(visionpool.py), 设置后MatchPlan交给它执行.
+
+############################################
+MATCH_THRESHOLD = 0.80
+def ClipRect(rect, frameShape):
+    """将[x,y,w,h]裁剪到画面内, 返回(x0,y0,x1,y1). 裁剪后为空时返回None."""
+    img_height, img_width = frameShape[:2]
+    x, y, w, h = rect
+    x0 = max(0, x)
+    y0 = max(0, y)
+    x1 = min(img_width, x + w)
+    y1 = min(img_height, y + h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+# 地图界面的默认排除区域: 上下的菜单栏, 左右两侧和上下中间的按钮. 'default'和宝箱的roi都会加上这些.
+MAP_ROI_EXCLUSIONS = [[0,0,900,208],[0,1265,900,335],[0,636,137,222],[763,636,137,222], [336,208,228,77],[336,1168,228,97]]
+def CutRoI(screenshot,roi):
+    # 原地涂抹: roi[0]之外填充255, 其余矩形内填充0. 只用切片赋值, 不分配整帧大小的掩码.
+    # 这是RoI匹配的参照语义. 匹配请直接使用MatchTemplate, 这里只保留给需要整帧比较的地方(例如因果界面的滑动检测)
+    # 和benchmark.py roi的对照.
+    if roi is None:
+        return screenshot
+
+    img_height, img_width = screenshot.shape[:2]
+    roi1_rect = roi[0]  # 第一个矩形 (x, y, width, height)
+
+    clipped = ClipRect(roi1_rect, screenshot.shape)
+    if clipped is None:
+        screenshot[:] = 255
+    else:
+        x0, y0, x1, y1 = clipped
+        screenshot[:y0] = 255
+        screenshot[y1:] = 255
+        screenshot[y0:y1, :x0] = 255
+        screenshot[y0:y1, x1:] = 255
+
+    for roi2_rect in roi[1:]:
+        clipped = ClipRect(roi2_rect, screenshot.shape)
+        if clipped is not None:
+            x0, y0, x1, y1 = clipped
+            # 将位于 roi2 中的像素设置为0
+            # (如果这些像素之前因为不在roi1中已经被设为0，则此操作无额外效果)
+            screenshot[y0:y1, x0:x1] = 0
+
+    # cv2.imwrite(f'CutRoI_{time.time()}.png', screenshot)
+    return screenshot
+class RoI:
+    """搜索区域. rects[0]是搜索范围, 其余的矩形是排除区域.
+    与原先的CutRoI相同: 搜索范围以外的像素视为白色(255), 排除区域内的像素视为黑色(0),
+    模板窗口可以部分超出搜索范围或与排除区域部分重叠. 不同的是不再复制和涂抹整帧:
+    只在与搜索范围有交集的模板窗口所覆盖的视图(搜索范围向外扩展模板尺寸-1)上匹配, 只涂抹这个视图的副本.
+    完全落在搜索范围以外的窗口只包含涂抹的颜色, 原先也只能匹配到涂抹出来的图案, 这里不再搜索.
+    视图和涂抹列表按(画面尺寸, 模板尺寸)编译一次后缓存."""
+    def __init__(self, rects):
+        self.rects = [list(r) for r in rects]
+        self._compiled = {}
+
+    def compile(self, frameShape, templateShape):
+        """返回(x0,y0,x1,y1,paints), paints为[(x0,y0,x1,y1,颜色)], 均为整帧坐标. 搜索范围为空或模板放不进视图时返回None."""
+        key = (frameShape[:2], templateShape[:2])
+        if key in self._compiled:
+            return self._compiled[key]
+        compiled = None
+        search = ClipRect(self.rects[0], frameShape)
+        th, tw = templateShape[:2]
+        if search is not None:
+            sx0, sy0, sx1, sy1 = search
+            view = ClipRect([sx0-tw+1, sy0-th+1, sx1-sx0+2*(tw-1), sy1-sy0+2*(th-1)], frameShape)
+            x0, y0, x1, y1 = view
+            if (x1-x0 >= tw) and (y1-y0 >= th):
+                # 搜索范围以外: 上下两条和左右两条.
+                paints = [(x0, y0, x1, sy0, 255), (x0, sy1, x1, y1, 255), (x0, sy0, sx0, sy1, 255), (sx1, sy0, x1, sy1, 255)]
+                for rect in self.rects[1:]:
+                    ex = ClipRect(rect, frameShape)
+                    if ex is not None:
+                        paints.append((max(x0, ex[0]), max(y0, ex[1]), min(x1, ex[2]), min(y1, ex[3]), 0))
+                paints = [p for p in paints if p[0] < p[2] and p[1] < p[3]]
+                compiled = (x0, y0, x1, y1, paints)
+        self._compiled[key] = compiled
+        return compiled
+############################################
+# 按模板配置的匹配方式. 不在表中的模板使用默认方式(BGR三通道, 整帧原分辨率).
+# pyramid: 缩小倍数. 先在缩小后的画面上找到最佳候选, 再在原分辨率下确认, 返回的分数仍是原分辨率的分数.
+# channel: 'gray'(灰度), 'b'/'g'/'r'(单一通道) 或 'bgr'(默认). 单通道匹配的开销约为三通道的1/3.
+#          依赖颜色区分的模板(例如WrapImage加权后匹配的因果选项, chestfear, combatAuto)不要放进来.
+#          目前只有几乎没有颜色的地名文字(平均饱和度低于15/255)使用灰度. 状态标志和按钮保持BGR:
+#          其他模板要先用真实截图运行benchmark.py channel --frames确认没有不一致再加进来.
+# 键不区分大小写(代码中存在'dungflag'/'dungFlag'等写法).
+TEMPLATE_MATCH_OPTIONS = {
+    'Inn':                  {'pyramid': 2},
+    'RoyalCityLuknalia':    {'pyramid': 2},
+    'cursedWheel_timeLeap': {'pyramid': 2},
+    'fortressworldmap':     {'pyramid': 2},
+    'EdgeOfTown':           {'pyramid': 2},
+    'GhostsOfYore':         {'pyramid': 4},
+    'Triumph':              {'pyramid': 2},
+    'retry_blank':          {'pyramid': 4},
+    'multipeopledead':      {'pyramid': 2},
+    'notenoughsp':          {'pyramid': 4},
+    'notenoughmp':          {'pyramid': 4},
+    'GHB/GHB':              {'pyramid': 4},
+    'LBC/LBC':              {'pyramid': 4},
+    'SSC/SSC':              {'pyramid': 2},
+    'COS/COS':              {'pyramid': 2, 'channel': 'gray'},
+    'DOE':                  {'pyramid': 2, 'channel': 'gray'},
+    'DOF':                  {'pyramid': 2, 'channel': 'gray'},
+    'DOL':                  {'pyramid': 2, 'channel': 'gray'},
+    'DOW':                  {'pyramid': 2, 'channel': 'gray'},
+    'Dist':                 {'pyramid': 2},
+    '7thDist':              {'pyramid': 2, 'channel': 'gray'},
+    'B2FTemple':            {'pyramid': 2, 'channel': 'gray'},
+    'B4FLabyrinth':         {'pyramid': 2, 'channel': 'gray'},
+    'beginningAbyss':       {'pyramid': 2, 'channel': 'gray'},
+    'impregnableFortress':  {'pyramid': 2, 'channel': 'gray'},
+    'SH_cave':              {'pyramid': 2, 'channel': 'gray'},
+}
+_TEMPLATE_MATCH_OPTIONS_LOWER = {k.lower(): v for k, v in TEMPLATE_MATCH_OPTIONS.items()}
+def TemplateOption(shortPath, key, default = None):
+    if shortPath is None:
+        return default
+    return _TEMPLATE_MATCH_OPTIONS_LOWER.get(shortPath.lower(), {}).get(key, default)
+############################################
+# 由画面派生出的图像(灰度, 单通道, 缩小, 通道加权)在同一帧内只计算一次.
+# 截图得到的画面是Frame, 派生图像和匹配结果直接缓存在这一帧上, 随帧一起释放.
+# 其他数组使用最近几帧的缓存. 缓存持有原图的引用, 所以用is判断是同一帧是可靠的(原图不会被回收后地址复用).
+_VIEW_LOCK = threading.Lock()
+_FRAME_VIEWS = [] # [(frame, key, view)] 最近的派生图像
+_TEMPLATE_VIEWS = {} # (shortPath, key) -> (template, view)
+CHANNEL_INDEX = {'b': 0, 'g': 1, 'r': 2}
+class Frame(np.ndarray):
+    """一帧画面. 派生图像(FrameView)和(模板, roi)的匹配结果(MatchOnFrame)在这一帧的生命周期内只计算一次.
+    画面内容不能再被修改; 需要涂改时先copy()(得到缓存为空的新Frame)."""
+    def __array_finalize__(self, obj):
+        # 切片, copy等得到的是新的画面, 不继承缓存.
+        self._views = {}
+        self._matches = {}
+def AsFrame(image):
+    return image if (image is None) or isinstance(image, Frame) else image.view(Frame)
+def _ComputeView(image, key):
+    kind, arg = key
+    if kind == 'channel':
+        if arg == 'gray':
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return np.ascontiguousarray(image[:, :, CHANNEL_INDEX[arg]])
+    if kind == 'scale':
+        return cv2.resize(image, (image.shape[1]//arg, image.shape[0]//arg), interpolation=cv2.INTER_AREA)
+    if kind == 'weight':
+        # 各通道乘以(r, g, b)权重, 用于按颜色区分的模板. 结果本身也是一帧, 之后在它上面的匹配同样会被缓存.
+        r, g, b = arg
+        return AsFrame(np.clip(np.asarray(image) * np.array([b, g, r]), 0, 255).astype(np.uint8))
+    raise ValueError(f"未知的派生图像: {key}")
+def FrameView(screenImage, key):
+    if isinstance(screenImage, Frame):
+        view = screenImage._views.get(key)
+        if view is None:
+            view = _ComputeView(screenImage, key)
+            with _VIEW_LOCK:
+                view = screenImage._views.setdefault(key, view)
+        return view
+    with _VIEW_LOCK:
+        for frame, k, view in _FRAME_VIEWS:
+            if frame is screenImage and k == key:
+                return view
+    view = _ComputeView(screenImage, key)
+    with _VIEW_LOCK:
+        _FRAME_VIEWS.insert(0, (screenImage, key, view))
+        del _FRAME_VIEWS[8:]
+    return view
+def FrameGray(screenImage):
+    return FrameView(screenImage, ('channel', 'gray'))
+def FrameWeighted(screenImage, r, g, b):
+    return FrameView(screenImage, ('weight', (r, g, b)))
+def TemplateView(shortPath, template, key):
+    cache_key = (shortPath, key)
+    with _VIEW_LOCK:
+        cached = _TEMPLATE_VIEWS.get(cache_key)
+        if cached is not None and cached[0] is template:
+            return cached[1]
+    view = _ComputeView(template, key)
+    with _VIEW_LOCK:
+        _TEMPLATE_VIEWS[cache_key] = (template, view)
+    return view
+def ReleaseViews():
+    """丢弃所有派生图像. 之后才能关闭这些图像所在的共享内存."""
+    with _VIEW_LOCK:
+        _FRAME_VIEWS.clear()
+        _TEMPLATE_VIEWS.clear()
+    MATCH_CACHE.release()
+def DownscaledFrame(screenImage, scale):
+    return FrameView(screenImage, ('scale', scale))
+def DownscaledTemplate(shortPath, template, scale):
+    return TemplateView(shortPath, template, ('scale', scale))
+def ChannelViews(screenImage, template, shortPath):
+    """按模板的channel配置返回(画面, 模板). 画面的单通道版本每帧只计算一次."""
+    mode = TemplateOption(shortPath, 'channel', 'bgr')
+    if mode == 'bgr' or screenImage.ndim != 3:
+        return screenImage, template
+    key = ('channel', mode)
+    return FrameView(screenImage, key), TemplateView(shortPath, template, key)
+############################################
+PYRAMID_REJECT = 0.5 # 粗匹配分数低于该值时直接视为不存在, 不再确认
+def MatchTemplatePyramid(screenImage, template, shortPath, scale):
+    """与MatchTemplate(无roi)的返回值相同. 粗匹配找到候选位置后, 在候选附近±2*scale像素的窗口内用原分辨率确认."""
+    small_frame = DownscaledFrame(screenImage, scale)
+    small_template = DownscaledTemplate(shortPath, template, scale)
+    result = cv2.matchTemplate(small_frame, small_template, cv2.TM_CCOEFF_NORMED)
+    _, coarse_val, _, coarse_loc = cv2.minMaxLoc(result)
+    if coarse_val < PYRAMID_REJECT:
+        return coarse_val, (coarse_loc[0]*scale, coarse_loc[1]*scale)
+    th, tw = template.shape[:2]
+    img_height, img_width = screenImage.shape[:2]
+    pad = 2*scale
+    x0 = max(0, coarse_loc[0]*scale - pad)
+    y0 = max(0, coarse_loc[1]*scale - pad)
+    x1 = min(img_width, coarse_loc[0]*scale + tw + pad)
+    y1 = min(img_height, coarse_loc[1]*scale + th + pad)
+    result = cv2.matchTemplate(screenImage[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    return max_val, (max_loc[0] + x0, max_loc[1] + y0)
+############################################
+_ROI_CACHE = {}
+def CompileRoI(roi):
+    """将[[x,y,w,h],...]形式的roi转换为RoI, 相同的roi共用同一个对象(以及其中的掩码缓存)."""
+    if roi is None or isinstance(roi, RoI):
+        return roi
+    key = tuple(tuple(r) for r in roi)
+    compiled = _ROI_CACHE.get(key)
+    if compiled is None:
+        if len(_ROI_CACHE) > 256:
+            _ROI_CACHE.clear()
+        compiled = _ROI_CACHE[key] = RoI(roi)
+    return compiled
+def MatchTemplate(screenImage, template, roi = None, shortPath = None, window = None):
+    """在画面(或roi的视图)上匹配模板. 返回(max_val, max_loc), max_loc为整帧坐标系下模板左上角.
+    模板无法放入搜索区域时返回(0.0, None). 提供shortPath时按TEMPLATE_MATCH_OPTIONS选择匹配方式.
+    window: (x0,y0,x1,y1), 只搜索完全落在其中的模板窗口(用于局部重算), 涂抹仍按roi进行."""
+    roi = CompileRoI(roi)
+    screenImage, template = ChannelViews(screenImage, template, shortPath)
+    if roi is None and window is not None:
+        x0, y0, x1, y1 = window
+        if (x1-x0 < template.shape[1]) or (y1-y0 < template.shape[0]):
+            return 0.0, None
+        result = cv2.matchTemplate(screenImage[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        return max_val, (max_loc[0] + x0, max_loc[1] + y0)
+    if roi is None:
+        if scale := TemplateOption(shortPath, 'pyramid'):
+            return MatchTemplatePyramid(screenImage, template, shortPath, scale)
+        result = cv2.matchTemplate(screenImage, template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        return max_val, max_loc
+    compiled = roi.compile(screenImage.shape, template.shape)
+    if compiled is None:
+        return 0.0, None
+    x0, y0, x1, y1, paints = compiled
+    if window is not None:
+        x0, y0, x1, y1 = max(x0, window[0]), max(y0, window[1]), min(x1, window[2]), min(y1, window[3])
+        th, tw = template.shape[:2]
+        if (x1-x0 < tw) or (y1-y0 < th):
+            return 0.0, None
+    view = screenImage[y0:y1, x0:x1]
+    paints = [(max(x0, p[0]), max(y0, p[1]), min(x1, p[2]), min(y1, p[3]), p[4]) for p in paints]
+    paints = [p for p in paints if p[0] < p[2] and p[1] < p[3]]
+    if paints:
+        view = view.copy()
+        for px0, py0, px1, py1, color in paints:
+            view[py0-y0:py1-y0, px0-x0:px1-x0] = color
+    result = cv2.matchTemplate(view, template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    return max_val, (max_loc[0] + x0, max_loc[1] + y0)
+############################################
+HOTSPOT_FILE = 'hotspots.json'
+class HotspotIndex:
+    """每个模板的热点区域.
+    记录模板每次命中时的左上角坐标范围(box). 命中范围足够集中(不超过max_spread)时,
+    之后的无roi搜索先在box附近(外扩margin)匹配, 达到阈值直接返回, 否则再搜索整帧.
+    在地图上到处出现的模板(例如宝箱)范围会超过max_spread, 之后被标记为roaming, 不再使用热点.
+    结果保存在HOTSPOT_FILE中, 下次启动继续使用."""
+    def __init__(self, path = HOTSPOT_FILE, max_spread = 60, margin = 8, min_samples = 2):
+        self.path = path
+        self.max_spread = max_spread
+        self.margin = margin
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._spots = LoadJson(path)
+        self._roi = {}
+        self._dirty = False
+        self._last_save = time.time()
+        self._full_cost = {} # 每个模板整帧匹配的平均耗时, 用来估算节省的时间
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+
+    def _region(self, shortPath, frameShape, templateShape):
+        spot = self._spots.get(shortPath)
+        if (spot is None) or spot['roaming'] or (spot['samples'] < self.min_samples) or (spot['frame'] != list(frameShape[:2])):
+            return None
+        key = (shortPath, tuple(spot['box']))
+        if key not in self._roi:
+            x0, y0, x1, y1 = spot['box']
+            th, tw = templateShape[:2]
+            self._roi[key] = RoI([[x0-self.margin, y0-self.margin, x1-x0+tw+2*self.margin, y1-y0+th+2*self.margin]])
+        return self._roi[key]
+
+    def _record(self, shortPath, frameShape, loc):
+        spot = self._spots.get(shortPath)
+        if (spot is None) or (spot['frame'] != list(frameShape[:2])):
+            self._spots[shortPath] = {'frame': list(frameShape[:2]), 'box': [loc[0], loc[1], loc[0], loc[1]], 'samples': 1, 'roaming': False}
+            self._dirty = True
+            return
+        if spot['roaming']:
+            return
+        x0, y0, x1, y1 = spot['box']
+        box = [min(x0, loc[0]), min(y0, loc[1]), max(x1, loc[0]), max(y1, loc[1])]
+        spot['samples'] += 1
+        if box != spot['box']:
+            spot['box'] = box
+            if (box[2]-box[0] > self.max_spread) or (box[3]-box[1] > self.max_spread):
+                spot['roaming'] = True
+                logger.debug(f"{shortPath}出现的位置不固定, 不再使用热点区域.")
+            self._dirty = True
+
+    def record(self, shortPath, frameShape, loc):
+        """记录在别处(例如VisionPool的worker进程中)得到的命中位置."""
+        with self._lock:
+            self._record(shortPath, frameShape, loc)
+
+    def match(self, screenImage, shortPath, template, threshold = MATCH_THRESHOLD):
+        """与MatchTemplate(无roi)相同的返回值, 但优先搜索热点区域."""
+        with self._lock:
+            roi = self._region(shortPath, screenImage.shape, template.shape)
+        if roi is not None:
+            t = time.perf_counter()
+            max_val, max_loc = MatchTemplate(screenImage, template, roi, shortPath)
+            cost = time.perf_counter() - t
+            with self._lock:
+                if max_loc is not None and max_val >= threshold:
+                    self.hits += 1
+                    self.saved_time += self._full_cost.get(shortPath, cost) - cost
+                    return max_val, max_loc
+                self.misses += 1
+                self.saved_time -= cost
+        t = time.perf_counter()
+        max_val, max_loc = MatchTemplate(screenImage, template, shortPath = shortPath)
+        cost = time.perf_counter() - t
+        with self._lock:
+            last = self._full_cost.get(shortPath)
+            self._full_cost[shortPath] = cost if last is None else last*0.8 + cost*0.2
+            if max_val >= threshold:
+                self._record(shortPath, screenImage.shape, max_loc)
+        return max_val, max_loc
+
+    def use_file(self, path):
+        """改为读写path. path还不存在时保留当前已经载入的热点, 之后保存到path."""
+        with self._lock:
+            self.path = path
+            if os.path.exists(path):
+                self._spots = LoadJson(path)
+                self._roi = {}
+                self._dirty = False
+
+    def save(self, force = False):
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._last_save < 60):
+                return
+            data = json.loads(json.dumps(self._spots))
+            self._dirty = False
+            self._last_save = time.time()
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+        except Exception as e:
+            logger.error(f"保存热点区域时发生错误: {e}")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "templates": sum(1 for spot in self._spots.values() if not spot['roaming'] and spot['samples'] >= self.min_samples),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_time": self.saved_time,
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        logger.debug(f"热点区域: {s['templates']}个模板, 命中{s['hits']}次, 未命中{s['misses']}次(命中率{s['hit_rate']*100:.1f}%), 估计节省{s['saved_time']:.3f}秒.")
+HOTSPOTS = HotspotIndex()
+############################################
+TILE_SIZE = 100 # 1600x900的画面分为16x9块
+TILE_DIFF_THRESHOLD = 4 # 块内像素差的最大值超过该值才算变化
+class MatchCache:
+    """相邻两帧经常完全相同, 或者只有一小块动画区域不同. 这里把画面分块, 与上一帧逐块比较,
+    记录每一块最后一次变化时的generation; 匹配结果按(模板, roi)缓存, 连同计算时的generation.
+    再次查询时:
+      搜索区域内没有块变化          -> 直接复用(reuse).
+      只有一小部分块变化, 且上次的最佳位置不在变化的块上 -> 只在变化的块附近重新匹配, 与上次的结果取最大值(partial).
+      其他情况                      -> 重新完整匹配(miss).
+    TM_CCOEFF_NORMED在某个位置的分数只取决于该位置的模板窗口, 所以局部重算与完整匹配得到的最大值相同."""
+    def __init__(self, tile = TILE_SIZE, diff_threshold = TILE_DIFF_THRESHOLD, max_entries = 512, partial_ratio = 0.5):
+        self.tile = tile
+        self.diff_threshold = diff_threshold
+        self.max_entries = max_entries
+        self.partial_ratio = partial_ratio # 需要重算的面积超过搜索区域的这一比例时, 直接完整匹配
+        self._lock = threading.Lock()
+        self._frame = None # 最近一帧本身, 用is判断是否是同一帧
+        self._pixels = None # 每一块最后一次变化时的内容, 用于比较
+        self._changed = None # 每一块最后一次变化时的generation
+        self._rows = None
+        self._cols = None
+        self._entries = OrderedDict() # (shortPath, roi矩形) -> (generation, score, loc, template)
+        self.generation = 0
+        self.frames = 0
+        self.identical_frames = 0
+        self.changed_tiles = 0
+        self.reuses = 0
+        self.partials = 0
+        self.misses = 0
+        self.frame_hits = 0 # 同一帧上重复的查询(见MatchOnFrame), 不经过这里的缓存
+        self.diff_time = 0.0
+
+    def _observe(self, screenImage):
+        # 调用时持有self._lock
+        if screenImage is self._frame:
+            return
+        t = time.perf_counter()
+        if self._pixels is None or self._pixels.shape != screenImage.shape:
+            self._rows = np.arange(0, screenImage.shape[0], self.tile)
+            self._cols = np.arange(0, screenImage.shape[1], self.tile)
+            self.generation += 1
+            self._changed = np.full((len(self._rows), len(self._cols)), self.generation)
+            self._pixels = screenImage.copy()
+            self._entries.clear()
+        else:
+            # 各通道展开到同一行中, 按块的列边界(乘以通道数)取最大值, 不需要先在通道间取最大值.
+            height = screenImage.shape[0]
+            channels = screenImage.shape[2] if screenImage.ndim == 3 else 1
+            diff = cv2.absdiff(screenImage, self._pixels).reshape(height, -1)
+            if height % self.tile == 0:
+                rowMax = diff.reshape(height // self.tile, self.tile, -1).max(axis=1)
+            else:
+                rowMax = np.maximum.reduceat(diff, self._rows, axis=0)
+            tiles = np.maximum.reduceat(rowMax, self._cols * channels, axis=1) > self.diff_threshold
+            # 只更新变化了的块: 每一块都与它上次变化时的内容比较, 缓慢的渐变累积超过阈值后也会被发现.
+            if tiles.all():
+                np.copyto(self._pixels, screenImage)
+            else:
+                size = self.tile
+                for ty, tx in zip(*np.nonzero(tiles)):
+                    y, x = ty * size, tx * size
+                    self._pixels[y:y+size, x:x+size] = screenImage[y:y+size, x:x+size]
+            if tiles.any():
+                self.generation += 1
+                self._changed[tiles] = self.generation
+                self.changed_tiles += int(tiles.sum())
+            else:
+                self.identical_frames += 1
+        self._frame = screenImage
+        self.frames += 1
+        self.diff_time += time.perf_counter() - t
+
+    def release(self):
+        """丢弃对最近一帧和模板的引用(例如它们在将要关闭的共享内存中). 之后的查询重新匹配."""
+        with self._lock:
+            self._frame = None
+            self._entries.clear()
+
+    def _changed_box(self, generation, rect):
+        """rect(x0,y0,x1,y1)内generation之后变化过的块的外接矩形(像素), 没有变化时返回None."""
+        x0, y0, x1, y1 = rect
+        t = self.tile
+        ty0, tx0 = y0 // t, x0 // t
+        changed = self._changed[ty0:(y1 - 1) // t + 1, tx0:(x1 - 1) // t + 1] > generation
+        if not changed.any():
+            return None
+        ys = np.flatnonzero(changed.any(axis=1))
+        xs = np.flatnonzero(changed.any(axis=0))
+        return ((tx0 + xs[0]) * t, (ty0 + ys[0]) * t, (tx0 + xs[-1] + 1) * t, (ty0 + ys[-1] + 1) * t)
+
+    def match(self, screenImage, shortPath, template, roi, compute):
+        """compute()为完整匹配, 返回(max_val, max_loc). 返回值与compute()相同."""
+        roi = CompileRoI(roi)
+        key = (shortPath, None if roi is None else tuple(tuple(r) for r in roi.rects))
+        with self._lock:
+            self._observe(screenImage)
+            generation = self.generation
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not template:
+                entry = None # 模板被重新加载过
+            plan = None
+            if entry is not None:
+                _, score, loc, _ = entry
+                th, tw = template.shape[:2]
+                region = (0, 0, screenImage.shape[1], screenImage.shape[0])
+                if roi is not None:
+                    # 只有搜索范围内的像素会影响分数(其余像素被涂抹), 但模板窗口可以覆盖整个视图.
+                    compiled = roi.compile(screenImage.shape, template.shape)
+                    search = ClipRect(roi.rects[0], screenImage.shape)
+                    region = compiled[:4] if compiled is not None else None
+                box = self._changed_box(entry[0], search if roi is not None else region) if region is not None else None
+                if box is None or loc is None:
+                    # loc为None: 模板放不进搜索区域, 与画面内容无关.
+                    plan = 'reuse'
+                elif self._changed_box(entry[0], (loc[0], loc[1], loc[0] + tw, loc[1] + th)) is None:
+                    # 可能与变化的块重叠的模板窗口: 左上角在[box[0]-tw+1, box[2])之内.
+                    sub = (max(region[0], box[0] - tw + 1), max(region[1], box[1] - th + 1),
+                           min(region[2], box[2] + tw - 1), min(region[3], box[3] + th - 1))
+                    if (sub[2] - sub[0]) * (sub[3] - sub[1]) <= self.partial_ratio * (region[2] - region[0]) * (region[3] - region[1]):
+                        plan = 'partial'
+            if plan == 'reuse':
+                self.reuses += 1
+                self._entries.move_to_end(key)
+                return score, loc
+            if plan == 'partial':
+                self.partials += 1
+            else:
+                self.misses += 1
+        if plan == 'partial':
+            new_val, new_loc = MatchTemplate(screenImage, template, roi, shortPath, window = sub)
+            if new_loc is not None and new_val > score:
+                score, loc = new_val, new_loc
+        else:
+            score, loc = compute()
+        with self._lock:
+            self._entries[key] = (generation, score, loc, template)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return score, loc
+
+    def stats(self):
+        with self._lock:
+            total = self.reuses + self.partials + self.misses
+            tiles = self._changed.size if self._changed is not None else 0
+            return {
+                "frames": self.frames,
+                "identical_frames": self.identical_frames,
+                "changed_tile_ratio": self.changed_tiles / (tiles * self.frames) if tiles and self.frames else 0.0,
+                "reuses": self.reuses,
+                "partials": self.partials,
+                "misses": self.misses,
+                "reuse_rate": (self.reuses + self.partials) / total if total else 0.0,
+                "frame_hits": self.frame_hits,
+                "diff_time": self.diff_time,
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        logger.debug(f"匹配缓存: {s['frames']}帧(完全相同{s['identical_frames']}帧, 平均变化{s['changed_tile_ratio']*100:.1f}%的块), "
+                     f"复用{s['reuses']}次, 局部重算{s['partials']}次, 完整匹配{s['misses']}次(复用率{s['reuse_rate']*100:.1f}%), 同一帧重复查询{s['frame_hits']}次, 比较耗时{s['diff_time']:.3f}秒.")
+MATCH_CACHE = MatchCache()
+def MatchOnFrame(screenImage, shortPath, template, roi = None, threshold = MATCH_THRESHOLD):
+    """CheckIf和MatchPlan共用的匹配入口. 没有roi时优先搜索热点区域; 结果经过MATCH_CACHE.
+    画面是Frame时, 同一帧上相同的(模板, roi)只匹配一次."""
+    if roi is None:
+        compute = lambda: HOTSPOTS.match(screenImage, shortPath, template, threshold)
+    else:
+        compute = lambda: MatchTemplate(screenImage, template, roi, shortPath)
+    if not isinstance(screenImage, Frame):
+        return MATCH_CACHE.match(screenImage, shortPath, template, roi, compute)
+    rects = roi.rects if isinstance(roi, RoI) else roi
+    key = (shortPath, None if rects is None else tuple(tuple(r) for r in rects))
+    cached = screenImage._matches.get(key)
+    if cached is not None and cached[0] is template:
+        MATCH_CACHE.frame_hits += 1
+        return cached[1]
+    result = MATCH_CACHE.match(screenImage, shortPath, template, roi, compute)
+    screenImage._matches[key] = (template, result)
+    return result
+############################################
+_MATCH_POOL = None
+_MATCH_POOL_LOCK = threading.Lock()
+_VISION_POOL = None # 设置后, 多个模板的MatchPlan交给进程池执行(visionpool.py)
+def SetVisionPool(pool):
+    global _VISION_POOL
+    _VISION_POOL = pool
+def MatchPool():
+    global _MATCH_POOL
+    with _MATCH_POOL_LOCK:
+        if _MATCH_POOL is None:
+            _MATCH_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="MatchPlan")
+        return _MATCH_POOL
+class MatchResult:
+    def __init__(self, target, roi = None):
+        self.target = target
+        self.roi = roi
+        self.score = None # None表示没有执行(优先级模式下被提前结束)
+        self.loc = None   # 整帧坐标系下模板左上角
+        self.pos = None   # 达到阈值时为模板中心坐标, 否则为None
+    def __repr__(self):
+        score = "-" if self.score is None else f"{self.score*100:.2f}%"
+        return f"<{self.target} {score} {self.pos}>"
+class MatchPlan:
+    """一次性匹配多个模板.
+    targets中的每一项可以是模板的shortPath, 也可以是(shortPath, roi).
+    run返回与targets一一对应的MatchResult列表(包含分数和位置);
+    priority=True时按targets顺序取第一个命中的结果, 命中后不再等待后面的模板."""
+    def __init__(self, targets, priority = False, threshold = MATCH_THRESHOLD):
+        self.items = []
+        for t in targets:
+            if isinstance(t, (list, tuple)):
+                self.items.append((t[0], CompileRoI(t[1])))
+            else:
+                self.items.append((t, None))
+        self.priority = priority
+        self.threshold = threshold
+
+    def _match(self, screenImage, result):
+        template = LoadTemplateImage(result.target)
+        if template is None:
+            result.score = 0.0
+            return result
+        try:
+            max_val, max_loc = MatchOnFrame(screenImage, result.target, template, result.roi, self.threshold)
+        except cv2.error as e:
+            logger.error(f"{result.target}: {e}")
+            max_val, max_loc = 0.0, None
+        result.score = max_val
+        result.loc = max_loc
+        if max_loc is not None:
+            logger.debug(f"搜索到疑似{result.target}, 匹配程度:{max_val*100:.2f}%")
+            if max_val >= self.threshold:
+                result.pos = [max_loc[0] + template.shape[1]//2, max_loc[1] + template.shape[0]//2]
+        return result
+
+    def run(self, screenImage):
+        if len(self.items) > 1 and (pool := _VISION_POOL) is not None:
+            try:
+                return pool.run(screenImage, self.items, self.threshold)
+            except Exception as e:
+                logger.error(f"图像匹配进程池出错, 改为在本进程匹配: {e}")
+        results = [MatchResult(target, roi) for target, roi in self.items]
+        if len(results) == 1:
+            self._match(screenImage, results[0])
+            return results
+        pool = MatchPool()
+        futures = [pool.submit(self._match, screenImage, r) for r in results]
+        for i, future in enumerate(futures):
+            future.result()
+            if self.priority and results[i].pos is not None:
+                for f in futures[i+1:]:
+                    f.cancel()
+                break
+        return results
+
+    def first(self, screenImage):
+        """返回按顺序第一个命中的MatchResult, 没有命中时返回None."""
+        for result in self.run(screenImage):
+            if result.pos is not None:
+                return result
+        return None
@@ -0,0 +1,301 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import numpy as np
+from utils import *
+from vision import *
+
+############################################
+# VISION POOL. 在多个worker进程中执行MatchPlan, 使匹配不再只占用农场线程所在的一个核.
+# 画面通过共享内存传递: 池中有slots个帧槽, 提交时把画面复制进一个空闲的帧槽, 任务中只传槽号和形状.
+# 同一帧上的模板被分成若干份交给不同的worker同时匹配, 全部完成后释放帧槽. 帧槽用完时提交会等待(背压).
+# 模板同样放在共享内存中(ShareTemplatePack); fleet模式下可以直接使用启动器的那一份.
+# 提交后立即返回Future, 农场线程可以在匹配进行时截取下一帧(见script.py的CaptureFrame).
+# 出错: worker中的异常作为该任务的结果传回, 对应的Future以RuntimeError结束(MatchPlan会改为在本进程匹配).
+#       run()超时的帧被放弃, 帧槽立即收回; worker进程意外退出时放弃所有未完成的帧, 换新的队列并重启所有worker.
+#       之后才到达的结果找不到对应的任务, 直接丢弃.
+# 各阶段耗时: slot(等待空闲帧槽), copy(复制到帧槽), wait(在任务队列中等待), match(worker中匹配),
+#             return(结果传回), total(提交到全部完成). 队列深度为已提交但尚未返回的任务数.
+VISION_FRAME_SHAPE = (1600, 900, 3)
+VISION_STAGES = ['slot', 'copy', 'wait', 'match', 'return', 'total']
+
+def _VisionWorker(templateShm, frameShms, tasks, results):
+    TEMPLATE_PACK.attach_shared(templateShm)
+    frames = [shared_memory.SharedMemory(name=name) for name in frameShms]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        taskId, slot, shape, items, threshold, submitted = task
+        started = time.time()
+        output, error = [], None
+        try:
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=frames[slot].buf)
+            plan = MatchPlan(items, threshold = threshold)
+            for target, roi in plan.items:
+                result = plan._match(frame, MatchResult(target, roi))
+                output.append((result.score, result.loc, result.pos))
+            del frame
+        except Exception as e:
+            output, error = None, f"{type(e).__name__}: {e}"
+        results.put((taskId, output, error, submitted, started, time.time()))
+    # 释放所有指向共享内存的数组, 否则退出时无法关闭共享内存.
+    ReleaseViews()
+    TEMPLATE_STORE.invalidate()
+    TEMPLATE_PACK.close()
+    for shm in frames:
+        shm.close()
+
+class _FrameJob:
+    def __init__(self, slot, shape, items):
+        self.slot = slot
+        self.shape = shape
+        self.items = items
+        self.results = [None] * len(items)
+        self.remaining = 0
+        self.taskIds = []
+        self.error = None
+        self.closed = False # 已经完成或被放弃, 帧槽已经收回
+        self.submitted = time.time()
+        self.future = Future()
+
+class VisionPool:
+    def __init__(self, workers = 2, slots = 4, templateShm = None, slot_timeout = 10):
+        self.workers = workers
+        self.slot_timeout = slot_timeout # 等待空闲帧槽的最长时间
+        self._ownTemplates = None
+        if templateShm is None:
+            self._ownTemplates = ShareTemplatePack()
+            templateShm = self._ownTemplates.name
+        self._frames = [shared_memory.SharedMemory(create=True, size=int(np.prod(VISION_FRAME_SHAPE))) for _ in range(slots)]
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workerArgs = (templateShm, [shm.name for shm in self._frames], self._tasks, self._results)
+        self._processes = [self._spawn(i) for i in range(workers)]
+        self._closing = False
+        self._spawnLock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = {} # taskId -> (_FrameJob, 在该帧中的序号)
+        self._nextId = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.frames = 0
+        self.failures = 0 # 出错或被放弃的帧
+        self.restarts = 0 # 重启worker的次数
+        self._depth_total = 0
+        self._stages = {stage: [0, 0.0, 0.0] for stage in VISION_STAGES} # stage -> [次数, 总耗时, 最大耗时]
+        self._collector = threading.Thread(target=self._collect, name="VisionPoolCollector", daemon=True)
+        self._collector.start()
+        logger.info(f"图像匹配进程池已启动: {workers}个进程, {slots}个帧槽.")
+
+    def _spawn(self, index):
+        process = multiprocessing.Process(target=_VisionWorker, name=f"VisionWorker-{index}", daemon=True, args=self._workerArgs)
+        process.start()
+        return process
+
+    def _release(self, job, error = None):
+        """在持有锁时调用. 收回帧槽并结束Future, 返回是否需要由调用者设置结果."""
+        if job.closed:
+            return False
+        job.closed = True
+        if error is not None:
+            job.error = job.error or error
+        for taskId in job.taskIds:
+            if self._pending.pop(taskId, None) is not None:
+                self.depth -= 1
+        if job.slot is not None:
+            self._free.put(job.slot)
+        if job.error is not None:
+            self.failures += 1
+        return True
+
+    def _abandon(self, job, reason):
+        with self._lock:
+            released = self._release(job, reason)
+        if released:
+            logger.warning(f"图像匹配进程池: 放弃一帧({reason}).")
+            if not job.future.done():
+                job.future.set_exception(RuntimeError(reason))
+
+    def _check_workers(self):
+        # 收集线程和农场线程都会调用, 用_spawnLock避免重复重启.
+        with self._spawnLock:
+            if self._closing:
+                return
+            dead = [i for i, process in enumerate(self._processes) if not process.is_alive()]
+            if not dead:
+                return
+            for i in dead:
+                logger.error(f"图像匹配进程池: VisionWorker-{i}意外退出(exitcode {self._processes[i].exitcode}).")
+            # 不知道退出的worker正在处理哪个任务, 放弃所有未完成的帧.
+            with self._lock:
+                jobs = list({id(job): job for job, _ in self._pending.values()}.values())
+            for job in jobs:
+                self._abandon(job, "worker进程意外退出")
+            # 被强制结束的进程可能正持有队列的锁, 旧的队列不能再用: 换新的队列并重启所有worker.
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join(5)
+            self._tasks = multiprocessing.Queue()
+            self._results = multiprocessing.Queue()
+            self._workerArgs = self._workerArgs[:2] + (self._tasks, self._results)
+            self._processes = [self._spawn(i) for i in range(self.workers)]
+            self.restarts += 1
+            logger.info(f"图像匹配进程池: 已重启{self.workers}个worker进程.")
+
+    def _record(self, stage, cost):
+        stat = self._stages[stage]
+        stat[0] += 1
+        stat[1] += cost
+        stat[2] = max(stat[2], cost)
+
+    def submit(self, screenImage, items, threshold = MATCH_THRESHOLD):
+        """items为MatchPlan.items([(shortPath, RoI或None)]). 返回Future, 结果为与items对应的MatchResult列表."""
+        return self._submit(screenImage, items, threshold).future
+
+    def _submit(self, screenImage, items, threshold):
+        if screenImage.dtype != np.uint8 or screenImage.nbytes > self._frames[0].size:
+            # 尺寸不对的画面(例如横屏)直接在本线程匹配, 之后由ScreenShot处理.
+            job = _FrameJob(None, screenImage.shape, items)
+            job.closed = True
+            plan = MatchPlan([], threshold = threshold)
+            job.future.set_result([plan._match(screenImage, MatchResult(target, roi)) for target, roi in items])
+            return job
+        t = time.perf_counter()
+        try:
+            slot = self._free.get(timeout = self.slot_timeout)
+        except queue.Empty:
+            self._check_workers()
+            raise RuntimeError(f"{self.slot_timeout}秒内没有空闲的帧槽")
+        slotCost = time.perf_counter() - t
+        t = time.perf_counter()
+        np.ndarray(screenImage.shape, dtype=np.uint8, buffer=self._frames[slot].buf)[:] = screenImage
+        copyCost = time.perf_counter() - t
+
+        job = _FrameJob(slot, screenImage.shape, items)
+        # 每个worker一份. RoI对象带有掩码缓存, 只传矩形, 由worker自己编译.
+        chunks = [list(range(i, len(items), self.workers)) for i in range(min(self.workers, len(items)))]
+        job.remaining = len(chunks)
+        with self._lock:
+            self._record('slot', slotCost)
+            self._record('copy', copyCost)
+            self.frames += 1
+            tasks = []
+            for chunk in chunks:
+                taskId = self._nextId
+                self._nextId += 1
+                self._pending[taskId] = (job, chunk)
+                job.taskIds.append(taskId)
+                tasks.append((taskId, chunk))
+            self.depth += len(tasks)
+            self.max_depth = max(self.max_depth, self.depth)
+            self._depth_total += self.depth
+        for taskId, chunk in tasks:
+            chunkItems = [(items[i][0], items[i][1].rects if items[i][1] is not None else None) for i in chunk]
+            self._tasks.put((taskId, slot, screenImage.shape, chunkItems, threshold, time.time()))
+        if not chunks:
+            with self._lock:
+                self._release(job)
+            job.future.set_result([])
+        return job
+
+    def run(self, screenImage, items, threshold = MATCH_THRESHOLD, timeout = 30):
+        job = self._submit(screenImage, items, threshold)
+        try:
+            return job.future.result(timeout)
+        except futures.TimeoutError: # 3.11之前与内置的TimeoutError不是同一个类
+            self._check_workers()
+            self._abandon(job, f"{timeout}秒内没有完成")
+            raise TimeoutError(f"匹配任务在{timeout}秒内没有完成")
+
+    def _collect(self):
+        while True:
+            try:
+                message = self._results.get(timeout = 1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if message is None:
+                break
+            taskId, output, error, submitted, started, finished = message
+            now = time.time()
+            with self._lock:
+                entry = self._pending.pop(taskId, None)
+                if entry is None:
+                    continue # 所属的帧已经被放弃
+                job, chunk = entry
+                self.depth -= 1
+                self._record('wait', started - submitted)
+                self._record('match', finished - started)
+                self._record('return', now - finished)
+                if error is not None:
+                    job.error = job.error or error
+                else:
+                    for index, (score, loc, pos) in zip(chunk, output):
+                        target, roi = job.items[index]
+                        result = MatchResult(target, roi)
+                        result.score, result.loc, result.pos = score, loc, pos
+                        job.results[index] = result
+                job.remaining -= 1
+                done = job.remaining == 0 and self._release(job)
+                if done and job.error is None:
+                    self._record('total', now - job.submitted)
+            if not done:
+                continue
+            if job.error is not None:
+                logger.error(f"图像匹配进程池: worker出错: {job.error}")
+                job.future.set_exception(RuntimeError(job.error))
+                continue
+            for result in job.results:
+                if result.roi is None and result.pos is not None:
+                    HOTSPOTS.record(result.target, job.shape, result.loc)
+            job.future.set_result(job.results)
+
+    def close(self):
+        with self._spawnLock:
+            self._closing = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(5)
+        self._results.put(None)
+        self._collector.join(5)
+        with self._lock:
+            for job, _ in self._pending.values():
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("图像匹配进程池已关闭"))
+            self._pending.clear()
+        for shm in self._frames:
+            shm.close()
+            shm.unlink()
+        if self._ownTemplates is not None:
+            self._ownTemplates.close()
+            self._ownTemplates.unlink()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'frames': self.frames,
+                'failures': self.failures,
+                'restarts': self.restarts,
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'mean_depth': self._depth_total / self.frames if self.frames else 0.0,
+                'stages': {stage: {'count': n, 'mean': total / n if n else 0.0, 'max': worst} for stage, (n, total, worst) in self._stages.items()},
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        if not s['frames']:
+            return
+        stages = ", ".join(f"{stage}:平均{v['mean']*1000:.1f}ms/最大{v['max']*1000:.1f}ms" for stage, v in s['stages'].items() if v['count'])
+        errors = f"出错或放弃{s['failures']}帧, 重启worker{s['restarts']}次. " if s['failures'] or s['restarts'] else ""
+        logger.info(f"图像匹配进程池: {s['frames']}帧, {errors}队列深度平均{s['mean_depth']:.1f}/最大{s['max_depth']}. {stages}.")
@@ -43,6 +43,14 @@ if errorlevel 1 (
     exit /b 1
 )
 
+echo Building template pack...
+python src/build_template_pack.py
+if errorlevel 1 (
+    echo Failed to build template pack.
+    pause
+    exit /b 1
+)
+
 :: 生成时间戳（格式：年月日时分）
 for /f %%i in ('powershell -Command "Get-Date -Format 'yyyyMMddHHmm'"') do set timestamp=%%i
 